@@ -4,3 +4,50 @@ Created on Sat Jun 12 18:36:07 2021
 
 @author: vorst
 """
+
+# Importing the package must stay fast and free of side effects. pyodbc and
+# pandas are imported on first use, and AsyncSQLBase (which pulls in asyncio)
+# is imported on first attribute access
+import logging
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+from .sql_tools import (SQLBase,
+                        pyodbc_connection_str,
+                        sqlalchemy_connection_str,
+                        quote_identifier,
+                        DepreciationError,
+                        NameUsedError,
+                        DetachError)
+from .pool import ConnectionPool, PoolTimeoutError, PoolClosedError
+from .retry import RetryPolicy
+from .instrumentation import Event, HistogramCollector, SlowQueryLogger
+
+_lazy_attributes = {'AsyncSQLBase':'.async_sql_tools',
+                    'DatabaseSpec':'.batch',
+                    'DatabaseResult':'.batch',
+                    'process_databases':'.batch',
+                    'Backend':'.backends',
+                    'PyodbcBackend':'.backends',
+                    'DBAPIBackend':'.backends',
+                    'SQLAlchemyBackend':'.backends',
+                    'SQLiteBackend':'.backends',
+                    'KeysetPaginator':'.pagination',
+                    'Page':'.pagination',
+                    'KeyRange':'.pagination',
+                    'FanoutResult':'.fanout',
+                    'TableInfo':'.metadata',
+                    'ColumnInfo':'.metadata',
+                    'IndexInfo':'.metadata',
+                    'StateStore':'.incremental',
+                    'TableExtract':'.incremental',
+                    'StagingCache':'.staging',
+                    'StagedFiles':'.staging',
+                    'ProfileReport':'.profiling'}
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+        module = importlib.import_module(_lazy_attributes[name], __name__)
+        return getattr(module, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
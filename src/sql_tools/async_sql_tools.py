@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio interface to SQLBase. pyodbc calls block, so every call is
+dispatched to a dedicated thread pool sized to match a bounded connection
+pool. The event loop stays free while hundreds of queries are in flight.
+Calls and open streams share max_workers slots; a stream keeps its slot (and
+its pooled connection) until it is exhausted or closed, and further calls
+wait for a slot on the event loop instead of on the connection pool
+
+@author: vorst
+"""
+
+# Python imports
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+
+# Third party imports
+
+# Local imports
+from .sql_tools import SQLBase
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+_EXHAUSTED = object()
+
+
+class AsyncSQLBase:
+
+    def __init__(self,
+                 server_name=None,
+                 driver_name=None,
+                 max_workers=16,
+                 pool_timeout=30,
+                 sqlbase=None,
+                 backend=None):
+        """Awaitable versions of the SQLBase methods. Each call runs on a
+        thread from a private ThreadPoolExecutor, and each thread borrows a
+        connection from a SQLBase connection pool of max_workers connections.
+        Call connect() (or use 'async with') before querying
+
+        inputs
+        -------
+        server_name : (str) name of sql server
+        driver_name : (str) type of driver
+        max_workers : (int) number of executor threads and the maximum
+            number of pooled connections per database. This bounds the
+            number of calls and open streams at once; further calls wait
+            their turn without blocking the event loop
+        pool_timeout : (float) seconds a call waits for a pooled connection
+        sqlbase : (SQLBase) wrap an existing instance instead of creating one.
+            server_name, driver_name and backend are ignored, and the executor
+            is sized to sqlbase.pool_size instead of max_workers
+        backend : (Backend) passed to SQLBase (see sql_tools.backends)"""
+
+        if sqlbase is not None:
+            # One thread per pooled connection, so no call waits on the pool
+            max_workers = sqlbase.pool_size
+        self.server_name = server_name
+        self.driver_name = driver_name
+        self.backend = backend
+        self.max_workers = max_workers
+        self.pool_timeout = pool_timeout
+        self.sqlbase = sqlbase
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='sql_tools')
+        # Created on first use so it belongs to the running event loop
+        self._slots = None
+
+        return None
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+        return None
+
+
+    def _get_slots(self):
+        """Semaphore of max_workers slots. Every executor call or open stream
+        holds one, so a thread is always free for a stream which already
+        holds a pooled connection"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        return self._slots
+
+
+    async def _run(self, function, *args, **kwargs):
+        """Wait for a slot, then run function(*args, **kwargs) on the
+        executor and await the result"""
+        async with self._get_slots():
+            return await self._run_in_slot(function, *args, **kwargs)
+
+
+    async def _run_in_slot(self, function, *args, **kwargs):
+        """Run function(*args, **kwargs) on the executor. Call while holding
+        a slot"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(function, *args, **kwargs))
+
+
+    async def _stream(self, generator):
+        """Iterate a blocking generator on the executor. A slot is held until
+        the generator is exhausted or closed, because the generator holds a
+        pooled connection for that long"""
+        async with self._get_slots():
+            try:
+                while True:
+                    item = await self._run_in_slot(next, generator, _EXHAUSTED)
+                    if item is _EXHAUSTED:
+                        break
+                    yield item
+            finally:
+                # Returns the pooled connection if iteration stopped early
+                await self._run_in_slot(generator.close)
+
+
+    async def connect(self):
+        """Create the underlying SQLBase (which opens and tests the master
+        connection) without blocking the event loop"""
+        if self.sqlbase is None:
+            self.sqlbase = await self._run(SQLBase,
+                                           self.server_name,
+                                           self.driver_name,
+                                           pool_size=self.max_workers,
+                                           pool_timeout=self.pool_timeout,
+                                           backend=self.backend)
+        return self
+
+
+    async def close(self):
+        """Close the master and pooled connections and shut down the executor"""
+        if self.sqlbase is not None:
+            # Does not wait for a slot, which an open stream may never release
+            await self._run_in_slot(self.sqlbase.close)
+        self._executor.shutdown(wait=False)
+        return None
+
+
+    async def init_database_connection(self, database_name):
+        """See SQLBase.init_database_connection"""
+        return await self._run(self.sqlbase.init_database_connection, database_name)
+
+
+    async def execute_sql(self, sql_query, params=None, database_name=None):
+        """See SQLBase.execute_sql"""
+        return await self._run(self.sqlbase.execute_sql,
+                               sql_query,
+                               params=params,
+                               database_name=database_name)
+
+
+    async def execute_sql_master(self, sql_query, params=None):
+        """See SQLBase.execute_sql_master"""
+        return await self._run(self.sqlbase.execute_sql_master, sql_query, params=params)
+
+
+    async def pandas_execute_sql(self, sql_query, params=None, database_name=None):
+        """See SQLBase.pandas_execute_sql"""
+        return await self._run(self.sqlbase.pandas_execute_sql,
+                               sql_query,
+                               params=params,
+                               database_name=database_name)
+
+
+    async def bulk_insert(self, data, table, **kwargs):
+        """See SQLBase.bulk_insert"""
+        return await self._run(self.sqlbase.bulk_insert, data, table, **kwargs)
+
+
+    async def execute_sql_batches(self,
+                                  sql_query,
+                                  params=None,
+                                  arraysize=5000,
+                                  database_name=None):
+        """Asynchronous iterator over batches of rows. Each fetchmany round
+        trip runs on the executor. See SQLBase.execute_sql_batches
+        outputs
+        -------
+        rows : (async generator) of (list) of rows"""
+        batches = self._stream(
+            self.sqlbase.execute_sql_batches(sql_query,
+                                             params=params,
+                                             arraysize=arraysize,
+                                             database_name=database_name))
+        try:
+            async for rows in batches:
+                yield rows
+        finally:
+            await batches.aclose()
+
+
+    async def iter_rows(self,
+                        sql_query,
+                        params=None,
+                        arraysize=5000,
+                        database_name=None):
+        """Asynchronous iterator over individual rows, fetched arraysize rows
+        per round trip
+        usage
+        -------
+        async for row in db.iter_rows('SELECT * FROM [POINTBAS]'):
+            ...
+        When breaking out of the loop early, wrap the iterator in
+        contextlib.aclosing so the pooled connection is returned immediately
+        instead of when the iterator is garbage collected"""
+        batches = self.execute_sql_batches(sql_query,
+                                           params=params,
+                                           arraysize=arraysize,
+                                           database_name=database_name)
+        try:
+            async for rows in batches:
+                for row in rows:
+                    yield row
+        finally:
+            await batches.aclose()
+
+
+    async def pandas_execute_sql_chunks(self,
+                                        sql_query,
+                                        params=None,
+                                        chunksize=50000,
+                                        database_name=None):
+        """Asynchronous iterator over dataframes of at most chunksize rows.
+        See SQLBase.pandas_execute_sql_chunks"""
+        chunks = self._stream(
+            self.sqlbase.pandas_execute_sql_chunks(sql_query,
+                                                   params=params,
+                                                   chunksize=chunksize,
+                                                   database_name=database_name))
+        try:
+            async for df in chunks:
+                yield df
+        finally:
+            await chunks.aclose()
+
+
+    async def attach_database(self, path_mdf, path_ldf, database_name):
+        """See SQLBase.attach_database"""
+        return await self._run(self.sqlbase.attach_database,
+                               path_mdf,
+                               path_ldf,
+                               database_name)
+
+
+    async def detach_database(self, database_name):
+        """See SQLBase.detach_database"""
+        return await self._run(self.sqlbase.detach_database, database_name)
+
+
+    async def check_existing_database(self, path_mdf, database_name):
+        """See SQLBase.check_existing_database"""
+        return await self._run(self.sqlbase.check_existing_database,
+                               path_mdf,
+                               database_name)
+
+
+    def pool_stats(self):
+        """See SQLBase.pool_stats"""
+        return self.sqlbase.pool_stats()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+AsyncSQLBase tests, run over SQLiteBackend with asyncio.run
+
+@author: vorst
+"""
+
+# Python imports
+import asyncio
+import contextlib
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+from sql_tools.async_sql_tools import AsyncSQLBase
+
+#%%
+
+class AsyncSQLBaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend, pool_size=3)
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)',
+                                 database_name='JobDB')
+        self.sqlbase.bulk_insert([(i, 'JHW.AHU{}'.format(i)) for i in range(10)],
+                                 'POINTBAS', columns=['ID', 'NAME'], database_name='JobDB')
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_executor_matches_pool(self):
+
+        async def run():
+            db = AsyncSQLBase(max_workers=8, sqlbase=self.sqlbase)
+            results = await asyncio.gather(*[
+                db.execute_sql('SELECT COUNT(*) FROM POINTBAS WHERE ID >= ?',
+                               params=[i], database_name='JobDB')
+                for i in range(10)])
+            stats = db.pool_stats()['JobDB']
+            await db.close()
+            return db, results, stats
+
+        db, results, stats = asyncio.run(run())
+
+        self.assertEqual(db.max_workers, 3)
+        self.assertEqual(db._executor._max_workers, self.sqlbase.pool_size)
+        self.assertEqual([result[0][0] for result in results], list(range(10, 0, -1)))
+        self.assertLessEqual(stats['size'], 3)
+        self.assertEqual(stats['waits'], 0)
+        return None
+
+
+    def test_iterators_return_connection_when_closed_early(self):
+
+        async def run():
+            db = AsyncSQLBase(sqlbase=self.sqlbase)
+            async with contextlib.aclosing(
+                    db.execute_sql_batches('SELECT * FROM POINTBAS ORDER BY ID',
+                                           arraysize=3,
+                                           database_name='JobDB')) as batches:
+                async for rows in batches:
+                    first = rows
+                    break
+            after_batches = db.pool_stats()['JobDB']['checked_out']
+
+            async with contextlib.aclosing(
+                    db.iter_rows('SELECT * FROM POINTBAS ORDER BY ID',
+                                 arraysize=3,
+                                 database_name='JobDB')) as rows:
+                async for row in rows:
+                    if row[0] == 4:
+                        break
+            after_rows = db.pool_stats()['JobDB']['checked_out']
+
+            async with contextlib.aclosing(
+                    db.pandas_execute_sql_chunks('SELECT * FROM POINTBAS ORDER BY ID',
+                                                 chunksize=4,
+                                                 database_name='JobDB')) as chunks:
+                async for df in chunks:
+                    break
+            after_chunks = db.pool_stats()['JobDB']['checked_out']
+            await db.close()
+            return first, df, (after_batches, after_rows, after_chunks)
+
+        first, df, checked_out = asyncio.run(run())
+
+        self.assertEqual([tuple(row) for row in first],
+                         [(0, 'JHW.AHU0'), (1, 'JHW.AHU1'), (2, 'JHW.AHU2')])
+        self.assertEqual(len(df), 4)
+        self.assertEqual(checked_out, (0, 0, 0))
+        return None
+
+
+    def test_streams_queue_for_slots(self):
+
+        async def consume(db, i):
+            count = 0
+            async for row in db.iter_rows('SELECT * FROM POINTBAS WHERE ID >= ?',
+                                          params=[i],
+                                          arraysize=2,
+                                          database_name='JobDB'):
+                count += 1
+                await asyncio.sleep(0.01)
+            return count
+
+        async def run():
+            # More streams than connections; each holds a connection until
+            # it is exhausted, so the rest wait for a slot
+            sqlbase = SQLBase(None, None, lazy=True, backend=self.backend,
+                              pool_size=2, pool_timeout=0.5)
+            db = AsyncSQLBase(sqlbase=sqlbase)
+            counts = await asyncio.gather(*[consume(db, i) for i in range(6)],
+                                          db.execute_sql('SELECT COUNT(*) FROM POINTBAS',
+                                                         database_name='JobDB'))
+            stats = db.pool_stats()['JobDB']
+            await db.close()
+            return counts, stats
+
+        counts, stats = asyncio.run(run())
+
+        self.assertEqual(counts[:6], list(range(10, 4, -1)))
+        self.assertEqual(counts[6][0][0], 10)
+        self.assertLessEqual(stats['size'], 2)
+        # No executor thread blocked on the exhausted pool
+        self.assertEqual(stats['waits'], 0)
+        self.assertEqual(stats['checked_out'], 0)
+        return None
+
+
+    def test_context_manager_closes(self):
+
+        async def run():
+            async with AsyncSQLBase(backend=self.backend, max_workers=2) as db:
+                rows = await db.execute_sql('SELECT COUNT(*) FROM POINTBAS',
+                                            database_name='JobDB')
+                self.assertEqual(rows[0][0], 10)
+                self.assertIsNotNone(db.sqlbase._master_connection)
+                self.assertEqual(db.sqlbase.pool_size, 2)
+            return db
+
+        db = asyncio.run(run())
+
+        self.assertIsNone(db.sqlbase._master_connection)
+        self.assertEqual(db.pool_stats(), {})
+        with self.assertRaises(RuntimeError):
+            db._executor.submit(print)
+        return None
+
+
+    def test_close(self):
+
+        async def run():
+            db = AsyncSQLBase(sqlbase=self.sqlbase)
+            await db.execute_sql('SELECT 1', database_name='JobDB')
+            await db.close()
+            return db
+
+        db = asyncio.run(run())
+
+        self.assertEqual(self.sqlbase.pool_stats(), {})
+        with self.assertRaises(RuntimeError):
+            db._executor.submit(print)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+Backends open DB-API connections for SQLBase. Pooling, statement caching,
+streaming, retries and the DataFrame paths in SQLBase only use the DB-API,
+so the same code runs over pyodbc (the default), a SQLAlchemy engine, any
+other DB-API 2 driver such as pymssql, or an in-process SQLite database.
+SQLBase writes ? parameter markers; backends for drivers with another
+paramstyle translate them
+
+Attaching, detaching and the server file catalog use T-SQL and only work on
+SQL Server backends
+
+@author: vorst
+"""
+
+# Python imports
+import functools
+import itertools
+import os
+import re
+import sqlite3
+import threading
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+# String literals, quoted identifiers and comments are skipped when
+# translating ? markers
+_token_re = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|\[[^\]]*(?:\]\][^\]]*)*\]|--[^\n]*|/\*.*?\*/|\?|%""",
+                       re.DOTALL)
+
+
+@functools.lru_cache(maxsize=1024)
+def convert_qmark(sql, paramstyle):
+    """Translate ? parameter markers in sql to paramstyle ('qmark',
+    'format', 'pyformat', 'numeric' or 'named'). Markers inside string
+    literals, quoted identifiers and comments are left alone. For the format
+    styles literal % signs are doubled"""
+    if paramstyle == 'qmark':
+        return sql
+
+    counter = itertools.count(1)
+
+    def replace(match):
+        token = match.group(0)
+        if token == '?':
+            if paramstyle in ('format', 'pyformat'):
+                return '%s'
+            if paramstyle == 'numeric':
+                return ':{}'.format(next(counter))
+            if paramstyle == 'named':
+                return ':p{}'.format(next(counter))
+            raise ValueError('Unsupported paramstyle {}'.format(paramstyle))
+        if token == '%':
+            return '%%' if paramstyle in ('format', 'pyformat') else '%'
+        return token
+
+    return _token_re.sub(replace, sql)
+
+
+def _convert_params(params, paramstyle):
+    if paramstyle == 'named' and params is not None and not isinstance(params, dict):
+        return {'p{}'.format(i):value for i, value in enumerate(params, start=1)}
+    return params
+
+
+class ParamstyleCursor:
+
+    def __init__(self, cursor, paramstyle):
+        """Cursor wrapper which translates ? markers for the driver. Other
+        attributes are passed through to the driver cursor"""
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_paramstyle', paramstyle)
+
+        return None
+
+
+    def execute(self, sql, params=None):
+        sql = convert_qmark(sql, self._paramstyle)
+        if params is None:
+            self._cursor.execute(sql)
+        else:
+            self._cursor.execute(sql, _convert_params(params, self._paramstyle))
+        return self
+
+
+    def executemany(self, sql, seq_of_params):
+        sql = convert_qmark(sql, self._paramstyle)
+        self._cursor.executemany(sql, [_convert_params(params, self._paramstyle)
+                                       for params in seq_of_params])
+        return self
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._cursor.close()
+        return False
+
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+    def __setattr__(self, name, value):
+        # arraysize, fast_executemany and so on belong to the driver cursor
+        setattr(self._cursor, name, value)
+
+
+class ProxyConnection:
+
+    def __init__(self, connection, paramstyle='qmark', dbapi_connection=None):
+        """Connection wrapper used by backends which hand out proxies (the
+        SQLAlchemy pool) or use another paramstyle. autocommit is applied
+        to the underlying driver connection
+        inputs
+        -------
+        connection : connection returned by the driver or pool
+        paramstyle : (str) paramstyle of the driver
+        dbapi_connection : the driver connection, if connection is a proxy"""
+        self._connection = connection
+        self._dbapi_connection = connection if dbapi_connection is None else dbapi_connection
+        self._paramstyle = paramstyle
+        self._closed = False
+        # DB-API connections start with autocommit off
+        self._autocommit = False
+
+        return None
+
+
+    def cursor(self):
+        return ParamstyleCursor(self._connection.cursor(), self._paramstyle)
+
+
+    def commit(self):
+        self._connection.commit()
+        return None
+
+
+    def rollback(self):
+        self._connection.rollback()
+        return None
+
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._connection.close()
+        return None
+
+
+    @property
+    def closed(self):
+        return self._closed or getattr(self._dbapi_connection, 'closed', False)
+
+
+    @property
+    def autocommit(self):
+        value = getattr(self._dbapi_connection, 'autocommit', self._autocommit)
+        if callable(value):
+            # Drivers like pymssql set it with a method and report the
+            # state in autocommit_state
+            value = getattr(self._dbapi_connection, 'autocommit_state', self._autocommit)
+        return bool(value)
+
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if callable(getattr(self._dbapi_connection, 'autocommit', None)):
+            self._dbapi_connection.autocommit(value)
+        else:
+            self._dbapi_connection.autocommit = value
+        self._autocommit = bool(value)
+
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class Backend:
+    """Opens connections for SQLBase. Subclasses implement connect"""
+
+    # True if connections returned by connect are already pooled by the
+    # backend. SQLBase then closes released connections (returning them to
+    # the backend pool) instead of keeping them idle
+    pools_connections = False
+    # True if the database speaks T-SQL (attach, detach, file catalog)
+    is_sql_server = False
+
+    def connect(self, database_name):
+        """Return a new DB-API connection to database_name. SQLBase uses
+        database_name 'master' for server level statements"""
+        raise NotImplementedError
+
+
+    def close(self):
+        """Release resources held by the backend. Called by SQLBase.close"""
+        return None
+
+
+    def __repr__(self):
+        return '{}()'.format(type(self).__name__)
+
+
+class PyodbcBackend(Backend):
+
+    is_sql_server = True
+
+    def __init__(self, server_name, driver_name, uid=None, pwd=None, **connect_kwargs):
+        """Connect with pyodbc using a SQL Server ODBC driver
+        inputs
+        -------
+        server_name : (str) name of sql server
+        driver_name : (str) ODBC driver, like 'SQL Server Native Client 11.0'
+        uid, pwd : (str) SQL Server login. Windows authentication
+            (Trusted_Connection) is used if uid is None
+        connect_kwargs : passed to pyodbc.connect, like timeout or
+            readonly"""
+        self.server_name = server_name
+        if not driver_name.startswith('{'):
+            driver_name = '{{{}}}'.format(driver_name)
+        self.driver_name = driver_name
+        self.uid = uid
+        self.pwd = pwd
+        self.connect_kwargs = connect_kwargs
+
+        return None
+
+
+    def connection_str(self, database_name):
+        from .sql_tools import pyodbc_connection_str
+        return pyodbc_connection_str(self.server_name,
+                                     self.driver_name,
+                                     database_name,
+                                     pwd=self.pwd,
+                                     uid=self.uid,
+                                     trusted_connection=self.uid is None)
+
+
+    def connect(self, database_name):
+        from .sql_tools import _import_pyodbc
+        return _import_pyodbc().connect(self.connection_str(database_name), **self.connect_kwargs)
+
+
+    def __repr__(self):
+        return 'PyodbcBackend({!r}, {!r})'.format(self.server_name, self.driver_name)
+
+
+class DBAPIBackend(Backend):
+
+    def __init__(self, driver, database_argument='database', paramstyle=None,
+                 is_sql_server=False, **connect_kwargs):
+        """Connect with any DB-API 2 driver
+        inputs
+        -------
+        driver : DB-API module (like pymssql) or a connect function
+        database_argument : (str) keyword of the driver connect function
+            which selects the database. None to not pass the database
+        paramstyle : (str) parameter style of the driver. Defaults to
+            driver.paramstyle for modules, otherwise 'qmark'
+        is_sql_server : (bool) True if the driver connects to SQL Server,
+            which enables attach / detach
+        connect_kwargs : other keyword arguments of the connect function,
+            like server, user and password
+        usage
+        -------
+        import pymssql
+        backend = DBAPIBackend(pymssql, server='localhost', is_sql_server=True)
+        sqlbase = SQLBase(backend=backend)"""
+        if callable(driver) and not hasattr(driver, 'connect'):
+            self._connect = driver
+            self.paramstyle = paramstyle or 'qmark'
+        else:
+            self._connect = driver.connect
+            self.paramstyle = paramstyle or getattr(driver, 'paramstyle', 'qmark')
+        self.database_argument = database_argument
+        self.is_sql_server = is_sql_server
+        self.connect_kwargs = connect_kwargs
+
+        return None
+
+
+    def connect(self, database_name):
+        kwargs = dict(self.connect_kwargs)
+        if self.database_argument is not None:
+            kwargs[self.database_argument] = database_name
+        connection = self._connect(**kwargs)
+        if self.paramstyle == 'qmark':
+            return connection
+        return ProxyConnection(connection, self.paramstyle)
+
+
+class SQLAlchemyBackend(Backend):
+
+    pools_connections = True
+
+    def __init__(self, engine, **engine_kwargs):
+        """Borrow connections from a SQLAlchemy engine and its pool
+        (QueuePool by default). Queries run on the raw DB-API connection,
+        so results are the same as with the driver directly
+        inputs
+        -------
+        engine : (sqlalchemy.engine.Engine or str) engine or database URL.
+            Databases other than the URL database get their own engine,
+            created from the URL with the database replaced
+        engine_kwargs : passed to sqlalchemy.create_engine for engines this
+            backend creates, like pool_size or fast_executemany"""
+        self.engine_kwargs = engine_kwargs
+        if isinstance(engine, str):
+            engine = self._create_engine(engine)
+            self._owned = [engine]
+        else:
+            self._owned = []
+        self.engine = engine
+        self.is_sql_server = engine.dialect.name == 'mssql'
+        self._engines = {engine.url.database:engine}
+        self._lock = threading.Lock()
+
+        return None
+
+
+    @classmethod
+    def for_sql_server(cls, server_name, driver_name, database_name='master', **engine_kwargs):
+        """Backend for a SQL Server engine using mssql+pyodbc with Windows
+        authentication, see sqlalchemy_connection_str"""
+        from .sql_tools import sqlalchemy_connection_str
+        url = sqlalchemy_connection_str(server_name, driver_name.strip('{}'), database_name)
+        return cls(url, **engine_kwargs)
+
+
+    def _create_engine(self, url):
+        try:
+            import sqlalchemy
+        except ImportError as e:
+            raise ImportError('SQLAlchemyBackend requires sqlalchemy. Try pip install sqlalchemy') from e
+        return sqlalchemy.create_engine(url, **self.engine_kwargs)
+
+
+    def engine_for(self, database_name):
+        """Return the engine connected to database_name"""
+        with self._lock:
+            if database_name not in self._engines:
+                url = self.engine.url.set(database=database_name)
+                engine = self._create_engine(url)
+                self._owned.append(engine)
+                self._engines[database_name] = engine
+            return self._engines[database_name]
+
+
+    def connect(self, database_name):
+        engine = self.engine if database_name is None else self.engine_for(database_name)
+        connection = engine.raw_connection()
+        dbapi_connection = getattr(connection, 'dbapi_connection', None)
+        if dbapi_connection is None:
+            # SQLAlchemy 1.4
+            dbapi_connection = connection.connection
+        return ProxyConnection(connection, engine.dialect.paramstyle, dbapi_connection)
+
+
+    def close(self):
+        """Dispose engines created by this backend. An engine passed in by
+        the caller is left open"""
+        with self._lock:
+            for engine in self._owned:
+                engine.dispose()
+            self._engines = {database:engine for database, engine in self._engines.items()
+                             if engine not in self._owned}
+            self._owned = []
+
+        return None
+
+
+    def __repr__(self):
+        return 'SQLAlchemyBackend({!r})'.format(str(self.engine.url))
+
+
+class _SQLiteCursor(sqlite3.Cursor):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        return False
+
+
+class _SQLiteConnection(sqlite3.Connection):
+
+    # SQLBase sets autocommit around server level statements
+    autocommit = False
+
+    @property
+    def closed(self):
+        try:
+            self.total_changes
+        except sqlite3.ProgrammingError:
+            return True
+        return False
+
+    def cursor(self, factory=_SQLiteCursor):
+        return super().cursor(factory)
+
+
+_sqlite_counter = itertools.count()
+
+
+class SQLiteBackend(Backend):
+
+    def __init__(self, directory=None):
+        """In-process SQLite databases, for tests and benchmarks. Each
+        database name is a separate SQLite database
+        inputs
+        -------
+        directory : (str) directory holding one <database_name>.db file per
+            database. If None, databases are shared in-memory databases
+            which live until close()"""
+        self.directory = directory
+        self._prefix = 'sql_tools_{}_{}_'.format(os.getpid(), next(_sqlite_counter))
+        self._keepers = {}
+        self._lock = threading.Lock()
+
+        return None
+
+
+    def _uri(self, database_name):
+        if self.directory is not None:
+            return os.path.join(self.directory, '{}.db'.format(database_name)), False
+        return 'file:{}{}?mode=memory&cache=shared'.format(self._prefix, database_name), True
+
+
+    def connect(self, database_name):
+        database, uri = self._uri(database_name)
+        if uri:
+            # An in-memory database is dropped when its last connection closes
+            with self._lock:
+                if database_name not in self._keepers:
+                    self._keepers[database_name] = sqlite3.connect(database,
+                                                                   uri=True,
+                                                                   check_same_thread=False)
+        return sqlite3.connect(database,
+                               uri=uri,
+                               check_same_thread=False,
+                               factory=_SQLiteConnection)
+
+
+    def close(self):
+        with self._lock:
+            keepers = list(self._keepers.values())
+            self._keepers.clear()
+        for connection in keepers:
+            connection.close()
+
+        return None
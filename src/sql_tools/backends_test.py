@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Backend tests. SQLBase runs over SQLiteBackend and DBAPIBackend(sqlite3), so
+no SQL Server instance is needed
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+import sqlite3
+import tempfile
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import (SQLiteBackend, DBAPIBackend, SQLAlchemyBackend,
+                                ProxyConnection, convert_qmark)
+
+#%%
+
+class _MethodAutocommitConnection:
+    """Driver connection which sets autocommit with a method, like pymssql"""
+
+    def __init__(self):
+        self.autocommit_state = False
+        return None
+
+    def autocommit(self, status):
+        self.autocommit_state = status
+        return None
+
+    def cursor(self):
+        return _Cursor()
+
+
+class _Cursor:
+
+    def close(self):
+        return None
+
+
+class _AttributeAutocommitConnection:
+
+    autocommit = False
+
+
+def _setup(sqlbase):
+    sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)', database_name='JobDB')
+    sqlbase.bulk_insert([(i, 'JHW.AHU{}'.format(i)) for i in range(10)],
+                        'POINTBAS', columns=['ID', 'NAME'], database_name='JobDB')
+    sqlbase.init_database_connection('JobDB')
+    return sqlbase
+
+
+class BackendTest(unittest.TestCase):
+
+    def test_convert_qmark(self):
+
+        sql = "SELECT * FROM [a?] WHERE NAME = 'x?' AND ID = ? AND VALUE LIKE '%' -- ?"
+        self.assertEqual(convert_qmark(sql, 'format'),
+                         "SELECT * FROM [a?] WHERE NAME = 'x?' AND ID = %s AND VALUE LIKE '%' -- ?")
+        self.assertEqual(convert_qmark('SELECT ? % 2, ?', 'pyformat'), 'SELECT %s %% 2, %s')
+        self.assertEqual(convert_qmark('SELECT ?, ?', 'numeric'), 'SELECT :1, :2')
+        self.assertEqual(convert_qmark('SELECT ?', 'qmark'), 'SELECT ?')
+        return None
+
+
+    def test_sqlite_backend(self):
+
+        backend = SQLiteBackend()
+        sqlbase = _setup(SQLBase(None, None, lazy=True, backend=backend))
+
+        self.assertEqual(sqlbase.execute_sql('SELECT NAME FROM POINTBAS WHERE ID = ?', (3,))[0][0],
+                         'JHW.AHU3')
+        self.assertEqual(len(sqlbase.pandas_execute_sql('SELECT * FROM POINTBAS')), 10)
+        batches = list(sqlbase.execute_sql_batches('SELECT * FROM POINTBAS', arraysize=4))
+        self.assertEqual([len(rows) for rows in batches], [4, 4, 2])
+        with self.assertRaises(NotImplementedError):
+            sqlbase.detach_database('JobDB')
+
+        sqlbase.close()
+        # In-memory databases live until the backend is closed
+        self.assertEqual(len(sqlbase.execute_sql('SELECT * FROM POINTBAS')), 10)
+        backend.close()
+        return None
+
+
+    def test_proxy_autocommit(self):
+
+        driver = _MethodAutocommitConnection()
+        connection = ProxyConnection(driver)
+        self.assertIs(connection.autocommit, False)
+        connection.autocommit = True
+        self.assertIs(driver.autocommit_state, True)
+        self.assertIs(connection.autocommit, True)
+
+        # The master cursor restores the previous state, not a method
+        sqlbase = SQLBase(None, None, lazy=True, backend=SQLiteBackend())
+        connection.autocommit = False
+        with sqlbase._master_cursor(autocommit=True, connection=connection):
+            self.assertIs(driver.autocommit_state, True)
+        self.assertIs(driver.autocommit_state, False)
+        self.assertIs(connection.autocommit, False)
+
+        # Drivers like pyodbc use an attribute
+        driver = _AttributeAutocommitConnection()
+        connection = ProxyConnection(driver)
+        connection.autocommit = True
+        self.assertIs(driver.autocommit, True)
+        self.assertIs(connection.autocommit, True)
+        return None
+
+
+    def test_named_paramstyle(self):
+
+        # sqlite3 also accepts :name markers
+        backend = DBAPIBackend(sqlite3.connect,
+                               paramstyle='named',
+                               database_argument=None,
+                               database=':memory:',
+                               check_same_thread=False)
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend, pool_size=1)
+        rows = sqlbase.execute_sql('SELECT ? + ?', (1, 2), database_name='JobDB')
+
+        self.assertEqual(rows[0][0], 3)
+        return None
+
+
+    def test_sqlalchemy_backend(self):
+        try:
+            import sqlalchemy
+        except ImportError:
+            self.skipTest('sqlalchemy is not installed')
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = sqlalchemy.create_engine('sqlite:///{}/JobDB.db'.format(directory))
+            backend = SQLAlchemyBackend(engine)
+            sqlbase = SQLBase(None, None, lazy=True, backend=backend, pool_size=1)
+            sqlbase.init_database_connection(engine.url.database)
+            rows = sqlbase.execute_sql('SELECT ?', (5,))
+
+            self.assertEqual(rows[0][0], 5)
+            # Released connections go back to the engine pool
+            self.assertEqual(sqlbase.pool_stats()[engine.url.database]['idle'], 0)
+            self.assertEqual(engine.pool.checkedin(), 1)
+            engine.dispose()
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Attach, extract from and detach many databases with bounded concurrency.
+Each worker thread owns one master session for the whole batch, so trace
+flag 1807 is turned on once per session instead of once per file and
+attaches do not serialize on the shared master connection
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+DatabaseSpec = namedtuple('DatabaseSpec', ['path_mdf', 'path_ldf', 'database_name'])
+
+DatabaseResult = namedtuple('DatabaseResult',
+                            ['database_name',
+                             'result',
+                             'error',
+                             'attach_seconds',
+                             'extract_seconds',
+                             'detach_seconds'])
+DatabaseResult.__doc__ = """Outcome of processing one database. error is None
+on success, otherwise the exception raised while attaching, extracting or
+detaching. Timings are None for steps which did not run"""
+
+
+class _MasterSessions:
+
+    def __init__(self, sqlbase, traceflag):
+        """One dedicated master connection per worker thread. Connections are
+        opened on first use by each thread and closed by close()"""
+        self.sqlbase = sqlbase
+        self.traceflag = traceflag
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        return None
+
+
+    def connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            connection = self.sqlbase._connect_database('master')
+            connection.autocommit = True
+            with self._lock:
+                self._connections.append(connection)
+            if self.traceflag:
+                self.sqlbase.traceon1807(True, connection=connection)
+            self._local.connection = connection
+
+        return self._local.connection
+
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+
+        for connection in connections:
+            try:
+                if self.traceflag:
+                    self.sqlbase.traceon1807(False, connection=connection)
+                connection.close()
+            except Exception as e:
+                logger.debug(e)
+
+        return None
+
+
+def _process_one(sqlbase, sessions, spec, extract=None, detach=True):
+    """Attach, extract from and detach one database on the master session
+    of the calling thread. Returns a DatabaseResult"""
+    result = None
+    error = None
+    attach_seconds = extract_seconds = detach_seconds = None
+    attached = False
+
+    try:
+        connection = sessions.connection()
+
+        start = time.perf_counter()
+        sqlbase.attach_database(spec.path_mdf,
+                                spec.path_ldf,
+                                spec.database_name,
+                                manage_traceflag=False,
+                                connection=connection)
+        attach_seconds = time.perf_counter() - start
+        attached = True
+
+        if extract is not None:
+            start = time.perf_counter()
+            result = extract(sqlbase, spec.database_name)
+            extract_seconds = time.perf_counter() - start
+
+    except Exception as e:
+        logger.info('Database {} failed : {}'.format(spec.database_name, e))
+        error = e
+
+    if attached and detach:
+        try:
+            start = time.perf_counter()
+            sqlbase.detach_database(spec.database_name, connection=sessions.connection())
+            detach_seconds = time.perf_counter() - start
+        except Exception as e:
+            logger.info('Database {} detach failed : {}'.format(spec.database_name, e))
+            if error is None:
+                error = e
+
+    return DatabaseResult(spec.database_name,
+                          result,
+                          error,
+                          attach_seconds,
+                          extract_seconds,
+                          detach_seconds)
+
+
+def process_databases(sqlbase,
+                      specs,
+                      extract=None,
+                      max_workers=4,
+                      detach=True):
+    """Attach each database in specs, call extract on it, then detach it.
+    Up to max_workers databases are processed at once. A failure on one
+    database is reported in its result and does not stop the batch
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    specs : (iterable) of (path_mdf, path_ldf, database_name) tuples
+    extract : (callable) called as extract(sqlbase, database_name) after the
+        database is attached, for example
+        lambda sqlbase, name: sqlbase.pandas_execute_sql(sql, database_name=name)
+    max_workers : (int) number of databases processed at once
+    detach : (bool) detach each database after extract (also after a failed
+        extract)
+    outputs
+    -------
+    results : (list) of (DatabaseResult) in the order of specs"""
+
+    specs = [DatabaseSpec(*spec) for spec in specs]
+    traceflag = any(sqlbase.is_network_path(spec.path_mdf) for spec in specs)
+    sessions = _MasterSessions(sqlbase, traceflag)
+
+    def run(spec):
+        return _process_one(sqlbase, sessions, spec, extract, detach)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix='sql_tools_batch') as executor:
+            results = list(executor.map(run, specs))
+    finally:
+        sessions.close()
+
+    n_failed = sum(1 for result in results if result.error is not None)
+    logger.info('Processed {} databases in {:.1f}s, {} failed'.format(
+        len(results), time.perf_counter() - start, n_failed))
+
+    return results
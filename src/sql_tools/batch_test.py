@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Batch attach / extract / detach tests. A fake SQLBase records the master
+sessions each call runs on, so these do not need a SQL Server instance
+
+@author: vorst
+"""
+
+# Python imports
+import threading
+import time
+import unittest
+
+# local imports
+from sql_tools.batch import (process_databases, _process_one, _MasterSessions,
+                             DatabaseSpec)
+
+#%%
+
+class _FakeConnection:
+
+    def __init__(self):
+        self.autocommit = False
+        self.closed = False
+        return None
+
+    def close(self):
+        self.closed = True
+        return None
+
+
+class _FakeSQLBase:
+    """Records attach, detach and trace flag calls per master session"""
+
+    def __init__(self, fail_attach=(), fail_detach=()):
+        self.fail_attach = fail_attach
+        self.fail_detach = fail_detach
+        self.connections = []
+        self.traceflags = []
+        self.attached = {}
+        self.detached = {}
+        self.threads = {}
+        self._lock = threading.Lock()
+        return None
+
+    def _connect_database(self, database_name):
+        connection = _FakeConnection()
+        with self._lock:
+            self.connections.append(connection)
+        return connection
+
+    def traceon1807(self, Flag, connection=None):
+        with self._lock:
+            self.traceflags.append((Flag, connection))
+        return None
+
+    @staticmethod
+    def is_network_path(path_mdf):
+        return path_mdf.startswith('\\\\')
+
+    def attach_database(self, path_mdf, path_ldf, database_name,
+                        manage_traceflag=True, connection=None):
+        assert not manage_traceflag
+        with self._lock:
+            self.threads.setdefault(id(connection), set()).add(threading.get_ident())
+        # Hold the session so other workers open their own
+        time.sleep(0.01)
+        if database_name in self.fail_attach:
+            raise OSError('Could not attach {}'.format(database_name))
+        self.attached[database_name] = connection
+        return None
+
+    def detach_database(self, database_name, connection=None):
+        if database_name in self.fail_detach:
+            raise RuntimeError('Could not detach {}'.format(database_name))
+        self.detached[database_name] = connection
+        return None
+
+
+def _specs(n, share='\\\\server\\share'):
+    return [('{}\\JobDB{}.mdf'.format(share, i), '{}\\JobDB{}_Log.ldf'.format(share, i),
+             'JobDB{}'.format(i)) for i in range(n)]
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_master_session_per_worker(self):
+
+        sqlbase = _FakeSQLBase()
+        results = process_databases(sqlbase,
+                                    _specs(12),
+                                    extract=lambda sqlbase, name: name.lower(),
+                                    max_workers=3)
+
+        self.assertEqual([result.result for result in results],
+                         ['jobdb{}'.format(i) for i in range(12)])
+        self.assertLessEqual(len(sqlbase.connections), 3)
+        self.assertGreater(len(sqlbase.connections), 1)
+        # Each session is used by one thread only, and a database is
+        # detached on the session which attached it
+        self.assertTrue(all(len(threads) == 1 for threads in sqlbase.threads.values()))
+        self.assertEqual(sqlbase.attached, sqlbase.detached)
+        for connection in sqlbase.connections:
+            self.assertTrue(connection.autocommit)
+            self.assertTrue(connection.closed)
+        return None
+
+
+    def test_traceflag_once_per_session(self):
+
+        sqlbase = _FakeSQLBase()
+        process_databases(sqlbase, _specs(12), max_workers=3)
+
+        on = [connection for flag, connection in sqlbase.traceflags if flag]
+        off = [connection for flag, connection in sqlbase.traceflags if not flag]
+        self.assertEqual(sorted(map(id, on)), sorted(map(id, sqlbase.connections)))
+        self.assertEqual(sorted(map(id, off)), sorted(map(id, sqlbase.connections)))
+
+        # Local files do not need the trace flag
+        sqlbase = _FakeSQLBase()
+        process_databases(sqlbase, _specs(4, share='D:\\Jobs'), max_workers=2)
+        self.assertEqual(sqlbase.traceflags, [])
+        return None
+
+
+    def test_errors_do_not_stop_batch(self):
+
+        def extract(sqlbase, database_name):
+            if database_name == 'JobDB2':
+                raise ValueError('bad table')
+            return database_name
+
+        sqlbase = _FakeSQLBase(fail_attach=('JobDB1',), fail_detach=('JobDB3',))
+        results = process_databases(sqlbase, _specs(5), extract=extract, max_workers=2)
+
+        self.assertEqual([result.database_name for result in results],
+                         ['JobDB{}'.format(i) for i in range(5)])
+        self.assertEqual([type(result.error) for result in results],
+                         [type(None), OSError, ValueError, RuntimeError, type(None)])
+        # A failed attach is not detached
+        self.assertNotIn('JobDB1', sqlbase.detached)
+        self.assertIsNone(results[1].attach_seconds)
+        self.assertIsNone(results[1].detach_seconds)
+        # A failed extract is still detached
+        self.assertIn('JobDB2', sqlbase.detached)
+        self.assertIsNone(results[2].result)
+        # A failed detach keeps the extract result
+        self.assertEqual(results[3].result, 'JobDB3')
+        self.assertIsNone(results[3].detach_seconds)
+        return None
+
+
+    def test_timings(self):
+
+        sqlbase = _FakeSQLBase()
+        sessions = _MasterSessions(sqlbase, traceflag=False)
+        spec = DatabaseSpec(*_specs(1)[0])
+
+        result = _process_one(sqlbase, sessions, spec,
+                              extract=lambda sqlbase, name: time.sleep(0.02))
+        self.assertIsNone(result.error)
+        self.assertGreaterEqual(result.attach_seconds, 0.01)
+        self.assertGreaterEqual(result.extract_seconds, 0.02)
+        self.assertGreaterEqual(result.detach_seconds, 0)
+
+        result = _process_one(sqlbase, sessions, spec, detach=False)
+        self.assertIsNone(result.extract_seconds)
+        self.assertIsNone(result.detach_seconds)
+        sessions.close()
+        self.assertEqual(len(sqlbase.connections), 1)
+        self.assertTrue(sqlbase.connections[0].closed)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
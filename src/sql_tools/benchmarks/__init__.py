@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for sql_tools. Run a benchmark module with
+python -m sql_tools.benchmarks.<module>
+
+@author: vorst
+"""
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the columnar fetch path (sql_tools.columnar.fetch_columnar) with
+the record based routes on a wide table. An in-memory sqlite3 database
+stands in for SQL Server, so this measures client side decoding and
+DataFrame construction, not network transfer.
+
+The columnar path is about as fast as the record routes (the transpose and
+the DataFrame construction are both done in C); its benefit is memory. It
+holds one fetchmany batch of rows at a time instead of every row tuple of
+the result, and keeps integer columns with NULLs as integers. Both the time
+and the peak memory (traced with tracemalloc, in a separate untimed run) of
+each route are reported. sqlite3.Row is used as the row type to model
+pyodbc.Row objects :
+read_sql : pandas.read_sql on plain tuples
+records : tuple(row) per Row and DataFrame.from_records, the route used by
+    SQLBase.pandas_execute_sql
+columnar : fetch_columnar on Row objects, the route used by
+    SQLBase.columnar_execute_sql
+
+usage
+-------
+python -m sql_tools.benchmarks.columnar_fetch --rows 200000 --columns 40
+
+@author: vorst
+"""
+
+# Python imports
+import argparse
+import datetime
+import json
+import sqlite3
+import time
+import tracemalloc
+import warnings
+
+# Third party imports
+import pandas as pd
+
+# Local imports
+from sql_tools.columnar import fetch_columnar
+
+
+#%%
+
+def make_table(n_rows, n_columns):
+    """Create an in-memory table with a mix of integer, float, text and
+    nullable integer columns"""
+    connection = sqlite3.connect(':memory:')
+    kinds = ['INTEGER', 'REAL', 'TEXT', 'INTEGER']
+    names = ['c{}'.format(i) for i in range(n_columns)]
+    connection.execute('CREATE TABLE wide ({})'.format(
+        ', '.join('{} {}'.format(name, kinds[i % 4]) for i, name in enumerate(names))))
+
+    def row(r):
+        values = []
+        for i in range(n_columns):
+            kind = i % 4
+            if kind == 0:
+                values.append(r)
+            elif kind == 1:
+                values.append(r * 0.5)
+            elif kind == 2:
+                values.append('NAME.{}.{}'.format(r, i))
+            else:
+                values.append(None if r % 7 == 0 else r)
+        return values
+
+    connection.executemany('INSERT INTO wide VALUES ({})'.format(', '.join('?' * n_columns)),
+                           (row(r) for r in range(n_rows)))
+    connection.commit()
+
+    return connection
+
+
+def time_it(function, repeat):
+    seconds = []
+    for _i in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def peak_memory_mb(function):
+    """Peak memory traced while function runs, in MB. NumPy and pandas
+    buffers are traced along with Python objects"""
+    tracemalloc.start()
+    try:
+        result = function()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak / 2**20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the columnar fetch path')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--columns', type=int, default=40)
+    parser.add_argument('--arraysize', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    connection = make_table(args.rows, args.columns)
+    row_connection = make_table(args.rows, args.columns)
+    row_connection.row_factory = sqlite3.Row
+    sql = 'SELECT * FROM wide'
+
+    def read_sql():
+        with warnings.catch_warnings():
+            # pandas warns about DB-API connections other than SQLAlchemy
+            warnings.simplefilter('ignore')
+            return pd.read_sql(sql, connection)
+
+    def records():
+        cursor = row_connection.cursor()
+        cursor.execute(sql)
+        columns = [column[0] for column in cursor.description]
+        return pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()],
+                                         columns=columns,
+                                         coerce_float=True)
+
+    def columnar():
+        cursor = row_connection.cursor()
+        cursor.execute(sql)
+        return fetch_columnar(cursor, arraysize=args.arraysize, output='pandas')
+
+    read_sql_seconds = time_it(read_sql, args.repeat)
+    records_seconds = time_it(records, args.repeat)
+    columnar_seconds = time_it(columnar, args.repeat)
+    read_sql_mb = peak_memory_mb(read_sql)
+    records_mb = peak_memory_mb(records)
+    columnar_mb = peak_memory_mb(columnar)
+
+    report = {'rows':args.rows,
+              'columns':args.columns,
+              'read_sql_seconds':read_sql_seconds,
+              'records_seconds':records_seconds,
+              'columnar_seconds':columnar_seconds,
+              'speedup_vs_records':records_seconds / columnar_seconds,
+              'speedup_vs_read_sql':read_sql_seconds / columnar_seconds,
+              'read_sql_peak_mb':read_sql_mb,
+              'records_peak_mb':records_mb,
+              'columnar_peak_mb':columnar_mb,
+              'memory_vs_records':columnar_mb / records_mb,
+              'memory_vs_read_sql':columnar_mb / read_sql_mb,
+              'date':datetime.datetime.now().isoformat(timespec='seconds')}
+    print(json.dumps(report, indent=2))
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process DB-API stand-in for SQL Server, used by the benchmark suite.
+Statements run on shared in-memory sqlite3 databases (one per database name)
+and every server round trip sleeps for a configurable latency, so the cost
+of logins, round trips and fetch sizes shows up as it would over a network.
+executemany makes one round trip when cursor.fast_executemany is True
+(like pyodbc) and one per row otherwise
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+import itertools
+import sqlite3
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+
+
+#%%
+
+Latency = namedtuple('Latency', ['connect', 'round_trip', 'per_row'])
+Latency.__new__.__defaults__ = (0.005, 0.0002, 0.0)
+Latency.__doc__ = """Simulated server latency in seconds. connect is paid per
+login, round_trip per statement or fetch call and per_row for every row sent
+or received"""
+
+# Same names as pyodbc / DB-API so SQLBase error handling applies
+Error = sqlite3.Error
+OperationalError = sqlite3.OperationalError
+InterfaceError = sqlite3.InterfaceError
+
+_counter = itertools.count()
+
+
+def _sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+    return None
+
+
+class FakeServer:
+
+    def __init__(self, latency=Latency()):
+        """A set of in-memory databases shared by all connections of this
+        server. Each database is kept alive by one unlatent keeper
+        connection until close()"""
+        self.latency = latency
+        self._prefix = 'sql_tools_bench_{}_'.format(next(_counter))
+        self._keepers = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects':0, 'round_trips':0, 'rows':0}
+
+        return None
+
+
+    def _uri(self, database_name):
+        return 'file:{}{}?mode=memory&cache=shared'.format(self._prefix, database_name)
+
+
+    def database(self, database_name):
+        """Return the keeper sqlite3 connection of database_name, for setup
+        without simulated latency"""
+        with self._lock:
+            if database_name not in self._keepers:
+                self._keepers[database_name] = sqlite3.connect(
+                    self._uri(database_name), uri=True, check_same_thread=False)
+            return self._keepers[database_name]
+
+
+    def connect(self, database_name):
+        """Open a FakeConnection to database_name, paying the login latency"""
+        self.database(database_name)
+        _sleep(self.latency.connect)
+        self._count('connects')
+        connection = sqlite3.connect(self._uri(database_name),
+                                     uri=True,
+                                     check_same_thread=False)
+        return FakeConnection(self, connection)
+
+
+    def round_trip(self, rows=0):
+        _sleep(self.latency.round_trip + rows * self.latency.per_row)
+        self._count('round_trips')
+        if rows:
+            self._count('rows', rows)
+        return None
+
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+        return None
+
+
+    def close(self):
+        with self._lock:
+            keepers = list(self._keepers.values())
+            self._keepers.clear()
+        for connection in keepers:
+            connection.close()
+
+        return None
+
+
+class FakeConnection:
+
+    def __init__(self, server, connection):
+        self.server = server
+        self._connection = connection
+        self.autocommit = False
+        self.closed = False
+
+        return None
+
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+    def commit(self):
+        self._connection.commit()
+        return None
+
+
+    def rollback(self):
+        self._connection.rollback()
+        return None
+
+
+    def close(self):
+        if not self.closed:
+            self._connection.close()
+            self.closed = True
+        return None
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection._connection.cursor()
+        self.arraysize = 1
+        self.fast_executemany = False
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        return False
+
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+    def execute(self, sql, params=()):
+        self.connection.server.round_trip()
+        self._cursor.execute(sql, params)
+        return self
+
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        server = self.connection.server
+        if self.fast_executemany:
+            server.round_trip(len(seq_of_params))
+        else:
+            for _params in seq_of_params:
+                server.round_trip(1)
+        self._cursor.executemany(sql, seq_of_params)
+        return self
+
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self.connection.server.round_trip(0 if row is None else 1)
+        return row
+
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(self.arraysize if size is None else size)
+        self.connection.server.round_trip(len(rows))
+        return rows
+
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.connection.server.round_trip(len(rows))
+        return rows
+
+
+    def nextset(self):
+        return None
+
+
+    def close(self):
+        self._cursor.close()
+        return None
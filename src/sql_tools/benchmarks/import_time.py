@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how long 'import sql_tools' takes in a fresh interpreter, and check
+that importing has no side effects : pyodbc and pandas are not loaded, no
+logging handlers are configured on the root logger and no files are created
+in the working directory
+
+usage
+-------
+python -m sql_tools.benchmarks.import_time --repeat 20
+
+@author: vorst
+"""
+
+# Python imports
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Third party imports
+
+# Local imports
+
+
+#%%
+
+_PROBE = """
+import sys, time, logging, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds':seconds,
+                  'pyodbc':'pyodbc' in sys.modules,
+                  'pandas':'pandas' in sys.modules,
+                  'root_handlers':len(logging.getLogger().handlers)}}))
+"""
+
+
+def measure_import(module='sql_tools', repeat=10):
+    """Import module in repeat fresh interpreters and report import times
+    inputs
+    -------
+    module : (str) module to import
+    repeat : (int) number of interpreters to start
+    outputs
+    -------
+    report : (dict) with keys 'median_ms', 'min_ms', 'max_ms', 'pyodbc_loaded',
+        'pandas_loaded', 'root_handlers' and 'files_created'"""
+
+    samples = []
+    probe = _PROBE.format(module=module)
+    with tempfile.TemporaryDirectory() as cwd:
+        for _i in range(repeat):
+            output = subprocess.run([sys.executable, '-c', probe],
+                                    cwd=cwd,
+                                    stdout=subprocess.PIPE,
+                                    check=True,
+                                    env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+            samples.append(json.loads(output.stdout.decode()))
+        files_created = os.listdir(cwd)
+
+    seconds = [sample['seconds'] for sample in samples]
+    report = {'module':module,
+              'repeat':repeat,
+              'median_ms':statistics.median(seconds) * 1000,
+              'min_ms':min(seconds) * 1000,
+              'max_ms':max(seconds) * 1000,
+              'pyodbc_loaded':any(sample['pyodbc'] for sample in samples),
+              'pandas_loaded':any(sample['pandas'] for sample in samples),
+              'root_handlers':max(sample['root_handlers'] for sample in samples),
+              'files_created':files_created}
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark import time of sql_tools')
+    parser.add_argument('--module', default='sql_tools')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    report = measure_import(args.module, args.repeat)
+    report['wall_seconds'] = time.perf_counter() - start
+    print(json.dumps(report, indent=2))
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
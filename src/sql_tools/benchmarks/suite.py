@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark suite for SQLBase. SQL Server is replaced by the
+in-process stand-in in sql_tools.benchmarks.fakedb (sqlite3 with simulated
+login and round trip latency), so the suite runs in CI and on Linux without
+an ODBC driver. Each benchmark reports throughput, latency percentiles and
+peak traced memory (tracemalloc, measured in a separate untimed run).
+Results can be saved as a baseline and later runs compared against it
+
+usage
+-------
+python -m sql_tools.benchmarks.suite --save-baseline baseline.json
+python -m sql_tools.benchmarks.suite --baseline baseline.json --tolerance 0.25
+
+@author: vorst
+"""
+
+# Python imports
+import argparse
+from collections import namedtuple
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Third party imports
+
+# Local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.benchmarks.fakedb import FakeServer, Latency
+
+
+#%%
+
+DATABASE = 'bench'
+
+CatalogRow = namedtuple('CatalogRow', ['physical_name', 'database_name'])
+
+
+class BenchSQLBase(SQLBase):
+
+    def __init__(self, server, n_catalog_databases=0, **kwargs):
+        """SQLBase connected to a FakeServer instead of SQL Server
+        inputs
+        -------
+        server : (FakeServer)
+        n_catalog_databases : (int) number of attached databases reported by
+            the server file catalog"""
+        self.server = server
+        self.n_catalog_databases = n_catalog_databases
+        kwargs.setdefault('lazy', True)
+        super().__init__('bench', 'fakedb', **kwargs)
+
+        return None
+
+
+    def _init_master_connection(self):
+        self.master_connection = self.server.connect('master')
+        return None
+
+
+    def _connect_database(self, database_name):
+        return self.server.connect(database_name)
+
+
+    def _load_catalog(self):
+        # One round trip for the whole catalog, like the sys.master_files query
+        rows = []
+        for i in range(self.n_catalog_databases):
+            rows.append(CatalogRow('D:\\jobs\\job{}\\JobDB.mdf'.format(i), 'job{}'.format(i)))
+            rows.append(CatalogRow('D:\\jobs\\job{}\\JobDB_Log.ldf'.format(i), 'job{}'.format(i)))
+        self.server.round_trip(len(rows))
+        return rows
+
+
+def make_server(latency, n_rows):
+    """FakeServer with table POINTBAS of n_rows rows in DATABASE"""
+    server = FakeServer(latency)
+    connection = server.database(DATABASE)
+    connection.execute('CREATE TABLE POINTBAS (ID INTEGER PRIMARY KEY, NAME TEXT, '
+                       'VALUE REAL, NETDEVID INTEGER)')
+    connection.executemany('INSERT INTO POINTBAS VALUES (?, ?, ?, ?)',
+                           ((i, 'JHW.AHU{}.TEMP'.format(i), i * 0.5,
+                             None if i % 7 == 0 else i % 100) for i in range(n_rows)))
+    connection.execute('CREATE TABLE SCRATCH (ID INTEGER, NAME TEXT, VALUE REAL)')
+    connection.commit()
+
+    return server
+
+
+def percentile(sorted_values, q):
+    """Linear interpolated percentile of a sorted list, q from 0 to 1"""
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    position = q * (len(sorted_values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def run_benchmark(name, function, repeat, unit):
+    """Call function repeat times and report its latency and throughput.
+    function returns the number of units (rows or operations) it processed.
+    One extra call under tracemalloc measures peak memory
+    inputs
+    -------
+    name : (str)
+    function : (callable) called with no arguments
+    repeat : (int) number of timed calls
+    unit : (str) what function counts, for the report
+    outputs
+    -------
+    report : (dict)"""
+    # Warm up pools, caches and imports
+    function()
+
+    seconds = []
+    units = 0
+    for _i in range(repeat):
+        start = time.perf_counter()
+        units += function()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds.sort()
+    total = sum(seconds)
+    report = {'name':name,
+              'repeat':repeat,
+              'unit':unit,
+              'units_per_call':units / repeat,
+              'throughput':units / total if total > 0 else float('inf'),
+              'mean_ms':statistics.mean(seconds) * 1000,
+              'p50_ms':percentile(seconds, 0.5) * 1000,
+              'p95_ms':percentile(seconds, 0.95) * 1000,
+              'p99_ms':percentile(seconds, 0.99) * 1000,
+              'max_ms':seconds[-1] * 1000,
+              'peak_memory_mb':peak / 2**20}
+
+    return report
+
+
+def benchmarks(latency=Latency(), n_rows=100000, scale=1.0):
+    """Return a list of (name, function, repeat, unit) and a cleanup
+    function. scale multiplies the repeat counts"""
+    server = make_server(latency, n_rows)
+    sqlbase = BenchSQLBase(server, n_catalog_databases=2000)
+    sqlbase.init_database_connection(DATABASE)
+    insert_rows = [(i, 'JHW.AHU{}'.format(i), i * 0.5) for i in range(min(n_rows, 20000))]
+
+    def repeat(n):
+        return max(3, int(n * scale))
+
+    def connect():
+        instance = BenchSQLBase(server)
+        instance.init_database_connection(DATABASE)
+        instance.close()
+        return 1
+
+    def execute_sql_point():
+        rows = sqlbase.execute_sql('SELECT * FROM POINTBAS WHERE ID = ?', (n_rows // 2,))
+        return len(rows)
+
+    def execute_sql_full():
+        return len(sqlbase.execute_sql('SELECT * FROM POINTBAS'))
+
+    def execute_sql_records():
+        return len(sqlbase.execute_sql('SELECT * FROM POINTBAS', row_format='record'))
+
+    def pandas_execute_sql():
+        return len(sqlbase.pandas_execute_sql('SELECT * FROM POINTBAS'))
+
+    def execute_sql_batches():
+        n = 0
+        for rows in sqlbase.execute_sql_batches('SELECT * FROM POINTBAS', arraysize=5000):
+            n += len(rows)
+        return n
+
+    def bulk_insert():
+        report = sqlbase.bulk_insert(insert_rows, 'SCRATCH', columns=['ID', 'NAME', 'VALUE'])
+        sqlbase.execute_sql('DELETE FROM SCRATCH')
+        return report['rows']
+
+    def catalog_lookup():
+        for i in range(100):
+            sqlbase.check_existing_database('D:\\jobs\\job{}\\JobDB.mdf'.format(i * 7),
+                                            'job{}'.format(i * 7))
+        return 100
+
+    def close():
+        sqlbase.close()
+        server.close()
+        return None
+
+    return ([('connect', connect, repeat(50), 'logins'),
+             ('execute_sql_point', execute_sql_point, repeat(200), 'rows'),
+             ('execute_sql_full', execute_sql_full, repeat(5), 'rows'),
+             ('execute_sql_records', execute_sql_records, repeat(5), 'rows'),
+             ('pandas_execute_sql', pandas_execute_sql, repeat(5), 'rows'),
+             ('execute_sql_batches', execute_sql_batches, repeat(5), 'rows'),
+             ('bulk_insert', bulk_insert, repeat(5), 'rows'),
+             ('catalog_lookup', catalog_lookup, repeat(50), 'lookups')],
+            close)
+
+
+def compare(reports, baseline, tolerance=0.25):
+    """Compare reports with a baseline. A benchmark regresses when its p50
+    latency is more than tolerance (fraction) above the baseline p50
+    outputs
+    -------
+    comparison : (dict) of {name : {'baseline_p50_ms', 'p50_ms', 'ratio',
+        'regressed'}} for benchmarks present in both"""
+    baseline = {report['name']:report for report in baseline['benchmarks']}
+    comparison = {}
+    for report in reports:
+        previous = baseline.get(report['name'])
+        if previous is None:
+            continue
+        ratio = report['p50_ms'] / previous['p50_ms'] if previous['p50_ms'] else float('inf')
+        comparison[report['name']] = {'baseline_p50_ms':previous['p50_ms'],
+                                      'p50_ms':report['p50_ms'],
+                                      'ratio':ratio,
+                                      'regressed':ratio > 1 + tolerance}
+
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline SQLBase benchmark suite')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='rows in the benchmark table')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplier for the number of timed calls')
+    parser.add_argument('--connect-latency', type=float, default=5.0,
+                        help='simulated login latency in ms')
+    parser.add_argument('--round-trip-latency', type=float, default=0.2,
+                        help='simulated round trip latency in ms')
+    parser.add_argument('--only', default=None,
+                        help='comma separated benchmark names to run')
+    parser.add_argument('--save-baseline', default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='compare with this JSON file, exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p50 slowdown against the baseline (fraction)')
+    args = parser.parse_args(argv)
+
+    latency = Latency(connect=args.connect_latency / 1000,
+                      round_trip=args.round_trip_latency / 1000)
+    only = None if args.only is None else set(args.only.split(','))
+
+    cases, close = benchmarks(latency, n_rows=args.rows, scale=args.scale)
+    reports = []
+    try:
+        for name, function, repeat, unit in cases:
+            if only is not None and name not in only:
+                continue
+            report = run_benchmark(name, function, repeat, unit)
+            reports.append(report)
+            print('{name:<22} p50 {p50_ms:9.3f} ms  p95 {p95_ms:9.3f} ms  '
+                  '{throughput:12.0f} {unit}/s  peak {peak_memory_mb:7.1f} MB'.format(**report),
+                  file=sys.stderr)
+    finally:
+        close()
+
+    result = {'date':datetime.datetime.now().isoformat(timespec='seconds'),
+              'python':platform.python_version(),
+              'platform':platform.platform(),
+              'rows':args.rows,
+              'latency':latency._asdict(),
+              'benchmarks':reports}
+
+    regressed = False
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        result['comparison'] = compare(reports, baseline, args.tolerance)
+        regressed = any(item['regressed'] for item in result['comparison'].values())
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    print(json.dumps(result, indent=2))
+    if regressed:
+        sys.exit(1)
+
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory snapshot of the server file catalog (sys.master_files joined to
+sys.databases). Lookups by physical file path or database name are
+dictionary lookups instead of a catalog query and a scan per call
+
+@author: vorst
+"""
+
+# Python imports
+import os
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+def normalize_path(path):
+    """Normalize a path for comparison (see SQLBase.path_equal)"""
+    return os.path.normpath(os.path.normcase(str(path)))
+
+
+class ServerCatalog:
+
+    def __init__(self, load, ttl=60):
+        """Cache of which database owns each physical file on the server
+        inputs
+        -------
+        load : (callable) called with no arguments, returns an iterable of
+            rows with attributes physical_name and database_name
+        ttl : (float) seconds before the snapshot is reloaded on the next
+            lookup. None keeps the snapshot until invalidate() is called"""
+        self._load = load
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        # {normalized physical path : database name}
+        self._paths = {}
+        # {database name : set of normalized physical paths}
+        self._databases = {}
+        self.loads = 0
+
+        return None
+
+
+    def _ensure_loaded(self, refresh=False):
+        """Reload the snapshot if it was never loaded, has expired or
+        refresh is True. Call with the lock held"""
+        expired = (self._loaded_at is None or
+                   (self.ttl is not None and time.monotonic() - self._loaded_at >= self.ttl))
+        if not (refresh or expired):
+            return None
+
+        paths = {}
+        databases = {}
+        for row in self._load():
+            path = normalize_path(row.physical_name)
+            paths[path] = row.database_name
+            databases.setdefault(row.database_name, set()).add(path)
+
+        self._paths = paths
+        self._databases = databases
+        self._loaded_at = time.monotonic()
+        self.loads += 1
+        logger.debug('Loaded server catalog : {} databases'.format(len(databases)))
+
+        return None
+
+
+    def database_for_path(self, path, refresh=False):
+        """Return the name of the database using physical file path, or None
+        inputs
+        -------
+        path : (str) path to a .mdf or .ldf file
+        refresh : (bool) reload the snapshot first"""
+        with self._lock:
+            self._ensure_loaded(refresh)
+            return self._paths.get(normalize_path(path))
+
+
+    def has_database(self, database_name, refresh=False):
+        """True if database_name is attached to the server"""
+        with self._lock:
+            self._ensure_loaded(refresh)
+            return database_name in self._databases
+
+
+    def database_names(self, refresh=False):
+        """Return a list of all database names on the server"""
+        with self._lock:
+            self._ensure_loaded(refresh)
+            return list(self._databases)
+
+
+    def add_database(self, database_name, paths):
+        """Record that database_name was attached using physical files paths.
+        Does nothing if the snapshot is not loaded"""
+        with self._lock:
+            if self._loaded_at is None:
+                return None
+            for path in paths:
+                path = normalize_path(path)
+                self._paths[path] = database_name
+                self._databases.setdefault(database_name, set()).add(path)
+
+        return None
+
+
+    def remove_database(self, database_name):
+        """Record that database_name was detached"""
+        with self._lock:
+            for path in self._databases.pop(database_name, ()):
+                if self._paths.get(path) == database_name:
+                    del self._paths[path]
+
+        return None
+
+
+    def invalidate(self):
+        """Discard the snapshot. The next lookup reloads it"""
+        with self._lock:
+            self._loaded_at = None
+            self._paths = {}
+            self._databases = {}
+
+        return None
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Server catalog snapshot tests. The catalog is loaded from a list of rows so
+these do not need a SQL Server instance
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+from collections import namedtuple
+
+# local imports
+from sql_tools.catalog import ServerCatalog
+
+# Globals
+Row = namedtuple('Row', ['logical_name', 'physical_name', 'database_name'])
+rows = [Row('master', 'master.mdf', 'master'),
+        Row('JobDB_dat', 'jobs/JHW/JobDB.mdf', 'JHW'),
+        Row('JobDB_log', 'jobs/JHW/JobDB_Log.ldf', 'JHW')]
+
+#%%
+
+class ServerCatalogTest(unittest.TestCase):
+
+    def test_lookup(self):
+
+        catalog = ServerCatalog(lambda: rows)
+
+        self.assertEqual(catalog.database_for_path('jobs/JHW/../JHW/JobDB.mdf'), 'JHW')
+        self.assertIsNone(catalog.database_for_path('jobs/MDT/JobDB.mdf'))
+        self.assertTrue(catalog.has_database('master'))
+        self.assertEqual(catalog.loads, 1)
+        return None
+
+
+    def test_add_remove_database(self):
+
+        catalog = ServerCatalog(lambda: rows)
+        catalog.add_database('MDT', ['jobs/MDT/JobDB.mdf'])
+        # Not loaded yet, so the add is ignored and picked up by the load
+        self.assertFalse(catalog.has_database('MDT'))
+
+        catalog.add_database('MDT', ['jobs/MDT/JobDB.mdf'])
+        self.assertEqual(catalog.database_for_path('jobs/MDT/JobDB.mdf'), 'MDT')
+
+        catalog.remove_database('JHW')
+        self.assertFalse(catalog.has_database('JHW'))
+        self.assertIsNone(catalog.database_for_path('jobs/JHW/JobDB.mdf'))
+        self.assertEqual(catalog.loads, 1)
+        return None
+
+
+    def test_ttl_and_invalidate(self):
+
+        catalog = ServerCatalog(lambda: rows, ttl=0)
+        catalog.has_database('JHW')
+        catalog.has_database('JHW')
+        self.assertEqual(catalog.loads, 2)
+
+        catalog = ServerCatalog(lambda: rows, ttl=None)
+        catalog.has_database('JHW')
+        catalog.invalidate()
+        catalog.has_database('JHW')
+        self.assertEqual(catalog.loads, 2)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
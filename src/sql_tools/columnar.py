@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar fetch path. Each cursor.fetchmany batch is transposed and
+converted to one typed NumPy array per column (dtype chosen from
+cursor.description), and the per-batch arrays are concatenated once at the
+end, instead of building a DataFrame from a list of row tuples. This lowers
+peak memory rather than fetch time, since only one batch of rows is alive at
+a time. Missing values are tracked with a mask so integer and boolean
+columns keep their type. Results can be returned as NumPy arrays, a pandas
+DataFrame with nullable dtypes, or a pyarrow Table
+
+@author: vorst
+"""
+
+# Python imports
+import datetime
+import decimal
+
+# Third party imports
+import numpy as np
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+# Column kinds and the NumPy dtype of their value buffer
+_DTYPES = {'int':np.dtype('int64'),
+           'float':np.dtype('float64'),
+           'bool':np.dtype('bool'),
+           'datetime':np.dtype('datetime64[us]'),
+           'object':np.dtype('object')}
+
+
+def column_kind(type_code, sample=None):
+    """Map a cursor.description type_code (pyodbc reports Python types) to a
+    column kind : 'int', 'float', 'bool', 'datetime' or 'object'. If the
+    driver does not report a type (sqlite3), the type of sample is used
+    inputs
+    -------
+    type_code : (type) cursor.description[i][1]
+    sample : first non-null value of the column, used when type_code is None
+    outputs
+    -------
+    kind : (str)"""
+    if type_code is None and sample is not None:
+        type_code = type(sample)
+
+    if type_code is bool:
+        return 'bool'
+    if isinstance(type_code, type) and issubclass(type_code, int) and type_code is not bool:
+        return 'int'
+    if type_code in (float, decimal.Decimal):
+        # Decimal is converted to float, like pandas.read_sql(coerce_float=True)
+        return 'float'
+    if type_code is datetime.datetime:
+        return 'datetime'
+
+    return 'object'
+
+
+def values_kind(values):
+    """Column kind of a batch of values, for drivers which do not report
+    column types. Integers mixed with floats (or Decimal) are 'float', any
+    other mix is 'object'. None if every value is None"""
+    types = set(map(type, values))
+    types.discard(type(None))
+    if not types:
+        return None
+    kinds = {column_kind(type_code) for type_code in types}
+    if len(kinds) == 1:
+        return kinds.pop()
+    if kinds == {'int', 'float'}:
+        return 'float'
+    return 'object'
+
+
+def widen_kind(kind, other):
+    """Kind able to hold the values of both kinds"""
+    if other is None or kind == other:
+        return kind
+    if kind is None:
+        return other
+    if {kind, other} == {'int', 'float'}:
+        return 'float'
+    return 'object'
+
+
+class ColumnBuffer:
+
+    def __init__(self, name, kind):
+        """Typed value chunks and null masks for one result column. Each
+        fetchmany batch is converted to one array of the column dtype; the
+        chunks are concatenated once when the result is complete"""
+        self.name = name
+        self.kind = kind
+        self.dtype = _DTYPES[kind]
+        self._values = []
+        self._masks = []
+        self.has_nulls = False
+
+        return None
+
+
+    def extend(self, column):
+        """Append a tuple of column values (one batch)"""
+        mask = None
+
+        if self.kind == 'object':
+            values = np.empty(len(column), dtype=object)
+            values[:] = column
+        elif self.kind in ('float', 'datetime'):
+            # NumPy converts None to NaN / NaT, so no mask is needed
+            values = np.array(column, dtype=self.dtype)
+        elif None in column:
+            # int and bool have no missing value marker : keep a mask
+            values = np.array(column, dtype=object)
+            mask = np.equal(values, None)
+            values[mask] = 0
+            values = values.astype(self.dtype)
+            self.has_nulls = True
+        else:
+            values = np.array(column, dtype=self.dtype)
+
+        self._values.append(values)
+        self._masks.append(mask)
+
+        return None
+
+
+    def widen(self, kind):
+        """Convert the values collected so far to kind, when a later batch
+        of a column without a reported type holds wider values (like a float
+        after integers). Masked nulls become NaN (float) or None (object)"""
+        dtype = _DTYPES[kind]
+        values = []
+        for chunk, chunk_mask in zip(self._values, self._masks):
+            chunk = chunk.astype(dtype)
+            if chunk_mask is not None:
+                chunk[chunk_mask] = np.nan if kind == 'float' else None
+            values.append(chunk)
+        self._values = values
+        self._masks = [None] * len(values)
+        self.kind = kind
+        self.dtype = dtype
+        self.has_nulls = False
+
+        return None
+
+
+    def _finish(self):
+        """Concatenate the batch chunks into one value array and one mask"""
+        if len(self._values) == 1 and self._masks[0] is not None:
+            return None
+
+        if not self._values:
+            values = np.empty(0, dtype=self.dtype)
+        else:
+            values = np.concatenate(self._values)
+        mask = np.zeros(len(values), dtype=bool)
+        start = 0
+        for chunk, chunk_mask in zip(self._values, self._masks):
+            if chunk_mask is not None:
+                mask[start:start + len(chunk)] = chunk_mask
+            start += len(chunk)
+
+        self._values = [values]
+        self._masks = [mask]
+
+        return None
+
+
+    @property
+    def values(self):
+        self._finish()
+        return self._values[0]
+
+
+    @property
+    def mask(self):
+        self._finish()
+        return self._masks[0]
+
+
+    def to_numpy(self):
+        """Return the values as a NumPy array, or a masked array for integer
+        and boolean columns which contain nulls"""
+        if self.has_nulls:
+            return np.ma.MaskedArray(self.values, mask=self.mask)
+        return self.values
+
+
+    def to_pandas(self):
+        """Return the values as a pandas array. Integer and boolean columns
+        with nulls use the nullable Int64 / boolean extension types"""
+        import pandas as pd
+        if self.has_nulls and self.kind == 'int':
+            return pd.arrays.IntegerArray(self.values, self.mask)
+        if self.has_nulls and self.kind == 'bool':
+            return pd.arrays.BooleanArray(self.values, self.mask)
+        return self.values
+
+
+    def to_arrow(self):
+        """Return the values as a pyarrow Array"""
+        pa = _import_pyarrow()
+        if self.has_nulls:
+            return pa.array(self.values, mask=self.mask)
+        # None, NaN and NaT become nulls
+        return pa.array(self.values, from_pandas=True)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError('output="arrow" requires pyarrow. Try pip install pyarrow') from e
+    return pyarrow
+
+
+def iter_column_batches(cursor, arraysize=10000):
+    """Yield (columns, kinds, batch) for each fetchmany batch, where batch is
+    a list of per-column tuples. Kinds are decided from cursor.description.
+    When the driver reports no type for a column (sqlite3) its kind is
+    inferred from the values and widened by later batches, so a float after
+    integers turns the column into 'float' (see widen_kind)
+    inputs
+    -------
+    cursor : executed DB-API cursor
+    arraysize : (int) rows fetched per round trip"""
+    columns = [column[0] for column in cursor.description]
+    type_codes = [column[1] for column in cursor.description]
+    kinds = None
+
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        # Transpose the batch in C : one tuple per column
+        batch = list(zip(*rows))
+        del rows
+        if kinds is None:
+            kinds = [column_kind(type_code) if type_code is not None else None
+                     for type_code in type_codes]
+        kinds = [widen_kind(kind, values_kind(values)) if type_code is None else kind
+                 for kind, type_code, values in zip(kinds, type_codes, batch)]
+        # A column with only nulls so far is collected as 'object'
+        yield columns, [kind or 'object' for kind in kinds], batch
+
+    return None
+
+
+def fetch_columnar(cursor, arraysize=10000, output='pandas'):
+    """Fetch the remaining result of an executed cursor into typed column
+    buffers
+    inputs
+    -------
+    cursor : executed DB-API cursor
+    arraysize : (int) rows fetched per round trip
+    output : (str) 'numpy' for a dict of {column : numpy.ndarray} (masked
+        arrays for integer / boolean columns with nulls), 'pandas' for a
+        DataFrame or 'arrow' for a pyarrow.Table
+    outputs
+    -------
+    result : (dict, pandas.DataFrame or pyarrow.Table)"""
+
+    if output not in ('numpy', 'pandas', 'arrow'):
+        raise ValueError('output must be numpy, pandas or arrow, got {}'.format(output))
+    if cursor.description is None:
+        raise ValueError('The statement did not return a result set')
+
+    columns = [column[0] for column in cursor.description]
+    buffers = None
+
+    for _columns, kinds, batch in iter_column_batches(cursor, arraysize):
+        if buffers is None:
+            buffers = [ColumnBuffer(name, kind) for name, kind in zip(columns, kinds)]
+        for buffer, kind, values in zip(buffers, kinds, batch):
+            kind = widen_kind(buffer.kind, kind)
+            if kind != buffer.kind:
+                buffer.widen(kind)
+            buffer.extend(values)
+
+    if buffers is None:
+        # Empty result
+        kinds = [column_kind(column[1]) for column in cursor.description]
+        buffers = [ColumnBuffer(name, kind) for name, kind in zip(columns, kinds)]
+
+    if output == 'numpy':
+        return {buffer.name:buffer.to_numpy() for buffer in buffers}
+
+    if output == 'arrow':
+        pa = _import_pyarrow()
+        return pa.Table.from_arrays([buffer.to_arrow() for buffer in buffers],
+                                    names=columns)
+
+    import pandas as pd
+    # Key by position so duplicate column names survive
+    df = pd.DataFrame({i:buffer.to_pandas() for i, buffer in enumerate(buffers)},
+                      copy=False)
+    df.columns = columns
+    return df
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar fetch tests. An in-memory sqlite3 database stands in for SQL Server
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+import sqlite3
+
+# Third party imports
+import numpy as np
+
+# local imports
+from sql_tools.columnar import fetch_columnar, column_kind, values_kind
+
+#%%
+
+def _cursor(arraysize=2):
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE POINTBAS (ID INTEGER, VALUE REAL, NAME TEXT, NETDEVID INTEGER)')
+    connection.executemany('INSERT INTO POINTBAS VALUES (?, ?, ?, ?)',
+                           [(i, None if i == 2 else i / 2, 'JHW.AHU{}'.format(i),
+                             None if i % 2 else i) for i in range(5)])
+    cursor = connection.cursor()
+    cursor.execute('SELECT * FROM POINTBAS')
+    return cursor
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def test_column_kind(self):
+
+        self.assertEqual(column_kind(int), 'int')
+        self.assertEqual(column_kind(bool), 'bool')
+        self.assertEqual(column_kind(None, 1.5), 'float')
+        self.assertEqual(column_kind(str), 'object')
+        self.assertEqual(values_kind((1, None, 2.5)), 'float')
+        self.assertEqual(values_kind((1, 'JHW')), 'object')
+        self.assertIsNone(values_kind((None, None)))
+        return None
+
+
+    def test_widen_untyped_column(self):
+
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE POINTBAS (ID INTEGER, VALUE, FLAG)')
+        connection.executemany('INSERT INTO POINTBAS VALUES (?, ?, ?)',
+                               [(0, 1, None), (1, None, None), (2, 2.5, 3), (3, 4, 'JHW')])
+        cursor = connection.execute('SELECT * FROM POINTBAS ORDER BY ID')
+
+        # VALUE is inferred int from the first batch, then widened to float
+        df = fetch_columnar(cursor, arraysize=2)
+        self.assertEqual(str(df['VALUE'].dtype), 'float64')
+        self.assertEqual(df['VALUE'].tolist()[0], 1.0)
+        self.assertTrue(np.isnan(df['VALUE'].iloc[1]))
+        self.assertEqual(df['VALUE'].tolist()[2:], [2.5, 4.0])
+        self.assertEqual(df['FLAG'].tolist()[2:], [3, 'JHW'])
+        self.assertEqual(str(df['ID'].dtype), 'int64')
+
+        cursor = connection.execute('SELECT * FROM POINTBAS ORDER BY ID')
+        arrays = fetch_columnar(cursor, arraysize=3, output='numpy')
+        self.assertEqual(arrays['FLAG'].dtype, object)
+        self.assertEqual(arrays['FLAG'].tolist(), [None, None, 3, 'JHW'])
+        return None
+
+
+    def test_pandas_output(self):
+
+        df = fetch_columnar(_cursor(), arraysize=2)
+
+        self.assertEqual(list(df.columns), ['ID', 'VALUE', 'NAME', 'NETDEVID'])
+        self.assertEqual(str(df['ID'].dtype), 'int64')
+        self.assertEqual(str(df['NETDEVID'].dtype), 'Int64')
+        self.assertTrue(df['VALUE'].isna().iloc[2])
+        self.assertEqual(df['NETDEVID'].isna().sum(), 2)
+        self.assertEqual(df['NAME'].iloc[4], 'JHW.AHU4')
+        return None
+
+
+    def test_numpy_output(self):
+
+        arrays = fetch_columnar(_cursor(), arraysize=3, output='numpy')
+
+        self.assertEqual(arrays['ID'].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(arrays['NETDEVID'].mask.tolist(), [False, True, False, True, False])
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
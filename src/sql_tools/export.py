@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Stream query results to Parquet or CSV files with bounded memory. Batches
+are fetched from the cursor and written straight to a Parquet row group or a
+buffered CSV writer, so at most one batch is held in memory. The exception is
+a column with no type reported by the driver and only NULLs so far : Parquet
+batches are held back (up to SCHEMA_MAX_ROWS rows) until its type is known
+
+@author: vorst
+"""
+
+# Python imports
+import csv
+import io
+import os
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+FORMATS = ('parquet', 'csv')
+CSV_COMPRESSIONS = {None:'', 'gzip':'.gz', 'bz2':'.bz2', 'xz':'.xz'}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if it cannot
+    be measured on this platform"""
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    import sys
+    if sys.platform == 'darwin':
+        return peak / 2**20
+    return peak / 2**10
+
+
+def _open_csv(path, compression):
+    """Open path for text writing, compressed if compression is given"""
+    if compression is None:
+        return open(path, mode='w', newline='', encoding='utf-8', buffering=2**20)
+    if compression == 'gzip':
+        import gzip
+        raw = gzip.open(path, mode='wb')
+    elif compression == 'bz2':
+        import bz2
+        raw = bz2.open(path, mode='wb')
+    elif compression == 'xz':
+        import lzma
+        raw = lzma.open(path, mode='wb')
+    else:
+        raise ValueError('compression must be one of {}, got {}'.format(
+            list(CSV_COMPRESSIONS), compression))
+    return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size=2**20),
+                            encoding='utf-8',
+                            newline='')
+
+
+def _write_csv(cursor, path, chunk_rows, compression):
+    columns = [column[0] for column in cursor.description]
+    n_rows = 0
+    with _open_csv(path, compression) as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            writer.writerows(rows)
+            n_rows += len(rows)
+
+    return n_rows
+
+
+def _import_parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('format="parquet" requires pyarrow. Try pip install pyarrow') from e
+    return pyarrow, pyarrow.parquet
+
+
+# Rows held back while a column without a reported type has only NULLs, so
+# its Parquet type can come from a later batch
+SCHEMA_MAX_ROWS = 500000
+
+
+def _arrow_type(pa, type_code, kind, arrays):
+    """Arrow type of a column from its cursor.description type_code, falling
+    back to the type inferred from the batches seen so far. Returns None if
+    no type was reported and every value so far is NULL"""
+    if kind == 'int':
+        return pa.int64()
+    if kind == 'float':
+        return pa.float64()
+    if kind == 'bool':
+        return pa.bool_()
+    if kind == 'datetime':
+        return pa.timestamp('us')
+    if type_code is str:
+        return pa.string()
+    if type_code in (bytes, bytearray):
+        return pa.binary()
+    for array in arrays:
+        if not pa.types.is_null(array.type):
+            return array.type
+    return None
+
+
+def _write_parquet(cursor, path, chunk_rows, compression):
+    from .columnar import ColumnBuffer, column_kind, iter_column_batches
+    pa, pq = _import_parquet()
+
+    columns = [column[0] for column in cursor.description]
+    type_codes = [column[1] for column in cursor.description]
+    writer = None
+    schema = None
+    # Batches held until every column has a type
+    pending = []
+    pending_rows = 0
+    n_rows = 0
+
+    def infer_schema(kinds, final):
+        types = [_arrow_type(pa, type_code, kind, [arrays[i] for arrays in pending])
+                 for i, (type_code, kind) in enumerate(zip(type_codes, kinds))]
+        if None in types and not final:
+            return None
+        # Only NULLs and no type reported
+        return pa.schema([pa.field(name, pa.string() if type_ is None else type_)
+                          for name, type_ in zip(columns, types)])
+
+    def write(arrays):
+        arrays = [array.cast(field.type) if array.type != field.type else array
+                  for array, field in zip(arrays, schema)]
+        # One row group per batch
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        return None
+
+    try:
+        kinds = [column_kind(type_code) for type_code in type_codes]
+        for _columns, kinds, batch in iter_column_batches(cursor, chunk_rows):
+            arrays = []
+            for name, kind, values in zip(columns, kinds, batch):
+                buffer = ColumnBuffer(name, kind)
+                buffer.extend(values)
+                arrays.append(buffer.to_arrow())
+            n_rows += len(batch[0])
+
+            if writer is not None:
+                write(arrays)
+                continue
+
+            pending.append(arrays)
+            pending_rows += len(batch[0])
+            schema = infer_schema(kinds, final=pending_rows >= SCHEMA_MAX_ROWS)
+            if schema is None:
+                continue
+            writer = pq.ParquetWriter(path, schema, compression=compression or 'snappy')
+            for arrays in pending:
+                write(arrays)
+            pending = []
+
+        if writer is None:
+            # Empty result, or NULL columns to the end : the schema from the
+            # reported types and the rows held back
+            schema = infer_schema(kinds, final=True)
+            writer = pq.ParquetWriter(path, schema, compression=compression or 'snappy')
+            for arrays in pending:
+                write(arrays)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
+
+
+def export_cursor(cursor, path, format='parquet', chunk_rows=50000, compression=None):
+    """Write the result of an executed cursor to path
+    inputs
+    -------
+    cursor : executed DB-API cursor
+    path : (str or Path) output file
+    format : (str) 'parquet' or 'csv'
+    chunk_rows : (int) rows fetched and written per batch. This bounds
+        memory use (see SCHEMA_MAX_ROWS), and each batch is one Parquet row
+        group
+    compression : (str) Parquet codec ('snappy' default, 'gzip', 'zstd',
+        'none') or CSV compression (None, 'gzip', 'bz2', 'xz')
+    outputs
+    -------
+    report : (dict) with keys 'path', 'rows', 'bytes', 'seconds',
+        'rows_per_sec' and 'peak_rss_mb'"""
+
+    if format not in FORMATS:
+        raise ValueError('format must be one of {}, got {}'.format(FORMATS, format))
+    if cursor.description is None:
+        raise ValueError('The statement did not return a result set')
+
+    start = time.perf_counter()
+    if format == 'csv':
+        n_rows = _write_csv(cursor, path, chunk_rows, compression)
+    else:
+        n_rows = _write_parquet(cursor, path, chunk_rows, compression)
+    seconds = time.perf_counter() - start
+
+    report = {'path':str(path),
+              'rows':n_rows,
+              'bytes':os.path.getsize(path),
+              'seconds':seconds,
+              'rows_per_sec':n_rows / seconds if seconds > 0 else float('inf'),
+              'peak_rss_mb':peak_rss_mb()}
+    logger.info('Exported {} rows to {} : {:.0f} rows/sec'.format(
+        n_rows, path, report['rows_per_sec']))
+
+    return report
+
+
+def export_file_name(schema, table, format='parquet', compression=None):
+    """File name for an exported table, like 'dbo.POINTBAS.parquet'"""
+    name = '{}.{}.{}'.format(schema, table, format)
+    if format == 'csv':
+        name += CSV_COMPRESSIONS.get(compression, '')
+    # Remove characters which are not allowed in Windows file names
+    return ''.join('_' if char in '<>:"/\\|?*' else char for char in name)
+
+
+def export_database(sqlbase,
+                    directory,
+                    database_name=None,
+                    tables=None,
+                    format='parquet',
+                    chunk_rows=50000,
+                    compression=None,
+                    max_workers=4):
+    """Export every table of a database to one file per table in directory.
+    Tables are exported in parallel, each worker streaming one table over its
+    own pooled connection. A failure on one table is reported in its result
+    and does not stop the export
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    directory : (str or Path) output directory, created if missing
+    database_name : (str) database to export. Defaults to the database set
+        by init_database_connection
+    tables : (iterable) of (schema, table) tuples. Defaults to every base
+        table of the database
+    format, chunk_rows, compression : see export_cursor
+    max_workers : (int) number of tables exported at once. Limited to the
+        pool size of sqlbase so workers never wait for a connection
+    outputs
+    -------
+    reports : (dict) of {'schema.table' : report}. See export_cursor for the
+        report keys; failed tables have a report with only 'error'"""
+    from concurrent.futures import ThreadPoolExecutor
+    from .sql_tools import quote_identifier
+
+    os.makedirs(directory, exist_ok=True)
+    if tables is None:
+        tables = sorted((table.schema, table.name) for table in
+                        sqlbase.get_tables(database_name))
+    tables = [(schema, table) for schema, table in tables]
+    max_workers = max(1, min(max_workers, sqlbase.pool_size, len(tables) or 1))
+
+    def run(schema_table):
+        schema, table = schema_table
+        sql = 'SELECT * FROM {}.{}'.format(quote_identifier(schema), quote_identifier(table))
+        path = os.path.join(directory, export_file_name(schema, table, format, compression))
+        try:
+            return sqlbase.export_query(sql,
+                                        path,
+                                        format=format,
+                                        chunk_rows=chunk_rows,
+                                        compression=compression,
+                                        database_name=database_name)
+        except Exception as e:
+            logger.info('Export of {}.{} failed : {}'.format(schema, table, e))
+            return {'error':e}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='sql_tools_export') as executor:
+        results = list(executor.map(run, tables))
+    seconds = time.perf_counter() - start
+
+    reports = {'{}.{}'.format(schema, table):report
+               for (schema, table), report in zip(tables, results)}
+    n_rows = sum(report.get('rows', 0) for report in results)
+    logger.info('Exported {} tables, {} rows in {:.1f}s ({:.0f} rows/sec), peak RSS {} MB'.format(
+        len(tables), n_rows, seconds, n_rows / seconds if seconds > 0 else 0, peak_rss_mb()))
+
+    return reports
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Export tests. An in-memory sqlite3 database stands in for SQL Server
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+from unittest import mock
+import sqlite3
+import tempfile
+import gzip
+import csv
+import os
+
+# local imports
+from sql_tools.export import export_cursor, export_file_name
+
+#%%
+
+def _cursor():
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE POINTBAS (ID INTEGER, VALUE REAL, NAME TEXT, NETDEVID INTEGER)')
+    connection.executemany('INSERT INTO POINTBAS VALUES (?, ?, ?, ?)',
+                           [(i, i / 2, 'JHW.AHU{}'.format(i),
+                             None if i % 2 else i) for i in range(25)])
+    cursor = connection.cursor()
+    cursor.execute('SELECT * FROM POINTBAS')
+    return cursor
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        return None
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+        return None
+
+
+    def test_csv(self):
+
+        path = os.path.join(self.directory.name, 'POINTBAS.csv.gz')
+        report = export_cursor(_cursor(), path, format='csv', chunk_rows=10, compression='gzip')
+
+        with gzip.open(path, mode='rt', newline='') as file:
+            rows = list(csv.reader(file))
+        self.assertEqual(rows[0], ['ID', 'VALUE', 'NAME', 'NETDEVID'])
+        self.assertEqual(len(rows), 26)
+        self.assertEqual(rows[2], ['1', '0.5', 'JHW.AHU1', ''])
+        self.assertEqual(report['rows'], 25)
+        self.assertEqual(report['bytes'], os.path.getsize(path))
+        return None
+
+
+    def test_parquet(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+
+        path = os.path.join(self.directory.name, 'POINTBAS.parquet')
+        report = export_cursor(_cursor(), path, chunk_rows=10)
+
+        parquet_file = pq.ParquetFile(path)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        table = parquet_file.read()
+        self.assertEqual(str(table.schema.field('NETDEVID').type), 'int64')
+        self.assertEqual(table.column('NETDEVID').null_count, 12)
+        self.assertEqual(report['rows'], 25)
+        return None
+
+
+    def test_parquet_null_first_batch(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        from sql_tools import export
+
+        # Columns without a declared type report no type code, and are
+        # NULL for the whole first batch
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE POINTBAS (ID, VALUE, NAME, UPDATED)')
+        connection.executemany('INSERT INTO POINTBAS VALUES (?, ?, ?, ?)',
+                               [(i,
+                                 None if i < 15 else i / 2,
+                                 None if i < 15 else 'JHW.AHU{}'.format(i),
+                                 None) for i in range(25)])
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM POINTBAS')
+        path = os.path.join(self.directory.name, 'POINTBAS.parquet')
+        report = export_cursor(cursor, path, chunk_rows=10)
+
+        parquet_file = pq.ParquetFile(path)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        table = parquet_file.read()
+        self.assertEqual(str(table.schema.field('VALUE').type), 'double')
+        self.assertEqual(str(table.schema.field('NAME').type), 'string')
+        self.assertEqual(table.column('VALUE').to_pylist()[14:17], [None, 7.5, 8.0])
+        # NULL to the end
+        self.assertEqual(str(table.schema.field('UPDATED').type), 'string')
+        self.assertEqual(report['rows'], 25)
+
+        # Past SCHEMA_MAX_ROWS the unknown type is written as string
+        cursor.execute('SELECT * FROM POINTBAS')
+        with mock.patch.object(export, 'SCHEMA_MAX_ROWS', 10):
+            export_cursor(cursor, path, chunk_rows=10)
+        self.assertEqual(str(pq.read_schema(path).field('VALUE').type), 'string')
+        connection.close()
+        return None
+
+
+    def test_file_name(self):
+
+        self.assertEqual(export_file_name('dbo', 'POINTBAS'), 'dbo.POINTBAS.parquet')
+        self.assertEqual(export_file_name('dbo', 'A/B', 'csv', 'gzip'), 'dbo.A_B.csv.gz')
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Run one query over many databases concurrently. Each database query borrows
+a connection from that database's pool, at most max_workers queries run at
+once, and every result is tagged with its source database. Results are
+streamed as they complete or merged into one DataFrame, with the latency and
+error of each database reported
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+FanoutResult = namedtuple('FanoutResult',
+                          ['database_name',
+                           'result',
+                           'error',
+                           'seconds',
+                           'rows'])
+FanoutResult.__doc__ = """Outcome of the query on one database. result is a
+DataFrame with the source column or a list of rows prefixed with the database
+name (None in the report of a merged fan out). error is None on success,
+otherwise the exception raised and rows is None"""
+
+OUTPUTS = ('pandas', 'rows')
+
+
+def _unique(database_names):
+    return list(dict.fromkeys(database_names))
+
+
+def iter_fan_out(sqlbase,
+                 sql_query,
+                 database_names,
+                 params=None,
+                 output='pandas',
+                 max_workers=8,
+                 source_column='database_name',
+                 use_cache=True):
+    """Yield a FanoutResult per database in completion order. At most
+    max_workers queries are in flight, so completed results do not pile up
+    when the consumer is slower than the queries
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    sql_query : (str) sql string to execute on every database
+    database_names : (iterable) of (str) databases to query
+    params : (sequence) parameter values for the ? markers in sql_query
+    output : (str) 'pandas' for a DataFrame per database with a
+        source_column, or 'rows' for lists of tuples (database_name, *row)
+    max_workers : (int) number of databases queried at once
+    source_column : (str) name of the source database column (pandas)
+    use_cache : (bool) use the query cache if it is enabled
+    outputs
+    -------
+    results : (generator) of (FanoutResult)
+    raises
+    -------
+    ValueError : if a pandas result already has a column named
+        source_column"""
+
+    if output not in OUTPUTS:
+        raise ValueError('output must be one of {}, got {}'.format(OUTPUTS, output))
+    database_names = _unique(database_names)
+
+    if output == 'pandas':
+        import numpy as np
+        import pandas as pd
+
+    def run(index, database_name):
+        start = time.perf_counter()
+        try:
+            if output == 'pandas':
+                result = sqlbase.pandas_execute_sql(sql_query,
+                                                    params=params,
+                                                    database_name=database_name,
+                                                    use_cache=use_cache)
+            else:
+                rows = sqlbase.execute_sql(sql_query,
+                                           params=params,
+                                           database_name=database_name,
+                                           use_cache=use_cache)
+                result = [(database_name,) + tuple(row) for row in rows]
+        except Exception as e:
+            logger.info('Query on {} failed : {}'.format(database_name, e))
+            return FanoutResult(database_name, None, e, time.perf_counter() - start, None)
+
+        if output == 'pandas':
+            # Raised to the caller : every database would fail the same way
+            if source_column in result.columns:
+                msg = ('The query result already has a column {!r}. Pass another '
+                       'source_column')
+                raise ValueError(msg.format(source_column))
+            # Categorical with all databases as categories, so frames
+            # concatenate without converting the tag to object
+            codes = np.full(len(result), index, dtype=np.int32)
+            result.insert(0,
+                          source_column,
+                          pd.Categorical.from_codes(codes, categories=database_names))
+
+        return FanoutResult(database_name, result, None, time.perf_counter() - start, len(result))
+
+    pending = set()
+    names = iter(enumerate(database_names))
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='sql_tools_fanout') as executor:
+        try:
+            while True:
+                while len(pending) < max_workers:
+                    item = next(names, None)
+                    if item is None:
+                        break
+                    pending.add(executor.submit(run, *item))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return None
+
+
+def fan_out(sqlbase,
+            sql_query,
+            database_names,
+            params=None,
+            output='pandas',
+            max_workers=8,
+            source_column='database_name',
+            use_cache=True):
+    """Run sql_query on every database and merge the results. See
+    iter_fan_out for the inputs
+    outputs
+    -------
+    merged : (pandas.DataFrame) with source_column first, or (list) of
+        tuples (database_name, *row), in the order of database_names
+    report : (list) of (FanoutResult) in the order of database_names, with
+        result set to None"""
+
+    database_names = _unique(database_names)
+    start = time.perf_counter()
+    results = {result.database_name:result for result in
+               iter_fan_out(sqlbase,
+                            sql_query,
+                            database_names,
+                            params=params,
+                            output=output,
+                            max_workers=max_workers,
+                            source_column=source_column,
+                            use_cache=use_cache)}
+    ordered = [results[database_name] for database_name in database_names]
+    parts = [result.result for result in ordered if result.error is None]
+
+    if output == 'pandas':
+        import pandas as pd
+        if parts:
+            merged = pd.concat(parts, ignore_index=True)
+        else:
+            merged = pd.DataFrame({source_column:pd.Categorical([], categories=database_names)})
+    else:
+        merged = [row for part in parts for row in part]
+
+    report = [result._replace(result=None) for result in ordered]
+    n_failed = sum(1 for result in report if result.error is not None)
+    logger.info('Queried {} databases in {:.2f}s, {} failed'.format(
+        len(report), time.perf_counter() - start, n_failed))
+
+    return merged, report
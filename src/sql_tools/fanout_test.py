@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Fan out tests, run over SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+
+#%%
+
+class FanoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        for i, database_name in enumerate(['JobDB1', 'JobDB2', 'JobDB3']):
+            self.sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)',
+                                     database_name=database_name)
+            self.sqlbase.bulk_insert([(j, 'JHW.AHU{}'.format(j)) for j in range(i + 1)],
+                                     'POINTBAS',
+                                     columns=['ID', 'NAME'],
+                                     database_name=database_name)
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_merged_dataframe(self):
+
+        df, report = self.sqlbase.fan_out_sql('SELECT * FROM POINTBAS',
+                                              ['JobDB1', 'JobDB2', 'JobDB3', 'Missing'],
+                                              max_workers=2)
+
+        self.assertEqual(list(df.columns), ['database_name', 'ID', 'NAME'])
+        self.assertEqual(str(df['database_name'].dtype), 'category')
+        self.assertEqual(df['database_name'].value_counts()['JobDB3'], 3)
+        self.assertEqual([item.rows for item in report], [1, 2, 3, None])
+        self.assertIsNotNone(report[3].error)
+        return None
+
+
+    def test_source_column_clash(self):
+
+        sql = 'SELECT ID, NAME AS database_name FROM POINTBAS'
+        with self.assertRaises(ValueError) as context:
+            self.sqlbase.fan_out_sql(sql, ['JobDB1', 'JobDB2'])
+        self.assertIn("'database_name'", str(context.exception))
+
+        df, _report = self.sqlbase.fan_out_sql(sql, ['JobDB1', 'JobDB2'], source_column='source')
+        self.assertEqual(list(df.columns), ['source', 'ID', 'database_name'])
+        return None
+
+
+    def test_stream_rows(self):
+
+        results = list(self.sqlbase.iter_fan_out_sql('SELECT ID FROM POINTBAS WHERE ID = ?',
+                                                     ['JobDB1', 'JobDB3'],
+                                                     params=(0,),
+                                                     output='rows'))
+
+        self.assertEqual(sorted(row for result in results for row in result.result),
+                         [('JobDB1', 0), ('JobDB3', 0)])
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental extraction. A local state store (a SQLite file) records a
+change fingerprint per table and the size and modification time of each
+database file. On the next run unchanged database files are not attached,
+unchanged tables are not read, and tables with a high-water column
+(rowversion, or a column named by the caller) return only the rows added
+or changed since the previous run
+
+Fingerprints :
+high-water : MAX of a rowversion (or caller named, ever increasing) column.
+    Only rows above the previous mark are pulled. Deleted rows are not
+    detected
+checksum : COUNT_BIG(*) and CHECKSUM_AGG(BINARY_CHECKSUM(*)) computed on the
+    server, for all tables of a database in one round trip. A changed table
+    is pulled in full. BINARY_CHECKSUM skips text, ntext, image, xml and
+    sql_variant columns, and a checksum can collide, so a change which only
+    touches those columns (or collides) is missed. Other backends hash the
+    rows on the client, which reads the table
+file : size and modification time of the .mdf file. An unchanged file is
+    not attached at all
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+import datetime
+import decimal
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+from .catalog import normalize_path
+from .sql_tools import quote_identifier
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+FULL = 'full'
+INCREMENTAL = 'incremental'
+UNCHANGED = 'unchanged'
+
+TableExtract = namedtuple('TableExtract',
+                          ['source',
+                           'schema',
+                           'table',
+                           'mode',
+                           'data',
+                           'rows',
+                           'fingerprint',
+                           'high_water'])
+TableExtract.__doc__ = """Extraction of one table. mode is FULL (data holds
+every row), INCREMENTAL (data holds the rows above the previous high-water
+mark) or UNCHANGED (data is None). fingerprint is the checksum fingerprint
+and high_water the new high-water mark; either is None when not used"""
+
+OUTPUTS = ('pandas', 'rows')
+
+_ROWVERSION_TYPES = ('timestamp', 'rowversion')
+
+_state_sql = """CREATE TABLE IF NOT EXISTS table_state (
+    source TEXT NOT NULL,
+    schema_name TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    fingerprint TEXT,
+    high_water TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (source, schema_name, table_name));
+CREATE TABLE IF NOT EXISTS file_state (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    updated_at REAL NOT NULL);"""
+
+
+def encode_mark(value):
+    """Encode a high-water mark as JSON text [type, value]. rowversion
+    bytes are stored as hex and datetimes in ISO format, so the state file
+    holds plain data only"""
+    if hasattr(value, 'to_pydatetime'):
+        # pandas.Timestamp
+        value = value.to_pydatetime()
+    if isinstance(value, (bytes, bytearray)):
+        return json.dumps(['bytes', bytes(value).hex()])
+    if isinstance(value, datetime.datetime):
+        return json.dumps(['datetime', value.isoformat()])
+    if isinstance(value, datetime.date):
+        return json.dumps(['date', value.isoformat()])
+    if isinstance(value, decimal.Decimal):
+        return json.dumps(['decimal', str(value)])
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise TypeError('Cannot record a high-water mark of type {}'.format(type(value).__name__))
+    return json.dumps([type(value).__name__, value])
+
+
+_MARK_TYPES = {'bytes':bytes.fromhex,
+               'datetime':datetime.datetime.fromisoformat,
+               'date':datetime.date.fromisoformat,
+               'decimal':decimal.Decimal,
+               'int':int,
+               'float':float,
+               'str':str}
+
+
+def decode_mark(text):
+    """Inverse of encode_mark"""
+    kind, value = json.loads(text)
+    return _MARK_TYPES[kind](value)
+
+
+class StateStore:
+
+    def __init__(self, path):
+        """Fingerprints of previous runs, kept in a SQLite file
+        inputs
+        -------
+        path : (str) path of the state file, created if missing. ':memory:'
+            keeps the state for the life of this object only"""
+        self.path = str(path)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript(_state_sql)
+        self._lock = threading.Lock()
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        return False
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+        return None
+
+
+    def table_state(self, source):
+        """Return {(schema, table) : (fingerprint, high_water)} recorded for
+        source. A high-water mark which cannot be decoded is returned as
+        None, so its table is extracted in full"""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT schema_name, table_name, fingerprint, high_water '
+                'FROM table_state WHERE source = ?', (source,)).fetchall()
+
+        states = {}
+        for schema, table, fingerprint, high_water in rows:
+            mark = None
+            if high_water is not None:
+                try:
+                    mark = decode_mark(high_water)
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning('Ignoring high-water mark of {}.{} : {}'.format(schema, table, e))
+            states[(schema.lower(), table.lower())] = (fingerprint, mark)
+
+        return states
+
+
+    def save_table(self, extract):
+        """Record the fingerprint and high-water mark of a TableExtract"""
+        high_water = None if extract.high_water is None else encode_mark(extract.high_water)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO table_state VALUES (?, ?, ?, ?, ?, ?)',
+                (extract.source, extract.schema, extract.table,
+                 extract.fingerprint, high_water, time.time()))
+        return None
+
+
+    @staticmethod
+    def file_signature(path):
+        """(size, modification time in ns) of a file"""
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+
+    def file_changed(self, path):
+        """True if the file was never recorded or its size or modification
+        time differ from the recorded ones"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime_ns FROM file_state WHERE path = ?',
+                (normalize_path(path),)).fetchone()
+        return row is None or tuple(row) != self.file_signature(path)
+
+
+    def save_file(self, path, signature=None):
+        """Record the size and modification time of a file. signature
+        defaults to the current file_signature(path)"""
+        size, mtime_ns = self.file_signature(path) if signature is None else signature
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?)',
+                (normalize_path(path), size, mtime_ns, time.time()))
+        return None
+
+
+    def forget(self, source):
+        """Discard the table state of source, so its next extraction is full"""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM table_state WHERE source = ?', (source,))
+        return None
+
+
+def _qualified(table):
+    return '{}.{}'.format(quote_identifier(table.schema), quote_identifier(table.name))
+
+
+def _checksums(sqlbase, database_name, batch):
+    """Fingerprints of a batch of tables in one statement"""
+    sql = '\nUNION ALL\n'.join(
+        'SELECT {}, COUNT_BIG(*), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM {}'.format(
+            i, _qualified(table)) for i, table in enumerate(batch))
+    rows = sqlbase.execute_sql(sql, database_name=database_name, use_cache=False)
+    return {(batch[i].schema.lower(), batch[i].name.lower()):'{}:{}'.format(count, checksum)
+            for i, count, checksum in rows}
+
+
+def fingerprint_tables(sqlbase, database_name, tables, batch_size=100):
+    """Return {(schema, table) lower case : fingerprint (str)} for a list of
+    TableInfo. On SQL Server the fingerprints of batch_size tables are
+    computed in one statement. If that statement fails (one table can not
+    be read) the tables of the batch are fingerprinted one at a time, and a
+    table which still fails has no fingerprint"""
+    fingerprints = {}
+    if sqlbase.backend.is_sql_server:
+        for start in range(0, len(tables), batch_size):
+            batch = tables[start:start + batch_size]
+            try:
+                fingerprints.update(_checksums(sqlbase, database_name, batch))
+                continue
+            except Exception as e:
+                logger.info('Checksum of {} tables failed, retrying one at a time : {}'.format(
+                    len(batch), e))
+            for table in batch:
+                try:
+                    fingerprints.update(_checksums(sqlbase, database_name, [table]))
+                except Exception as e:
+                    logger.info('Checksum of {} failed : {}'.format(_qualified(table), e))
+    else:
+        import hashlib
+        for table in tables:
+            sql = 'SELECT * FROM {}'.format(_qualified(table))
+            if table.key_columns:
+                sql += ' ORDER BY ' + ', '.join(quote_identifier(key) for key in table.key_columns)
+            digest = hashlib.sha1()
+            count = 0
+            for rows in sqlbase.execute_sql_batches(sql, database_name=database_name):
+                for row in rows:
+                    digest.update(repr(tuple(row)).encode('utf-8'))
+                    count += 1
+            fingerprints[(table.schema.lower(), table.name.lower())] = '{}:{}'.format(count, digest.hexdigest())
+
+    return fingerprints
+
+
+def table_rowversion(table):
+    """Name of the rowversion column of a TableInfo, or None"""
+    for column in table.columns:
+        if column.type_name is not None and column.type_name.lower() in _ROWVERSION_TYPES:
+            return column.name
+    return None
+
+
+def _high_water_column(table, high_water_columns):
+    """Name of the high-water column of a TableInfo, or None"""
+    for name in ('{}.{}'.format(table.schema, table.name), table.name):
+        for key, column in high_water_columns.items():
+            if key.lower() == name.lower():
+                return column
+    return table_rowversion(table)
+
+
+def _column_max(data, column, output):
+    """Largest non NULL value of column. The column is matched case
+    insensitively, like SQL Server matches column names"""
+    names = list(data.columns)
+    if column not in names:
+        matches = [name for name in names if name.lower() == column.lower()]
+        if not matches:
+            raise KeyError(column)
+        column = matches[0]
+    if output == 'pandas':
+        values = data[column].dropna()
+        if not len(values):
+            return None
+        mark = values.max()
+        # numpy scalars cannot be bound as parameters
+        return mark.item() if hasattr(mark, 'item') else mark
+    position = data.index[column]
+    values = [row[position] for row in data if row[position] is not None]
+    return max(values) if values else None
+
+
+def extract_tables(sqlbase,
+                   state,
+                   on_table,
+                   database_name=None,
+                   source=None,
+                   tables=None,
+                   high_water_columns=None,
+                   output='pandas'):
+    """Extract the new and changed tables (or rows) of a database since the
+    previous run recorded in state. The state of a table is saved after
+    on_table returns for it, so a table whose on_table call failed is
+    extracted again on the next run
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    state : (StateStore)
+    on_table : (callable) called as on_table(extract) with a TableExtract
+        for each table, including unchanged ones. Store extract.data here
+    database_name : (str) database to extract. Defaults to the database set
+        by init_database_connection
+    source : (str) stable name of the data under which state is recorded,
+        like the .mdf path. Defaults to database_name
+    tables : (iterable) of (str) table names. Defaults to every table
+    high_water_columns : (dict) of {table name : column} for tables with an
+        ever increasing column (identity, modified date). rowversion columns
+        are used without being listed
+    output : (str) 'pandas' for DataFrames or 'rows' for Rows of tuples
+    outputs
+    -------
+    extracts : (list) of (TableExtract) with data set to None"""
+
+    if output not in OUTPUTS:
+        raise ValueError('output must be one of {}, got {}'.format(OUTPUTS, output))
+    database_name = sqlbase._resolve_database_name(database_name)
+    source = database_name if source is None else source
+    high_water_columns = high_water_columns or {}
+
+    if tables is None:
+        infos = sqlbase.get_tables(database_name)
+    else:
+        infos = [sqlbase.get_table(table, database_name) for table in tables]
+    previous = state.table_state(source)
+
+    marks = {}
+    checksummed = []
+    for table in infos:
+        column = _high_water_column(table, high_water_columns)
+        if column is None:
+            checksummed.append(table)
+        else:
+            marks[(table.schema.lower(), table.name.lower())] = column
+    fingerprints = fingerprint_tables(sqlbase, database_name, checksummed) if checksummed else {}
+
+    def read(sql, params=None):
+        if output == 'pandas':
+            return sqlbase.pandas_execute_sql(sql, params=params,
+                                              database_name=database_name,
+                                              use_cache=False)
+        return sqlbase.execute_sql(sql, params=params,
+                                   database_name=database_name,
+                                   use_cache=False,
+                                   row_format='tuple')
+
+    extracts = []
+    for table in infos:
+        key = (table.schema.lower(), table.name.lower())
+        old_fingerprint, old_mark = previous.get(key, (None, None))
+        sql = 'SELECT * FROM {}'.format(_qualified(table))
+
+        if key in marks:
+            column = marks[key]
+            predicates = []
+            params = []
+            if old_mark is not None:
+                predicates.append('{} > ?'.format(quote_identifier(column)))
+                params.append(old_mark)
+            if sqlbase.backend.is_sql_server and \
+               column.lower() == (table_rowversion(table) or '').lower():
+                # Skip rows of open transactions; they are above the next mark
+                predicates.append('{} < MIN_ACTIVE_ROWVERSION()'.format(quote_identifier(column)))
+            if predicates:
+                sql += ' WHERE ' + ' AND '.join(predicates)
+            data = read(sql, params or None)
+            rows = len(data)
+            mark = _column_max(data, column, output) if rows else old_mark
+            if old_mark is None:
+                mode = FULL
+            elif rows:
+                mode = INCREMENTAL
+            else:
+                mode, data = UNCHANGED, None
+            extract = TableExtract(source, table.schema, table.name, mode, data, rows, None, mark)
+        else:
+            # A table without a fingerprint is always extracted in full
+            fingerprint = fingerprints.get(key)
+            if fingerprint is not None and fingerprint == old_fingerprint:
+                extract = TableExtract(source, table.schema, table.name, UNCHANGED,
+                                       None, 0, fingerprint, None)
+            else:
+                data = read(sql)
+                extract = TableExtract(source, table.schema, table.name, FULL,
+                                       data, len(data), fingerprint, None)
+
+        on_table(extract)
+        state.save_table(extract)
+        extracts.append(extract._replace(data=None))
+
+    counts = {mode:sum(1 for extract in extracts if extract.mode == mode)
+              for mode in (FULL, INCREMENTAL, UNCHANGED)}
+    logger.info('Extracted {} : {} full, {} incremental, {} unchanged tables'.format(
+        source, counts[FULL], counts[INCREMENTAL], counts[UNCHANGED]))
+
+    return extracts
+
+
+def process_databases(sqlbase,
+                      specs,
+                      state,
+                      on_table,
+                      tables=None,
+                      high_water_columns=None,
+                      output='pandas',
+                      max_workers=4):
+    """Incremental version of sql_tools.batch.process_databases. Database
+    files whose size and modification time match the state are skipped
+    without attaching them. The others are attached, extracted with
+    extract_tables (state recorded under the .mdf path) and detached
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    specs : (iterable) of (path_mdf, path_ldf, database_name) tuples
+    state : (StateStore)
+    on_table : (callable) see extract_tables. Called from worker threads
+    tables, high_water_columns, output : see extract_tables
+    max_workers : (int) number of databases processed at once
+    outputs
+    -------
+    results : (list) of (DatabaseResult) for the changed databases, with
+        result the list of TableExtract of the database
+    skipped : (list) of (DatabaseSpec) of unchanged database files"""
+    from .batch import DatabaseSpec, process_databases as process
+
+    specs = [DatabaseSpec(*spec) for spec in specs]
+    changed = [spec for spec in specs if state.file_changed(spec.path_mdf)]
+    skipped = [spec for spec in specs if spec not in changed]
+    sources = {spec.database_name:normalize_path(spec.path_mdf) for spec in changed}
+
+    def extract(sqlbase, database_name):
+        return extract_tables(sqlbase,
+                              state,
+                              on_table,
+                              database_name=database_name,
+                              source=sources[database_name],
+                              tables=tables,
+                              high_water_columns=high_water_columns,
+                              output=output)
+
+    results = process(sqlbase, changed, extract=extract, max_workers=max_workers)
+
+    # Attaching and detaching rewrite the file, so its signature is taken
+    # after the database was detached
+    for spec, result in zip(changed, results):
+        if result.error is None:
+            state.save_file(spec.path_mdf)
+    logger.info('Skipped {} unchanged database files'.format(len(skipped)))
+
+    return results, skipped
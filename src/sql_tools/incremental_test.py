@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental extraction tests, run over SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+import datetime
+import decimal
+import os
+import pickle
+import sqlite3
+import tempfile
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+from sql_tools.incremental import (StateStore, FULL, INCREMENTAL, UNCHANGED,
+                                   TableExtract, encode_mark, decode_mark,
+                                   fingerprint_tables)
+from sql_tools.metadata import TableInfo
+
+#%%
+
+class _ChecksumSQLBase:
+    """Fake SQL Server SQLBase whose checksum statements fail on one table"""
+
+    class backend:
+        is_sql_server = True
+
+    def __init__(self, bad_table):
+        self.bad_table = bad_table
+        self.statements = []
+        return None
+
+    def execute_sql(self, sql, database_name=None, use_cache=True):
+        self.statements.append(sql)
+        if self.bad_table in sql:
+            raise RuntimeError('Invalid object name {}'.format(self.bad_table))
+        return [(i, 10 + i, 100 + i) for i in range(sql.count('CHECKSUM_AGG'))]
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        self.sqlbase.init_database_connection('JobDB')
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER PRIMARY KEY, NAME TEXT)')
+        self.sqlbase.execute_sql('CREATE TABLE NETDEV (ID INTEGER PRIMARY KEY, NAME TEXT)')
+        self.sqlbase.bulk_insert([(i, 'JHW.AHU{}'.format(i)) for i in range(10)],
+                                 'POINTBAS', columns=['ID', 'NAME'])
+        self.sqlbase.bulk_insert([(1, 'NETDEV1')], 'NETDEV', columns=['ID', 'NAME'])
+        self.directory = tempfile.TemporaryDirectory()
+        self.state = StateStore(os.path.join(self.directory.name, 'state.db'))
+        return None
+
+
+    def tearDown(self):
+        self.state.close()
+        self.directory.cleanup()
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def extract(self):
+        extracted = {}
+        self.sqlbase.extract_changed_tables(self.state,
+                                            lambda extract: extracted.update({extract.table:extract}),
+                                            high_water_columns={'POINTBAS':'ID'})
+        return extracted
+
+
+    def test_only_changes_are_pulled(self):
+
+        first = self.extract()
+        self.assertEqual(first['POINTBAS'].mode, FULL)
+        self.assertEqual(first['POINTBAS'].rows, 10)
+        self.assertEqual(first['POINTBAS'].high_water, 9)
+        self.assertEqual(first['NETDEV'].mode, FULL)
+
+        second = self.extract()
+        self.assertEqual(second['POINTBAS'].mode, UNCHANGED)
+        self.assertEqual(second['NETDEV'].mode, UNCHANGED)
+        self.assertIsNone(second['NETDEV'].data)
+
+        self.sqlbase.execute_sql("INSERT INTO POINTBAS VALUES (10, 'JHW.AHU10')")
+        self.sqlbase.execute_sql("UPDATE NETDEV SET NAME = 'NETDEV2'")
+        third = self.extract()
+        self.assertEqual(third['POINTBAS'].mode, INCREMENTAL)
+        self.assertEqual(third['POINTBAS'].data['ID'].tolist(), [10])
+        self.assertEqual(third['NETDEV'].mode, FULL)
+        self.assertEqual(third['NETDEV'].data['NAME'].tolist(), ['NETDEV2'])
+        return None
+
+
+    def test_high_water_column_case(self):
+
+        for output in ['rows', 'pandas']:
+            extracted = {}
+            state = StateStore(os.path.join(self.directory.name, '{}.db'.format(output)))
+            for _run in range(2):
+                self.sqlbase.extract_changed_tables(
+                    state,
+                    lambda extract: extracted.update({extract.table:extract}),
+                    tables=['POINTBAS'],
+                    high_water_columns={'pointbas':'id'},
+                    output=output)
+                self.assertEqual(extracted['POINTBAS'].high_water, 9)
+            self.assertEqual(extracted['POINTBAS'].mode, UNCHANGED)
+            state.close()
+        return None
+
+
+    def test_failed_table_is_extracted_again(self):
+
+        def fail(extract):
+            raise RuntimeError('could not store')
+
+        with self.assertRaises(RuntimeError):
+            self.sqlbase.extract_changed_tables(self.state, fail, tables=['NETDEV'])
+        self.assertEqual(self.extract()['NETDEV'].mode, FULL)
+        return None
+
+
+    def test_file_signature(self):
+
+        path = os.path.join(self.directory.name, 'JobDB.mdf')
+        with open(path, 'wb') as file:
+            file.write(b'data')
+        self.assertTrue(self.state.file_changed(path))
+        self.state.save_file(path)
+        self.assertFalse(self.state.file_changed(path))
+        with open(path, 'ab') as file:
+            file.write(b'more')
+        self.assertTrue(self.state.file_changed(path))
+        return None
+
+
+
+    def test_mark_encoding(self):
+
+        for mark in [b'\x00\x00\x00\x00\x00\x00\x07\xd1', 9, 2.5, 'JHW.AHU9',
+                     datetime.datetime(2020, 1, 13, 9, 14, 49, 123000),
+                     datetime.date(2020, 1, 13), decimal.Decimal('12.50')]:
+            self.assertEqual(decode_mark(encode_mark(mark)), mark)
+            self.assertEqual(type(decode_mark(encode_mark(mark))), type(mark))
+        self.assertEqual(encode_mark(b'\x00\x07\xd1'), '["bytes", "0007d1"]')
+        with self.assertRaises(TypeError):
+            encode_mark(object())
+
+        # Marks are stored as text, and unreadable marks are ignored
+        self.state.save_table(TableExtract('JobDB', 'main', 'POINTBAS', FULL, None, 1,
+                                           None, b'\x00\x07\xd1'))
+        with sqlite3.connect(self.state.path) as connection:
+            connection.execute("INSERT INTO table_state VALUES ('JobDB', 'main', 'NETDEV', "
+                               "NULL, ?, 0)", (pickle.dumps(5),))
+            stored = connection.execute("SELECT high_water FROM table_state "
+                                        "WHERE table_name = 'POINTBAS'").fetchone()[0]
+        connection.close()
+        self.assertEqual(stored, '["bytes", "0007d1"]')
+        self.assertEqual(self.state.table_state('JobDB'),
+                         {('main', 'pointbas'):(None, b'\x00\x07\xd1'),
+                          ('main', 'netdev'):(None, None)})
+        return None
+
+
+    def test_checksum_fallback(self):
+
+        tables = [TableInfo('dbo', name, (), (), (), None, 1)
+                  for name in ['POINTBAS', 'BROKEN', 'NETDEV']]
+        sqlbase = _ChecksumSQLBase('[BROKEN]')
+        fingerprints = fingerprint_tables(sqlbase, 'JobDB', tables)
+
+        # The batch failed, then each table was fingerprinted alone
+        self.assertEqual(len(sqlbase.statements), 4)
+        self.assertEqual(fingerprints, {('dbo', 'pointbas'):'10:100',
+                                        ('dbo', 'netdev'):'10:100'})
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
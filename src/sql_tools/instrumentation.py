@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Timing events for connect, execute, fetch, DataFrame construction, attach
+and detach. SQLBase emits an Event to every registered listener; with no
+listeners registered timing is skipped. Ships with an in-memory histogram
+collector and a slow query logger
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+import bisect
+import math
+import re
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+from .query_cache import normalize_sql
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+CONNECT = 'connect'
+EXECUTE = 'execute'
+FETCH = 'fetch'
+DATAFRAME = 'dataframe'
+ATTACH = 'attach'
+DETACH = 'detach'
+
+Event = namedtuple('Event',
+                   ['kind',
+                    'database_name',
+                    'seconds',
+                    'rows',
+                    'bytes',
+                    'fingerprint',
+                    'sql',
+                    'error'])
+Event.__doc__ = """One timed operation. kind is one of 'connect', 'execute',
+'fetch' (one batch), 'dataframe', 'attach' or 'detach'. rows and bytes are
+None when they do not apply; bytes is an estimate (see
+query_cache.estimate_size). fingerprint identifies the statement with its
+literals removed, so the same query with different values is grouped
+together. error is the exception raised, or None"""
+
+# Numbers, strings and hex literals
+_literal_re = re.compile(r"N?'(?:[^']|'')*'|\b0x[0-9a-f]+\b|\b\d+(?:\.\d+)?\b", re.IGNORECASE)
+
+
+def fingerprint(sql):
+    """Return a short hash of sql with whitespace normalized and literals
+    replaced by ?"""
+    if sql is None:
+        return None
+    import hashlib
+    text = _literal_re.sub('?', normalize_sql(sql)).lower()
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+class _Timer:
+
+    def __init__(self, instrumentation, kind, database_name, sql):
+        """Context manager which emits one Event when the block exits. Set
+        rows and bytes inside the block"""
+        self.instrumentation = instrumentation
+        self.kind = kind
+        self.database_name = database_name
+        self.sql = sql
+        self.rows = None
+        self.bytes = None
+        self.enabled = True
+
+        return None
+
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self._start
+        self.instrumentation.emit(Event(self.kind,
+                                        self.database_name,
+                                        seconds,
+                                        self.rows,
+                                        self.bytes,
+                                        fingerprint(self.sql),
+                                        self.sql,
+                                        exc))
+        return False
+
+
+class _NullTimer:
+    """Used when no listener is registered. Attribute writes are ignored"""
+
+    rows = None
+    bytes = None
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+
+    def __init__(self):
+        """Dispatches Events to listeners. A listener is any callable taking
+        one Event. Listeners are called on the thread which did the work and
+        must be thread-safe; exceptions raised by a listener are logged and
+        ignored"""
+        self._listeners = ()
+        self._lock = threading.Lock()
+
+        return None
+
+
+    @property
+    def enabled(self):
+        return bool(self._listeners)
+
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners = self._listeners + (listener,)
+        return listener
+
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners = tuple(item for item in self._listeners if item != listener)
+        return None
+
+
+    def timer(self, kind, database_name=None, sql=None):
+        """Return a context manager which times its block and emits an Event
+        of kind. Costs one attribute check when no listener is registered"""
+        if not self._listeners:
+            return _NULL_TIMER
+        return _Timer(self, kind, database_name, sql)
+
+
+    def emit(self, event):
+        # Copy-on-write tuple, so no lock is needed to iterate
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.debug('Listener {} failed : {}'.format(listener, e))
+
+        return None
+
+
+class HistogramCollector:
+
+    def __init__(self, bucket_bounds=None):
+        """Listener which keeps latency histograms in memory, per event kind
+        and per (kind, fingerprint)
+        inputs
+        -------
+        bucket_bounds : (list) of upper bucket bounds in seconds. Defaults to
+            log spaced bounds from 100 microseconds to about 5 minutes"""
+        if bucket_bounds is None:
+            bucket_bounds = [1e-4 * 10 ** (i / 4) for i in range(27)]
+        self.bucket_bounds = sorted(bucket_bounds)
+        self._lock = threading.Lock()
+        # {key : dict of counters and 'buckets' list}
+        self._histograms = {}
+        self._sql = {}
+
+        return None
+
+
+    def __call__(self, event):
+        keys = [event.kind]
+        if event.fingerprint is not None:
+            keys.append((event.kind, event.fingerprint))
+        index = bisect.bisect_left(self.bucket_bounds, event.seconds)
+
+        with self._lock:
+            if event.fingerprint is not None and event.fingerprint not in self._sql:
+                self._sql[event.fingerprint] = normalize_sql(event.sql)
+            for key in keys:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = {'count':0,
+                                 'errors':0,
+                                 'seconds':0.0,
+                                 'min':math.inf,
+                                 'max':0.0,
+                                 'rows':0,
+                                 'bytes':0,
+                                 'buckets':[0] * (len(self.bucket_bounds) + 1)}
+                    self._histograms[key] = histogram
+                histogram['count'] += 1
+                histogram['errors'] += event.error is not None
+                histogram['seconds'] += event.seconds
+                histogram['min'] = min(histogram['min'], event.seconds)
+                histogram['max'] = max(histogram['max'], event.seconds)
+                histogram['rows'] += event.rows or 0
+                histogram['bytes'] += event.bytes or 0
+                histogram['buckets'][index] += 1
+
+        return None
+
+
+    def percentile(self, kind, q, fingerprint=None):
+        """Return the upper bucket bound below which fraction q (0 to 1) of
+        the events of kind fall, or None if there are no events. The
+        result is exact to the bucket resolution, and capped at the observed
+        maximum"""
+        key = kind if fingerprint is None else (kind, fingerprint)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None or histogram['count'] == 0:
+                return None
+            target = q * histogram['count']
+            cumulative = 0
+            for index, count in enumerate(histogram['buckets']):
+                cumulative += count
+                if cumulative >= target and count:
+                    break
+            if index < len(self.bucket_bounds):
+                return min(self.bucket_bounds[index], histogram['max'])
+            return histogram['max']
+
+
+    def summary(self, by_statement=False):
+        """Return {kind : stats} (or {(kind, fingerprint) : stats} if
+        by_statement) where stats has count, errors, total / mean / min /
+        max seconds, p50 / p95 / p99 seconds, rows and bytes. Statement
+        summaries also carry the normalized 'sql'"""
+        with self._lock:
+            keys = [key for key in self._histograms
+                    if isinstance(key, tuple) == by_statement]
+
+        summary = {}
+        for key in keys:
+            kind, fingerprint = key if by_statement else (key, None)
+            with self._lock:
+                histogram = dict(self._histograms[key])
+            stats = {'count':histogram['count'],
+                     'errors':histogram['errors'],
+                     'seconds':histogram['seconds'],
+                     'mean':histogram['seconds'] / histogram['count'],
+                     'min':histogram['min'],
+                     'max':histogram['max'],
+                     'p50':self.percentile(kind, 0.5, fingerprint),
+                     'p95':self.percentile(kind, 0.95, fingerprint),
+                     'p99':self.percentile(kind, 0.99, fingerprint),
+                     'rows':histogram['rows'],
+                     'bytes':histogram['bytes']}
+            if by_statement:
+                stats['sql'] = self._sql.get(fingerprint)
+            summary[key] = stats
+
+        return summary
+
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._sql.clear()
+        return None
+
+
+class SlowQueryLogger:
+
+    def __init__(self, threshold=1.0, kinds=(EXECUTE, ATTACH, DETACH), level=logging.WARNING,
+                 log=None):
+        """Listener which logs events slower than threshold seconds
+        inputs
+        -------
+        threshold : (float) seconds
+        kinds : (iterable) event kinds to check. None checks every kind
+        level : (int) logging level
+        log : (logging.Logger) defaults to this module logger"""
+        self.threshold = threshold
+        self.kinds = None if kinds is None else frozenset(kinds)
+        self.level = level
+        self.log = logger if log is None else log
+
+        return None
+
+
+    def __call__(self, event):
+        if event.seconds < self.threshold:
+            return None
+        if self.kinds is not None and event.kind not in self.kinds:
+            return None
+
+        msg = 'Slow {} on {} : {:.3f}s'.format(event.kind, event.database_name, event.seconds)
+        if event.rows is not None:
+            msg += ', {} rows'.format(event.rows)
+        if event.sql is not None:
+            sql = normalize_sql(event.sql)
+            msg += ' [{}] {}'.format(event.fingerprint, sql[:500])
+        self.log.log(self.level, msg)
+
+        return None
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation tests
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+import logging
+
+# local imports
+from sql_tools.instrumentation import (Instrumentation, HistogramCollector,
+                                       SlowQueryLogger, Event, fingerprint)
+
+#%%
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_fingerprint(self):
+
+        self.assertEqual(fingerprint("SELECT * FROM POINTBAS WHERE ID = 5"),
+                         fingerprint("select *  from POINTBAS\nwhere ID = 12;"))
+        self.assertEqual(fingerprint("SELECT * FROM POINTBAS WHERE NAME = 'JHW'"),
+                         fingerprint("SELECT * FROM POINTBAS WHERE NAME = 'AHU''s'"))
+        self.assertNotEqual(fingerprint("SELECT * FROM POINTBAS"),
+                            fingerprint("SELECT * FROM POINTSEN"))
+        return None
+
+
+    def test_listeners(self):
+
+        instrumentation = Instrumentation()
+        with instrumentation.timer('execute') as timer:
+            timer.rows = 1
+        self.assertFalse(timer.enabled)
+
+        events = []
+        instrumentation.add_listener(events.append)
+        with self.assertRaises(ValueError):
+            with instrumentation.timer('execute', 'JobDB', 'SELECT 1') as timer:
+                timer.rows = 1
+                raise ValueError()
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].database_name, 'JobDB')
+        self.assertEqual(events[0].rows, 1)
+        self.assertIsInstance(events[0].error, ValueError)
+        instrumentation.remove_listener(events.append)
+        self.assertFalse(instrumentation.enabled)
+        return None
+
+
+    def test_histogram(self):
+
+        histograms = HistogramCollector(bucket_bounds=[0.01, 0.1, 1])
+        for seconds in [0.005] * 90 + [0.05] * 9 + [2]:
+            histograms(Event('execute', 'JobDB', seconds, 10, None,
+                             fingerprint('SELECT 1'), 'SELECT 1', None))
+
+        summary = histograms.summary()['execute']
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['rows'], 1000)
+        self.assertEqual(summary['p50'], 0.01)
+        self.assertEqual(summary['p95'], 0.1)
+        self.assertEqual(summary['p99'], 0.1)
+        self.assertEqual(histograms.percentile('execute', 1.0), 2)
+        self.assertEqual(len(histograms.summary(by_statement=True)), 1)
+        return None
+
+
+    def test_slow_query_logger(self):
+
+        slow = SlowQueryLogger(threshold=1.0)
+        with self.assertLogs('sql_tools.instrumentation', level=logging.WARNING) as logs:
+            slow(Event('execute', 'JobDB', 0.5, None, None, None, 'SELECT 1', None))
+            slow(Event('execute', 'JobDB', 1.5, None, None, 'abc', 'SELECT  2', None))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('SELECT 2', logs.output[0])
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
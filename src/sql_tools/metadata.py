@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Cached table metadata (columns, types, indexes, keys and row count
+estimates) per database. The metadata of every table of a database is
+loaded in one batched catalog query and reused until the database is
+attached, detached or altered through SQLBase, so callers like pagination
+and export do not query the catalog on each call
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+import re
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+ColumnInfo = namedtuple('ColumnInfo',
+                        ['name',
+                         'ordinal',
+                         'type_name',
+                         'max_length',
+                         'precision',
+                         'scale',
+                         'nullable',
+                         'is_identity'])
+ColumnInfo.__doc__ = """One column of a table. ordinal starts at 1.
+max_length is in bytes on SQL Server (-1 for MAX types) and None when the
+server does not report it"""
+
+IndexInfo = namedtuple('IndexInfo',
+                       ['name',
+                        'type',
+                        'is_unique',
+                        'is_primary_key',
+                        'columns'])
+IndexInfo.__doc__ = """One index of a table. type is like 'CLUSTERED' or
+'NONCLUSTERED' on SQL Server and 'INDEX' on SQLite. columns is a tuple of
+the key column names in key order"""
+
+TableInfo = namedtuple('TableInfo',
+                       ['schema',
+                        'name',
+                        'columns',
+                        'indexes',
+                        'key_columns',
+                        'row_count',
+                        'partitions'])
+TableInfo.__doc__ = """Metadata of one table. columns is a tuple of
+ColumnInfo in ordinal order and indexes a tuple of IndexInfo. key_columns is
+the clustered index key, or the primary key of a heap (empty if neither
+exists). row_count is the estimate kept by the server (sys.partitions), and
+None when the server keeps none"""
+
+_ddl_re = re.compile(r'\b(CREATE|ALTER|DROP|SP_RENAME)\b', re.IGNORECASE)
+
+
+def is_ddl(sql):
+    """True if sql may change table definitions"""
+    return bool(_ddl_re.search(sql))
+
+
+def split_table_name(table):
+    """Split 'table', 'schema.table' or '[schema].[table]' into
+    (schema or None, table)"""
+    parts = re.findall(r'\[((?:[^\]]|\]\])*)\]|"((?:[^"]|"")*)"|([^.\s]+)', table)
+    names = [bracket.replace(']]', ']') or quoted.replace('""', '"') or bare
+             for bracket, quoted, bare in parts]
+    if not names or len(names) > 2:
+        raise ValueError('Could not parse table name {!r}'.format(table))
+    if len(names) == 1:
+        return None, names[0]
+    return names[0], names[1]
+
+
+_sql_server_metadata_sql = """SET NOCOUNT ON;
+SELECT t.object_id, s.name, t.name,
+    (SELECT SUM(p.rows) FROM sys.partitions AS p
+     WHERE p.object_id = t.object_id AND p.index_id IN (0, 1)),
+    (SELECT COUNT(*) FROM sys.partitions AS p
+     WHERE p.object_id = t.object_id AND p.index_id IN (0, 1))
+FROM sys.tables AS t
+JOIN sys.schemas AS s ON s.schema_id = t.schema_id;
+SELECT c.object_id, c.name, c.column_id, TYPE_NAME(c.user_type_id),
+    c.max_length, c.precision, c.scale, c.is_nullable, c.is_identity, NULL
+FROM sys.columns AS c
+JOIN sys.tables AS t ON t.object_id = c.object_id
+ORDER BY c.object_id, c.column_id;
+SELECT i.object_id, i.index_id, i.name, i.type_desc, i.is_unique, i.is_primary_key, c.name
+FROM sys.indexes AS i
+JOIN sys.tables AS t ON t.object_id = i.object_id
+JOIN sys.index_columns AS ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+JOIN sys.columns AS c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+WHERE ic.key_ordinal > 0
+ORDER BY i.object_id, i.index_id, ic.key_ordinal;"""
+
+_sqlite_metadata_sql = ["""SELECT m.name, 'main', m.name, NULL, NULL
+FROM sqlite_master AS m
+WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'""",
+"""SELECT m.name, p.name, p.cid + 1, p.type, NULL, NULL, NULL, NOT p."notnull", 0, p.pk
+FROM sqlite_master AS m
+JOIN pragma_table_info(m.name) AS p
+WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+ORDER BY m.name, p.cid""",
+"""SELECT m.name, l.seq, l.name, 'INDEX', l."unique", l.origin = 'pk', i.name
+FROM sqlite_master AS m
+JOIN pragma_index_list(m.name) AS l
+JOIN pragma_index_info(l.name) AS i
+WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+ORDER BY m.name, l.seq, i.seqno"""]
+
+
+def _result_sets(sqlbase, database_name, statements):
+    """Run statements on one pooled connection and return the rows of every
+    result set, in order"""
+    pool = sqlbase.get_pool(database_name)
+
+    def run():
+        results = []
+        with pool.connection() as connection:
+            for sql in statements:
+                with sqlbase._execute(pool, connection, sql) as cursor:
+                    while True:
+                        if cursor.description is not None:
+                            results.append(sqlbase._fetchall(cursor, database_name, sql))
+                        nextset = getattr(cursor, 'nextset', None)
+                        if nextset is None or not nextset():
+                            break
+            connection.commit()
+        return results
+
+    return sqlbase._with_retry(pool, run, idempotent=True)
+
+
+def load_tables(sqlbase, database_name):
+    """Query the metadata of every table of database_name
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    database_name : (str)
+    outputs
+    -------
+    tables : (list) of (TableInfo)"""
+
+    if sqlbase.backend.is_sql_server:
+        table_rows, column_rows, index_rows = _result_sets(sqlbase,
+                                                           database_name,
+                                                           [_sql_server_metadata_sql])
+    else:
+        table_rows, column_rows, index_rows = _result_sets(sqlbase,
+                                                           database_name,
+                                                           _sqlite_metadata_sql)
+
+    columns = {}
+    primary_keys = {}
+    for object_id, *values, nullable, is_identity, pk in column_rows:
+        column = ColumnInfo(*values, bool(nullable), bool(is_identity))
+        columns.setdefault(object_id, []).append(column)
+        if pk:
+            # SQLite reports the primary key position of each column
+            primary_keys.setdefault(object_id, []).append((pk, column.name))
+
+    indexes = {}
+    for object_id, index_id, name, index_type, is_unique, is_primary_key, column in index_rows:
+        table_indexes = indexes.setdefault(object_id, {})
+        if index_id not in table_indexes:
+            table_indexes[index_id] = IndexInfo(name, index_type, bool(is_unique),
+                                                bool(is_primary_key), [])
+        table_indexes[index_id].columns.append(column)
+
+    tables = []
+    for object_id, schema, name, row_count, partitions in table_rows:
+        table_indexes = tuple(index._replace(columns=tuple(index.columns))
+                              for index in indexes.get(object_id, {}).values())
+        clustered = [index for index in table_indexes if index.type == 'CLUSTERED']
+        primary = [index for index in table_indexes if index.is_primary_key]
+        if clustered:
+            key_columns = clustered[0].columns
+        elif primary:
+            key_columns = primary[0].columns
+        else:
+            key_columns = tuple(column for _position, column in
+                                sorted(primary_keys.get(object_id, ())))
+        tables.append(TableInfo(schema,
+                                name,
+                                tuple(columns.get(object_id, ())),
+                                table_indexes,
+                                key_columns,
+                                None if row_count is None else int(row_count),
+                                partitions))
+
+    return tables
+
+
+class MetadataCache:
+
+    def __init__(self, load, ttl=None, default_schemas=('dbo', 'main')):
+        """Cache of table metadata per database
+        inputs
+        -------
+        load : (callable) called with a database name, returns an iterable
+            of TableInfo
+        ttl : (float) seconds before the metadata of a database is reloaded
+            on the next lookup. None keeps it until invalidate() is called
+        default_schemas : (tuple) schemas searched, in order, for table
+            names given without a schema"""
+        self._load = load
+        self.ttl = ttl
+        self.default_schemas = default_schemas
+        self._lock = threading.RLock()
+        # {database name : (loaded at, {(schema, table) lower case : TableInfo})}
+        self._databases = {}
+        self.loads = 0
+
+        return None
+
+
+    def _tables(self, database_name, refresh=False):
+        with self._lock:
+            entry = self._databases.get(database_name)
+            expired = (entry is None or
+                       (self.ttl is not None and time.monotonic() - entry[0] >= self.ttl))
+            if refresh or expired:
+                tables = {(table.schema.lower(), table.name.lower()):table
+                          for table in self._load(database_name)}
+                entry = (time.monotonic(), tables)
+                self._databases[database_name] = entry
+                self.loads += 1
+                logger.debug('Loaded metadata of {} : {} tables'.format(database_name, len(tables)))
+            return entry[1]
+
+
+    def tables(self, database_name, refresh=False):
+        """Return a list of TableInfo of every table of database_name"""
+        return list(self._tables(database_name, refresh).values())
+
+
+    def table(self, database_name, table, refresh=False):
+        """Return the TableInfo of table
+        inputs
+        -------
+        database_name : (str)
+        table : (str) table name, like 'POINTBAS', 'dbo.POINTBAS' or
+            '[dbo].[POINTBAS]'. Without a schema the default schemas are
+            searched first, then any schema with a table of that name
+        refresh : (bool) reload the metadata of database_name first
+        raises
+        -------
+        KeyError : if the table does not exist"""
+        schema, name = split_table_name(table)
+        tables = self._tables(database_name, refresh)
+        name = name.lower()
+        if schema is not None:
+            candidates = [(schema.lower(), name)]
+        else:
+            candidates = [(default.lower(), name) for default in self.default_schemas]
+            candidates.extend(key for key in tables if key[1] == name)
+        for key in candidates:
+            if key in tables:
+                return tables[key]
+
+        raise KeyError('Table {} not found in {}'.format(table, database_name))
+
+
+    def invalidate(self, database_name=None):
+        """Discard the metadata of database_name, or of every database if
+        database_name is None. The next lookup reloads it"""
+        with self._lock:
+            if database_name is None:
+                self._databases.clear()
+            else:
+                self._databases.pop(database_name, None)
+
+        return None
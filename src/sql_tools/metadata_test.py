@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Metadata cache tests, run over SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+import os
+import tempfile
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+from sql_tools.metadata import split_table_name
+
+#%%
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        self.sqlbase.init_database_connection('JobDB')
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (NETDEVID INTEGER NOT NULL, '
+                                 'ID INTEGER NOT NULL, NAME TEXT, PRIMARY KEY (NETDEVID, ID))')
+        self.sqlbase.execute_sql('CREATE INDEX IX_NAME ON POINTBAS (NAME)')
+        self.sqlbase.execute_sql('CREATE TABLE NETDEV (ID INTEGER PRIMARY KEY, NAME TEXT)')
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_describe_table(self):
+
+        table = self.sqlbase.get_table('main.[POINTBAS]')
+        self.assertEqual([column.name for column in table.columns], ['NETDEVID', 'ID', 'NAME'])
+        self.assertEqual(table.columns[2].type_name, 'TEXT')
+        self.assertFalse(table.columns[0].nullable)
+        self.assertTrue(table.columns[2].nullable)
+        self.assertEqual(table.key_columns, ('NETDEVID', 'ID'))
+        self.assertIn(('NAME',), [index.columns for index in table.indexes])
+
+        self.assertEqual(self.sqlbase.get_table('netdev').key_columns, ('ID',))
+        self.assertEqual(sorted(table.name for table in self.sqlbase.get_tables()),
+                         ['NETDEV', 'POINTBAS'])
+        with self.assertRaises(KeyError):
+            self.sqlbase.get_table('Missing')
+        return None
+
+
+    def test_cached_until_ddl(self):
+
+        self.sqlbase.get_table('POINTBAS')
+        self.sqlbase.get_table('NETDEV')
+        self.assertEqual(self.sqlbase.metadata.loads, 1)
+
+        # Writes which do not change definitions keep the metadata
+        self.sqlbase.execute_sql("INSERT INTO NETDEV VALUES (1, 'JHW')")
+        self.sqlbase.get_table('NETDEV')
+        self.assertEqual(self.sqlbase.metadata.loads, 1)
+
+        self.sqlbase.execute_sql('ALTER TABLE NETDEV ADD COLUMN ADDRESS TEXT')
+        table = self.sqlbase.get_table('NETDEV')
+        self.assertEqual(self.sqlbase.metadata.loads, 2)
+        self.assertEqual(table.columns[-1].name, 'ADDRESS')
+        return None
+
+
+    def test_export_database_lists_tables(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            reports = self.sqlbase.export_database(directory, format='csv')
+            self.assertEqual(sorted(reports), ['main.NETDEV', 'main.POINTBAS'])
+            self.assertTrue(os.path.exists(os.path.join(directory, 'main.NETDEV.csv')))
+        return None
+
+
+    def test_split_table_name(self):
+
+        self.assertEqual(split_table_name('POINTBAS'), (None, 'POINTBAS'))
+        self.assertEqual(split_table_name('[dbo].[Point]]s]'), ('dbo', 'Point]s'))
+        self.assertEqual(split_table_name('dbo."my table"'), ('dbo', 'my table'))
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
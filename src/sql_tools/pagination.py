@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset pagination over large tables. Each page is a short statement
+(SELECT TOP (n) ... WHERE key > last key ORDER BY key) on the clustered key,
+so no lock or tempdb space is held between pages, and a walk can be resumed
+from the last key of any page. Pages can be fetched by parallel workers over
+disjoint ranges of the leading key column
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+Page = namedtuple('Page', ['rows', 'columns', 'last_key', 'range_index'])
+Page.__doc__ = """One page of rows. last_key is the tuple of key column values
+of the last row; pass it as start_after to resume after this page.
+range_index identifies the key range of a parallel walk (0 otherwise)"""
+
+KeyRange = namedtuple('KeyRange', ['lower', 'upper'])
+KeyRange.__doc__ = """Range of the leading key column, lower exclusive and
+upper inclusive. None is unbounded"""
+
+class KeysetPaginator:
+
+    def __init__(self,
+                 sqlbase,
+                 table,
+                 key_columns=None,
+                 page_size=10000,
+                 columns=None,
+                 database_name=None):
+        """Walk table in pages ordered by its key
+        inputs
+        -------
+        sqlbase : (SQLBase)
+        table : (str) table name, like 'POINTBAS' or 'dbo.POINTBAS'
+        key_columns : (list) of (str) unique key columns to page on. Defaults
+            to the clustered index key (or primary key) of table. Key columns
+            must not contain NULL
+        page_size : (int) rows per page
+        columns : (list) of (str) columns to select. Defaults to all
+            columns. Key columns which are not listed are appended
+        database_name : (str) database to query. Defaults to the database
+            set by init_database_connection"""
+        from .sql_tools import quote_identifier
+
+        self.sqlbase = sqlbase
+        self.table = table
+        self.page_size = page_size
+        self.database_name = sqlbase._resolve_database_name(database_name)
+        self.sql_server = sqlbase.backend.is_sql_server
+        self._table_sql = quote_identifier(table)
+
+        if key_columns is None:
+            key_columns = self.discover_key()
+        if isinstance(key_columns, str):
+            key_columns = [key_columns]
+        self.key_columns = list(key_columns)
+
+        if columns is None:
+            columns = self._table_columns()
+        columns = list(columns)
+        lower = [column.lower() for column in columns]
+        for key in self.key_columns:
+            if key.lower() not in lower:
+                columns.append(key)
+                lower.append(key.lower())
+        self.columns = columns
+        self._key_positions = [lower.index(key.lower()) for key in self.key_columns]
+
+        self._select = ', '.join(quote_identifier(column) for column in self.columns)
+        self._keys_sql = [quote_identifier(key) for key in self.key_columns]
+
+        return None
+
+
+    def discover_key(self):
+        """Return the clustered index key columns of the table, or its
+        primary key columns if the table is a heap (from the SQLBase
+        metadata cache)"""
+        try:
+            keys = list(self.sqlbase.get_table(self.table, self.database_name).key_columns)
+        except KeyError:
+            keys = []
+
+        if not keys:
+            raise ValueError('Table {} has no clustered or primary key. '
+                             'Pass key_columns'.format(self.table))
+        return keys
+
+
+    def _table_columns(self):
+        try:
+            table = self.sqlbase.get_table(self.table, self.database_name)
+            return [column.name for column in table.columns]
+        except KeyError:
+            # Not a table, like a view
+            pass
+        if self.sql_server:
+            sql = 'SELECT TOP (0) * FROM {}'.format(self._table_sql)
+        else:
+            sql = 'SELECT * FROM {} LIMIT 0'.format(self._table_sql)
+        columns, _rows = self._fetch(sql, None)
+        return columns
+
+
+    def _fetch(self, sql, params):
+        """Return (columns, rows) of a query, with the SQLBase retry policy"""
+        sqlbase = self.sqlbase
+        pool = sqlbase.get_pool(self.database_name)
+
+        def run():
+            with pool.connection() as connection:
+                with sqlbase._execute(pool, connection, sql, params) as cursor:
+                    columns = [column[0] for column in cursor.description]
+                    rows = sqlbase._fetchall(cursor, self.database_name, sql)
+                connection.commit()
+            return columns, rows
+
+        return sqlbase._with_retry(pool, run, idempotent=True)
+
+
+    def _page_sql(self, after, upper, lower):
+        """Statement and parameters for the page after key tuple 'after',
+        within a range of the leading key column"""
+        predicates = []
+        params = []
+        if after is not None:
+            # k1 >= ? AND ((k1 > ?) OR (k1 = ? AND k2 > ?) OR ...). The leading
+            # conjunct is sargable, so the server seeks the key index instead
+            # of scanning it to evaluate the OR
+            if len(self._keys_sql) > 1:
+                predicates.append('{} >= ?'.format(self._keys_sql[0]))
+                params.append(after[0])
+            terms = []
+            for i, key in enumerate(self._keys_sql):
+                parts = ['{} = ?'.format(previous) for previous in self._keys_sql[:i]]
+                parts.append('{} > ?'.format(key))
+                terms.append('(' + ' AND '.join(parts) + ')')
+                params.extend(after[:i + 1])
+            predicates.append('(' + ' OR '.join(terms) + ')')
+        elif lower is not None:
+            predicates.append('{} > ?'.format(self._keys_sql[0]))
+            params.append(lower)
+        if upper is not None:
+            predicates.append('{} <= ?'.format(self._keys_sql[0]))
+            params.append(upper)
+
+        where = ' WHERE ' + ' AND '.join(predicates) if predicates else ''
+        order = ', '.join(self._keys_sql)
+        if self.sql_server:
+            sql = 'SELECT TOP (?) {} FROM {}{} ORDER BY {}'.format(
+                self._select, self._table_sql, where, order)
+            params = [self.page_size] + params
+        else:
+            sql = 'SELECT {} FROM {}{} ORDER BY {} LIMIT ?'.format(
+                self._select, self._table_sql, where, order)
+            params = params + [self.page_size]
+
+        return sql, params
+
+
+    def pages(self, start_after=None, key_range=None, range_index=0):
+        """Yield Pages in key order
+        inputs
+        -------
+        start_after : (tuple) key values of the last row already processed,
+            like Page.last_key of a previous walk. None starts at the
+            beginning of key_range
+        key_range : (KeyRange) limit the walk to this range of the leading
+            key column
+        range_index : (int) reported in each Page"""
+        lower, upper = key_range if key_range is not None else (None, None)
+        after = None if start_after is None else tuple(start_after)
+
+        while True:
+            sql, params = self._page_sql(after, upper, lower)
+            _columns, rows = self._fetch(sql, params)
+            if not rows:
+                break
+            last = rows[-1]
+            after = tuple(last[position] for position in self._key_positions)
+            yield Page(rows, self.columns, after, range_index)
+            if len(rows) < self.page_size:
+                break
+
+        return None
+
+
+    def key_ranges(self, n):
+        """Split the leading key column into at most n ranges holding about
+        the same number of rows (NTILE over the key)
+        outputs
+        -------
+        ranges : (list) of (KeyRange) covering every key, in key order"""
+        key = self._keys_sql[0]
+        sql = ('SELECT MAX({key}) FROM (SELECT {key}, NTILE(?) OVER (ORDER BY {key}) AS tile '
+               'FROM {table}) AS tiles GROUP BY tile ORDER BY 1').format(key=key, table=self._table_sql)
+        _columns, rows = self._fetch(sql, [n])
+        bounds = []
+        for row in rows[:-1]:
+            if not bounds or row[0] != bounds[-1]:
+                bounds.append(row[0])
+
+        lowers = [None] + bounds
+        uppers = bounds + [None]
+        return [KeyRange(lower, upper) for lower, upper in zip(lowers, uppers)]
+
+
+    def parallel_pages(self, workers=4, ranges=None, start_after=None, max_pending=None):
+        """Yield Pages fetched by parallel workers, each walking one key
+        range. Pages arrive in no particular order across ranges, but in key
+        order within a range. To resume, keep the ranges and the last_key of
+        each range_index
+        inputs
+        -------
+        workers : (int) number of ranges walked at once
+        ranges : (list) of (KeyRange). Defaults to key_ranges(workers)
+        start_after : (dict) of {range_index : last key} to resume from
+        max_pending : (int) pages buffered ahead of the consumer. Defaults
+            to 2 * workers"""
+        if ranges is None:
+            ranges = self.key_ranges(workers)
+        start_after = start_after or {}
+        pages = queue.Queue(maxsize=max_pending or 2 * workers)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def walk(range_index):
+            try:
+                for page in self.pages(start_after.get(range_index),
+                                       ranges[range_index],
+                                       range_index):
+                    if not put(page):
+                        return None
+            except Exception as e:
+                put(e)
+            put(done)
+            return None
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(ranges))),
+                                      thread_name_prefix='sql_tools_pages')
+        try:
+            for range_index in range(len(ranges)):
+                executor.submit(walk, range_index)
+            remaining = len(ranges)
+            while remaining:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return None
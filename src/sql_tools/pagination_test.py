@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset pagination tests, run over SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+from sql_tools.pagination import KeysetPaginator
+
+#%%
+
+class PaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (NETDEVID INTEGER, ID INTEGER, NAME TEXT, '
+                                 'PRIMARY KEY (NETDEVID, ID))', database_name='JobDB')
+        self.sqlbase.bulk_insert([(i % 3, i, 'JHW.AHU{}'.format(i)) for i in range(100)],
+                                 'POINTBAS', columns=['NETDEVID', 'ID', 'NAME'], database_name='JobDB')
+        self.sqlbase.init_database_connection('JobDB')
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_pages(self):
+
+        pages = list(self.sqlbase.iter_table_pages('POINTBAS', page_size=30))
+
+        self.assertEqual([len(page.rows) for page in pages], [30, 30, 30, 10])
+        keys = [(row[0], row[1]) for page in pages for row in page.rows]
+        self.assertEqual(keys, sorted((i % 3, i) for i in range(100)))
+        self.assertEqual(pages[0].last_key, keys[29])
+        return None
+
+
+    def test_resume(self):
+
+        paginator = KeysetPaginator(self.sqlbase, 'POINTBAS', page_size=30, columns=['NAME'])
+        first = next(paginator.pages())
+        rest = list(paginator.pages(start_after=first.last_key))
+
+        self.assertEqual(paginator.columns, ['NAME', 'NETDEVID', 'ID'])
+        self.assertEqual(len(first.rows) + sum(len(page.rows) for page in rest), 100)
+        return None
+
+
+    def test_parallel(self):
+
+        paginator = KeysetPaginator(self.sqlbase, 'POINTBAS', page_size=7)
+        ranges = paginator.key_ranges(3)
+        pages = list(paginator.parallel_pages(workers=3, ranges=ranges))
+
+        self.assertEqual(len(ranges), 3)
+        ids = sorted(row[1] for page in pages for row in page.rows)
+        self.assertEqual(ids, list(range(100)))
+        self.assertEqual({page.range_index for page in pages}, {0, 1, 2})
+        return None
+
+
+
+    def test_composite_key_seek(self):
+
+        paginator = KeysetPaginator(self.sqlbase, 'POINTBAS', page_size=30)
+        sql, params = paginator._page_sql((1, 40), None, None)
+
+        self.assertIn('WHERE [NETDEVID] >= ? AND (([NETDEVID] > ?) OR '
+                      '([NETDEVID] = ? AND [ID] > ?))', sql)
+        self.assertEqual(params, [1, 1, 1, 40, 30])
+        # The leading conjunct lets the server seek the primary key
+        plan = self.sqlbase.execute_sql('EXPLAIN QUERY PLAN ' + sql, params=params)
+        self.assertTrue(any('SEARCH' in row[-1] for row in plan))
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
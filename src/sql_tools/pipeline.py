@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined query execution. A fetch thread pulls fetchmany batches into a
+bounded queue while a process pool builds a DataFrame from each batch and
+applies a transform, so network I/O, decoding and downstream work overlap
+and use more than one core. Batches come back in query order. The queue
+and the number of batches in flight are bounded, so a slow consumer stops
+the fetch instead of buffering the whole result
+
+@author: vorst
+"""
+
+# Python imports
+from collections import deque
+import os
+import queue
+import threading
+
+# Third party imports
+
+# Local imports
+from . import instrumentation as events
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+def convert_batch(columns, rows, transform=None):
+    """Build a DataFrame from a batch of tuples and apply transform. Runs in
+    a worker process"""
+    import pandas as pd
+    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+    if transform is not None:
+        df = transform(df)
+    return df
+
+
+class _InlineFuture:
+    """Result of a batch converted in the calling thread (processes=0)"""
+
+    def __init__(self, function, *args):
+        self._result = function(*args)
+        return None
+
+    def result(self):
+        return self._result
+
+
+def iter_pipeline(sqlbase,
+                  sql_query,
+                  transform=None,
+                  params=None,
+                  database_name=None,
+                  arraysize=50000,
+                  processes=None,
+                  max_pending=None,
+                  executor=None,
+                  on_columns=None):
+    """Yield DataFrames of at most arraysize rows, in query order, with
+    fetching and conversion overlapped
+    inputs
+    -------
+    sqlbase : (SQLBase)
+    sql_query : (str) sql string to execute
+    transform : (callable) called as transform(df) on each batch DataFrame in
+        a worker process, returning a DataFrame. It must be picklable (a
+        module level function)
+    params : (sequence) parameter values for the ? markers in sql_query
+    database_name : (str) database to query. Defaults to the database set by
+        init_database_connection
+    arraysize : (int) rows per fetchmany batch
+    processes : (int) worker processes. Defaults to os.cpu_count() - 1. 0
+        converts batches in the calling thread, still overlapped with the
+        fetch thread
+    max_pending : (int) batches fetched or converting ahead of the
+        consumer. Defaults to 2 * processes (at least 2)
+    executor : (concurrent.futures.Executor) reuse this executor instead of
+        starting a process pool per call (process start up is slow on
+        Windows)
+    on_columns : (callable) called with the list of result columns after
+        the last batch
+    outputs
+    -------
+    dfs : (generator) of (pandas.DataFrame)"""
+
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 2) - 1)
+    if max_pending is None:
+        max_pending = max(2, 2 * processes)
+    pool = sqlbase._get_database_pool(database_name)
+
+    batches = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            with pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.arraysize = arraysize
+                    with sqlbase.instrumentation.timer(events.EXECUTE, pool.name, sql_query):
+                        sqlbase._execute_cursor(cursor, sql_query, params)
+                    if not put([column[0] for column in cursor.description]):
+                        return None
+                    for rows in sqlbase._iter_fetchmany(cursor, arraysize, pool.name, sql_query):
+                        # Driver rows do not pickle
+                        if not put([tuple(row) for row in rows]):
+                            return None
+                finally:
+                    cursor.close()
+                connection.commit()
+            sqlbase._invalidate_after_write(pool.name, sql_query)
+        except Exception as e:
+            put(e)
+        put(done)
+        return None
+
+    owned = None
+    if executor is None and processes > 0:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = owned = ProcessPoolExecutor(max_workers=processes)
+
+    def submit(columns, rows):
+        if executor is None:
+            return _InlineFuture(convert_batch, columns, rows, transform)
+        return executor.submit(convert_batch, columns, rows, transform)
+
+    fetcher = threading.Thread(target=fetch, name='sql_tools_fetch', daemon=True)
+    fetcher.start()
+    pending = deque()
+    try:
+        columns = None
+        while True:
+            item = batches.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if columns is None:
+                columns = item
+                continue
+            pending.append(submit(columns, item))
+            while len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        if on_columns is not None and columns is not None:
+            on_columns(columns)
+    finally:
+        stop.set()
+        for future in pending:
+            if hasattr(future, 'cancel'):
+                future.cancel()
+        fetcher.join()
+        if owned is not None:
+            owned.shutdown(wait=True, cancel_futures=True)
+
+    return None
+
+
+def pipeline_execute_sql(sqlbase, sql_query, transform=None, **kwargs):
+    """Run iter_pipeline and concatenate the batches into one DataFrame. A
+    result without rows is an empty DataFrame with the result columns (not
+    transformed)
+    outputs
+    -------
+    df : (pandas.DataFrame)"""
+    import pandas as pd
+
+    columns = []
+    dfs = list(iter_pipeline(sqlbase,
+                             sql_query,
+                             transform=transform,
+                             on_columns=columns.extend,
+                             **kwargs))
+    if not dfs:
+        return pd.DataFrame(columns=columns)
+    if len(dfs) == 1:
+        return dfs[0]
+    return pd.concat(dfs, ignore_index=True)
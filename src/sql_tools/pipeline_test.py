@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline tests, run over SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+from concurrent.futures import ProcessPoolExecutor
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+
+#%%
+
+def double_value(df):
+    df['VALUE'] = df['VALUE'] * 2
+    return df
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        self.sqlbase.init_database_connection('JobDB')
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER PRIMARY KEY, VALUE REAL)')
+        self.sqlbase.bulk_insert([(i, i * 0.5) for i in range(1000)],
+                                 'POINTBAS', columns=['ID', 'VALUE'])
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_ordered_process_pool(self):
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            df = self.sqlbase.pipeline_execute_sql('SELECT * FROM POINTBAS ORDER BY ID',
+                                                   transform=double_value,
+                                                   arraysize=64,
+                                                   executor=executor)
+        self.assertEqual(df['ID'].tolist(), list(range(1000)))
+        self.assertEqual(df['VALUE'].tolist(), [float(i) for i in range(1000)])
+        return None
+
+
+    def test_stream_inline_and_empty(self):
+
+        dfs = list(self.sqlbase.iter_pipeline_execute_sql('SELECT ID FROM POINTBAS WHERE ID < 250',
+                                                          arraysize=100,
+                                                          processes=0,
+                                                          max_pending=1))
+        self.assertEqual([len(df) for df in dfs], [100, 100, 50])
+
+        df = self.sqlbase.pipeline_execute_sql('SELECT ID, VALUE FROM POINTBAS WHERE ID < 0',
+                                               processes=0)
+        self.assertEqual(list(df.columns), ['ID', 'VALUE'])
+        self.assertEqual(len(df), 0)
+        return None
+
+
+    def test_error_and_early_close(self):
+
+        with self.assertRaises(Exception):
+            self.sqlbase.pipeline_execute_sql('SELECT * FROM Missing', processes=0)
+
+        batches = self.sqlbase.iter_pipeline_execute_sql('SELECT * FROM POINTBAS',
+                                                         arraysize=10,
+                                                         processes=0,
+                                                         max_pending=2)
+        next(batches)
+        batches.close()
+        # The pooled connection was returned
+        self.assertEqual(len(self.sqlbase.execute_sql('SELECT * FROM POINTBAS')), 1000)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded, thread-safe pool of DB-API connections. SQLBase keeps one pool per
+database so worker threads can share logged-in connections instead of
+serializing on a single connection or paying for a new login on every query
+
+@author: vorst
+"""
+
+# Python imports
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+from .retry import classify, CONNECTION, TIMEOUT
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+class PoolTimeoutError(Exception):
+    pass
+
+class PoolClosedError(Exception):
+    pass
+
+
+def drain_cursor(cursor):
+    """Discard the unread result sets of cursor. SQL Server (without MARS)
+    refuses the next statement on a connection with pending results"""
+    nextset = getattr(cursor, 'nextset', None)
+    if nextset is None:
+        return None
+    while nextset():
+        pass
+    return None
+
+
+class StatementCache:
+
+    def __init__(self, connection, max_size=32):
+        """A least recently used cache of cursors keyed by statement text for
+        one connection. Re-executing the same parameterized statement on the
+        same cursor lets pyodbc reuse the prepared statement handle instead
+        of preparing it again, and sending identical statement text lets the
+        server reuse its cached plan
+        inputs
+        -------
+        connection : DB-API connection which owns the cursors
+        max_size : (int) maximum number of cached cursors. The least recently
+            used cursor is closed when the cache is full"""
+        self.connection = connection
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cursors = OrderedDict()
+
+        return None
+
+
+    def cursor(self, sql):
+        """Return the cached cursor for statement sql, creating it if needed.
+        The cursor is owned by the cache and must not be closed by the caller"""
+        cursor = self._cursors.get(sql)
+        if cursor is not None:
+            self._cursors.move_to_end(sql)
+            self.hits += 1
+            return cursor
+
+        self.misses += 1
+        cursor = self.connection.cursor()
+        self._cursors[sql] = cursor
+        while len(self._cursors) > self.max_size:
+            _sql, evicted = self._cursors.popitem(last=False)
+            self._close_cursor(evicted)
+
+        return cursor
+
+
+    @contextmanager
+    def statement(self, sql):
+        """Borrow the cached cursor for sql for the duration of a with
+        block. When the block completes, unread result sets are drained. If
+        the block raises (or a generator holding the cursor is closed) the
+        results may be partly read, so the cursor is closed and forgotten"""
+        cursor = self.cursor(sql)
+        try:
+            yield cursor
+        except BaseException:
+            self.discard(sql, cursor)
+            raise
+        try:
+            drain_cursor(cursor)
+        except Exception as e:
+            logger.debug(e)
+            self.discard(sql, cursor)
+
+        return None
+
+
+    def discard(self, sql, cursor=None):
+        """Close and forget the cursor for sql, for example after it raised.
+        If cursor is given, only that cursor is discarded"""
+        cached = self._cursors.get(sql)
+        if cached is not None and (cursor is None or cached is cursor):
+            del self._cursors[sql]
+            self._close_cursor(cached)
+        elif cursor is not None:
+            # Already evicted from the cache
+            self._close_cursor(cursor)
+        return None
+
+
+    def close(self):
+        """Close every cached cursor"""
+        while self._cursors:
+            _sql, cursor = self._cursors.popitem()
+            self._close_cursor(cursor)
+        return None
+
+
+    @staticmethod
+    def _close_cursor(cursor):
+        try:
+            cursor.close()
+        except Exception as e:
+            logger.debug(e)
+        return None
+
+
+class ConnectionPool:
+
+    def __init__(self,
+                 connect,
+                 max_size=5,
+                 timeout=30,
+                 max_idle=300,
+                 ping_after=30,
+                 statement_cache_size=32,
+                 name=None,
+                 keep_idle=True):
+        """A bounded pool of connections created by 'connect'. Connections
+        are checked out with acquire() and returned with release(), or
+        borrowed for the duration of a with block with connection()
+        inputs
+        -------
+        connect : (callable) called with no arguments to open a new connection
+        max_size : (int) maximum number of connections open at once
+            (checked out + idle)
+        timeout : (float) default seconds to wait for a free connection when
+            the pool is exhausted. None waits forever
+        max_idle : (float) idle connections older than this many seconds are
+            closed instead of reused. None disables eviction
+        ping_after : (float) connections idle longer than this many seconds
+            are tested with a round trip before checkout. Connections idle
+            for less time only get the cheap 'closed' attribute check
+        statement_cache_size : (int) number of cursors cached per connection
+            by statement_cache(). See StatementCache
+        name : (str) used in log messages
+        keep_idle : (bool) keep released connections open for reuse. False
+            closes them on release, for connections which are pooled by the
+            driver (like SQLAlchemy pool proxies). The pool then only bounds
+            the number of connections in use"""
+
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1, got {}'.format(max_size))
+
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.statement_cache_size = statement_cache_size
+        self.name = name
+        self.keep_idle = keep_idle
+
+        self._lock = threading.Condition(threading.Lock())
+        # Idle connections as (connection, time returned). Most recently
+        # returned connections are on the right and are reused first
+        self._idle = deque()
+        self._checked_out = set()
+        self._closed = False
+        # StatementCache for each open connection, keyed by id(connection)
+        self._statements = {}
+        self._stats = {'hits':0,
+                       'misses':0,
+                       'creates':0,
+                       'waits':0,
+                       'timeouts':0,
+                       'evictions':0,
+                       'discards':0,
+                       'failed_pings':0,
+                       'statement_hits':0,
+                       'statement_misses':0}
+
+        return None
+
+
+    def acquire(self, timeout=None):
+        """Check out a connection. An idle connection is reused if one passes
+        the liveness check, otherwise a new connection is opened if the pool
+        is below max_size, otherwise wait for another thread to release one
+        inputs
+        -------
+        timeout : (float) seconds to wait for a free connection. Defaults to
+            the pool timeout
+        outputs
+        -------
+        connection : DB-API connection"""
+
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise PoolClosedError('Pool {} is closed'.format(self.name))
+
+                self._evict_idle()
+
+                if self._idle:
+                    connection, returned = self._idle.pop()
+                    # Reserve the slot before releasing the lock for the ping
+                    self._checked_out.add(id(connection))
+                    self._lock.release()
+                    try:
+                        alive = self._is_alive(connection, returned)
+                    finally:
+                        self._lock.acquire()
+                    if alive:
+                        self._stats['hits'] += 1
+                        return connection
+                    self._checked_out.discard(id(connection))
+                    self._stats['failed_pings'] += 1
+                    self._close_connection(connection)
+                    self._lock.notify()
+                    continue
+
+                if self._size() < self.max_size:
+                    self._stats['misses'] += 1
+                    # Reserve a slot while the (slow) login happens unlocked
+                    placeholder = object()
+                    self._checked_out.add(id(placeholder))
+                    self._lock.release()
+                    try:
+                        connection = self._connect()
+                    except Exception:
+                        self._lock.acquire()
+                        self._checked_out.discard(id(placeholder))
+                        self._lock.notify()
+                        raise
+                    self._lock.acquire()
+                    self._checked_out.discard(id(placeholder))
+                    self._checked_out.add(id(connection))
+                    self._stats['creates'] += 1
+                    return connection
+
+                # Pool exhausted - wait for a release
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._lock.wait(remaining):
+                        if self._idle or self._size() < self.max_size:
+                            continue
+                        self._stats['timeouts'] += 1
+                        msg = 'Timed out after {}s waiting for a connection from pool {}'
+                        raise PoolTimeoutError(msg.format(timeout, self.name))
+
+
+    def release(self, connection, discard=False):
+        """Return a connection to the pool
+        inputs
+        -------
+        connection : DB-API connection previously returned by acquire()
+        discard : (bool) close the connection instead of reusing it. Use this
+            after an error which may have left the connection unusable"""
+
+        with self._lock:
+            if id(connection) not in self._checked_out:
+                raise ValueError('Connection was not checked out from this pool')
+            self._checked_out.discard(id(connection))
+
+            if discard or self._closed or not self.keep_idle:
+                if discard:
+                    self._stats['discards'] += 1
+                self._close_connection(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+
+            self._lock.notify()
+
+        return None
+
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Borrow a connection for the duration of a with block. The
+        connection is discarded if the block raises a database error. The
+        connection is also returned when a generator holding it is closed"""
+        connection = self.acquire(timeout=timeout)
+        discard = False
+        try:
+            yield connection
+        except Exception as e:
+            discard = self._is_connection_error(e)
+            raise
+        finally:
+            self.release(connection, discard=discard)
+
+
+    def statement_cache(self, connection):
+        """Return the StatementCache of a checked out connection. The cache
+        lives as long as the connection and is closed with it"""
+        with self._lock:
+            if id(connection) not in self._checked_out:
+                raise ValueError('Connection was not checked out from this pool')
+            if id(connection) not in self._statements:
+                self._statements[id(connection)] = StatementCache(
+                    connection, max_size=self.statement_cache_size)
+            statements = self._statements[id(connection)]
+
+        return statements
+
+
+    def warmup(self, connections=1):
+        """Open connections until at least 'connections' idle connections are
+        available (bounded by max_size), so later checkouts do not wait for
+        a login"""
+        borrowed = []
+        try:
+            while len(borrowed) < min(connections, self.max_size):
+                with self._lock:
+                    if len(self._idle) + len(borrowed) >= connections:
+                        break
+                borrowed.append(self.acquire())
+        finally:
+            for connection in borrowed:
+                self.release(connection)
+
+        return None
+
+
+    def stats(self):
+        """Return a dictionary of pool counters and the current pool size.
+        'hits' are checkouts served from an idle connection, 'misses' are
+        checkouts which had to open a connection, 'waits' are checkouts
+        which blocked on an exhausted pool. 'statement_hits' are executions
+        which reused a cached (prepared) cursor"""
+        with self._lock:
+            stats = dict(self._stats)
+            for statements in self._statements.values():
+                stats['statement_hits'] += statements.hits
+                stats['statement_misses'] += statements.misses
+            stats['idle'] = len(self._idle)
+            stats['checked_out'] = len(self._checked_out)
+            stats['size'] = self._size()
+            stats['max_size'] = self.max_size
+
+        return stats
+
+
+    def close(self):
+        """Close all idle connections. Checked out connections are closed
+        when they are released"""
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                connection, _returned = self._idle.pop()
+                self._close_connection(connection)
+            self._lock.notify_all()
+
+        return None
+
+
+    def discard_idle(self):
+        """Close every idle connection. Use this after a lost connection
+        (for example a failover), when the other idle connections to the
+        same server are most likely broken too"""
+        with self._lock:
+            while self._idle:
+                connection, _returned = self._idle.pop()
+                self._stats['discards'] += 1
+                self._close_connection(connection)
+            self._lock.notify_all()
+
+        return None
+
+
+    def _size(self):
+        return len(self._idle) + len(self._checked_out)
+
+
+    def _evict_idle(self):
+        """Close idle connections older than max_idle. Call with the lock held"""
+        if self.max_idle is None:
+            return None
+
+        now = time.monotonic()
+        # Oldest connections are on the left
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            connection, _returned = self._idle.popleft()
+            self._stats['evictions'] += 1
+            self._close_connection(connection)
+
+        return None
+
+
+    def _is_alive(self, connection, returned):
+        """Cheap liveness check. A closed connection is never reused, and a
+        connection idle longer than ping_after is tested with a round trip"""
+        if getattr(connection, 'closed', False):
+            return False
+
+        if self.ping_after is not None and time.monotonic() - returned > self.ping_after:
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute('SELECT 1')
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+            except Exception as e:
+                logger.debug('Pool {} ping failed : {}'.format(self.name, e))
+                return False
+
+        return True
+
+
+    @staticmethod
+    def _is_connection_error(exception):
+        """DB-API drivers raise OperationalError / InterfaceError when the
+        connection itself is in trouble (as opposed to a bad statement). A
+        lost connection or timeout SQLSTATE also marks the connection as
+        unusable"""
+        if type(exception).__name__ in ('OperationalError', 'InterfaceError'):
+            return True
+        return classify(exception) in (CONNECTION, TIMEOUT)
+
+
+    def _close_connection(self, connection):
+        statements = self._statements.pop(id(connection), None)
+        if statements is not None:
+            self._stats['statement_hits'] += statements.hits
+            self._stats['statement_misses'] += statements.misses
+            statements.close()
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug('Pool {} close failed : {}'.format(self.name, e))
+        return None
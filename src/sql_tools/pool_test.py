@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Connection pool tests. These use in-memory sqlite3 connections so they do not
+need a SQL Server instance
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+import sqlite3
+import threading
+
+# local imports
+from sql_tools.pool import (ConnectionPool, StatementCache,
+                            PoolTimeoutError, PoolClosedError)
+
+#%%
+
+def _connect():
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+class _PendingCursor:
+    """Fake cursor with result sets left to read"""
+
+    def __init__(self, pending=2):
+        self.pending = pending
+        self.closed = False
+        return None
+
+    def execute(self, sql, *params):
+        return self
+
+    def nextset(self):
+        if self.pending:
+            self.pending -= 1
+            return True
+        return False
+
+    def close(self):
+        self.closed = True
+        return None
+
+
+class _PendingConnection:
+
+    def __init__(self):
+        self.cursors = []
+        return None
+
+    def cursor(self):
+        cursor = _PendingCursor()
+        self.cursors.append(cursor)
+        return cursor
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_reuse_connection(self):
+
+        pool = ConnectionPool(_connect, max_size=2)
+        connection = pool.acquire()
+        pool.release(connection)
+        connection2 = pool.acquire()
+
+        self.assertIs(connection, connection2)
+        stats = pool.stats()
+        self.assertEqual(stats['creates'], 1)
+        self.assertEqual(stats['hits'], 1)
+        return None
+
+
+    def test_timeout_when_exhausted(self):
+
+        pool = ConnectionPool(_connect, max_size=1, timeout=0.05)
+        connection = pool.acquire()
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        pool.release(connection)
+        return None
+
+
+    def test_wait_for_release(self):
+
+        pool = ConnectionPool(_connect, max_size=1, timeout=5)
+        connection = pool.acquire()
+        timer = threading.Timer(0.05, pool.release, args=(connection,))
+        timer.start()
+        connection2 = pool.acquire()
+
+        self.assertIs(connection, connection2)
+        self.assertEqual(pool.stats()['waits'], 1)
+        timer.join()
+        return None
+
+
+    def test_idle_eviction(self):
+
+        pool = ConnectionPool(_connect, max_size=2, max_idle=0)
+        connection = pool.acquire()
+        pool.release(connection)
+        connection2 = pool.acquire()
+
+        self.assertIsNot(connection, connection2)
+        self.assertEqual(pool.stats()['evictions'], 1)
+        return None
+
+
+    def test_failed_ping_replaces_connection(self):
+
+        pool = ConnectionPool(_connect, max_size=2, ping_after=0)
+        connection = pool.acquire()
+        pool.release(connection)
+        # A closed sqlite3 connection fails the ping query
+        connection.close()
+        connection2 = pool.acquire()
+
+        self.assertIsNot(connection, connection2)
+        self.assertEqual(pool.stats()['failed_pings'], 1)
+        return None
+
+
+    def test_discard_on_connection_error(self):
+
+        pool = ConnectionPool(_connect, max_size=1)
+        with self.assertRaises(sqlite3.OperationalError):
+            with pool.connection() as connection:
+                raise sqlite3.OperationalError('connection lost')
+
+        self.assertEqual(pool.stats()['discards'], 1)
+        self.assertEqual(pool.stats()['size'], 0)
+        return None
+
+
+    def test_warmup(self):
+
+        pool = ConnectionPool(_connect, max_size=3)
+        pool.warmup(5)
+
+        stats = pool.stats()
+        self.assertEqual(stats['idle'], 3)
+        self.assertEqual(stats['checked_out'], 0)
+        return None
+
+
+    def test_closed_pool(self):
+
+        pool = ConnectionPool(_connect)
+        pool.close()
+        with self.assertRaises(PoolClosedError):
+            pool.acquire()
+        return None
+
+
+class StatementCacheTest(unittest.TestCase):
+
+    def test_cursor_reuse(self):
+
+        statements = StatementCache(_connect(), max_size=2)
+        cursor = statements.cursor('SELECT ?')
+        cursor2 = statements.cursor('SELECT ?')
+
+        self.assertIs(cursor, cursor2)
+        self.assertEqual((statements.hits, statements.misses), (1, 1))
+        return None
+
+
+    def test_lru_eviction(self):
+
+        statements = StatementCache(_connect(), max_size=2)
+        cursor = statements.cursor('SELECT 1')
+        statements.cursor('SELECT 2')
+        statements.cursor('SELECT 3')
+
+        self.assertIsNot(cursor, statements.cursor('SELECT 1'))
+        self.assertEqual(statements.misses, 4)
+        return None
+
+
+    def test_pool_closes_statements(self):
+
+        pool = ConnectionPool(_connect, max_size=1)
+        with pool.connection() as connection:
+            pool.statement_cache(connection).cursor('SELECT 1')
+            pool.statement_cache(connection).cursor('SELECT 1')
+        pool.close()
+
+        stats = pool.stats()
+        self.assertEqual(stats['statement_hits'], 1)
+        self.assertEqual(stats['statement_misses'], 1)
+        return None
+
+
+    def test_statement_drains_results(self):
+
+        connection = _PendingConnection()
+        statements = StatementCache(connection)
+        with statements.statement('EXEC sp_who') as cursor:
+            pass
+        self.assertEqual(cursor.pending, 0)
+        self.assertFalse(cursor.closed)
+        # The drained cursor stays cached
+        self.assertIs(statements.cursor('EXEC sp_who'), cursor)
+        return None
+
+
+    def test_statement_discards_partly_read_cursor(self):
+
+        connection = _PendingConnection()
+        statements = StatementCache(connection)
+        with self.assertRaises(RuntimeError):
+            with statements.statement('SELECT * FROM POINTBAS') as cursor:
+                raise RuntimeError('fetch failed')
+        self.assertTrue(cursor.closed)
+        self.assertIsNot(statements.cursor('SELECT * FROM POINTBAS'), cursor)
+
+        def rows():
+            with statements.statement('SELECT 1') as cursor:
+                yield cursor
+        generator = rows()
+        cursor = next(generator)
+        generator.close()
+        self.assertTrue(cursor.closed)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Query profiling on SQL Server. A query is run with SET STATISTICS IO, TIME
+and/or XML ON; the informational messages of each result set
+(cursor.messages) and the actual plan result sets are collected and parsed
+into a ProfileReport : reads per table, server CPU and elapsed time, and the
+client execute and fetch time
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+import re
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+ProfileReport = namedtuple('ProfileReport',
+                           ['sql',
+                            'rows',
+                            'tables',
+                            'compile_cpu_ms',
+                            'compile_elapsed_ms',
+                            'cpu_ms',
+                            'elapsed_ms',
+                            'execute_ms',
+                            'fetch_ms',
+                            'plans',
+                            'messages'])
+ProfileReport.__doc__ = """Profile of one query. tables is a dict of
+{table : {counter : value}} with counters like 'scan_count',
+'logical_reads', 'physical_reads' and 'read_ahead_reads', summed over the
+statements of the batch. compile_* and cpu_ms / elapsed_ms are the server
+parse and compile and execution times (STATISTICS TIME, summed). execute_ms
+is the client time until the first result set was ready and fetch_ms the
+client time to fetch every row. plans is a list of actual plan XML strings
+(STATISTICS XML), one per statement. messages are the server messages with
+the driver prefix removed. Values which were not captured are None"""
+
+# '[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+_driver_prefix_re = re.compile(r'^(?:\[[^\]]*\])+\s*')
+_table_io_re = re.compile(r"Table '(?P<table>[^']+)'\. (?P<counters>[^.]*)")
+_counter_re = re.compile(r'(?P<name>[A-Za-z][A-Za-z\- ]*?) (?P<value>\d+)')
+_time_re = re.compile(r'CPU time = (?P<cpu>\d+) ms,\s*elapsed time = (?P<elapsed>\d+) ms')
+_compile_marker = 'parse and compile time'
+_execution_marker = 'Execution Times'
+_SHOWPLAN_COLUMN = 'Microsoft SQL Server 2005 XML Showplan'
+
+
+def clean_message(message):
+    """Text of a cursor.messages item, without the driver prefix"""
+    if isinstance(message, (tuple, list)):
+        message = message[-1]
+    return _driver_prefix_re.sub('', str(message)).strip()
+
+
+def parse_messages(messages):
+    """Parse STATISTICS IO and TIME messages
+    inputs
+    -------
+    messages : (iterable) of (str) server messages, without driver prefix
+    outputs
+    -------
+    stats : (dict) with keys 'tables', 'compile_cpu_ms', 'compile_elapsed_ms',
+        'cpu_ms', 'elapsed_ms'. Times are None if no such message was seen"""
+    tables = {}
+    times = {'compile':[None, None], 'execution':[None, None]}
+    section = None
+
+    for message in messages:
+        for line in message.splitlines():
+            if _compile_marker in line:
+                section = 'compile'
+            elif _execution_marker in line:
+                section = 'execution'
+
+            match = _time_re.search(line)
+            if match and section is not None:
+                totals = times[section]
+                totals[0] = (totals[0] or 0) + int(match.group('cpu'))
+                totals[1] = (totals[1] or 0) + int(match.group('elapsed'))
+                section = None
+                continue
+
+            match = _table_io_re.search(line)
+            if match:
+                counters = tables.setdefault(match.group('table'), {})
+                for counter in _counter_re.finditer(match.group('counters')):
+                    name = counter.group('name').strip().lower().replace('-', '_').replace(' ', '_')
+                    counters[name] = counters.get(name, 0) + int(counter.group('value'))
+
+    return {'tables':tables,
+            'compile_cpu_ms':times['compile'][0],
+            'compile_elapsed_ms':times['compile'][1],
+            'cpu_ms':times['execution'][0],
+            'elapsed_ms':times['execution'][1]}
+
+
+def summarize_plan(plan_xml):
+    """Summarize an actual plan (showplan XML)
+    outputs
+    -------
+    statements : (list) of (dict) with 'text', 'estimated_cost' and
+        'operators', a list of (dict) with 'physical_op', 'logical_op',
+        'estimated_rows' and 'actual_rows' (summed over threads) in plan
+        order"""
+    import xml.etree.ElementTree as ElementTree
+
+    namespace = {'p':'http://schemas.microsoft.com/sqlserver/2004/07/showplan'}
+    root = ElementTree.fromstring(plan_xml)
+    statements = []
+    for statement in root.iter('{%s}StmtSimple' % namespace['p']):
+        operators = []
+        for operator in statement.iter('{%s}RelOp' % namespace['p']):
+            counters = operator.findall('p:RunTimeInformation/p:RunTimeCountersPerThread', namespace)
+            actual = sum(int(counter.get('ActualRows', 0)) for counter in counters) if counters else None
+            operators.append({'physical_op':operator.get('PhysicalOp'),
+                              'logical_op':operator.get('LogicalOp'),
+                              'estimated_rows':float(operator.get('EstimateRows', 'nan')),
+                              'actual_rows':actual})
+        cost = statement.get('StatementSubTreeCost')
+        statements.append({'text':statement.get('StatementText'),
+                           'estimated_cost':None if cost is None else float(cost),
+                           'operators':operators})
+
+    return statements
+
+
+def _messages(cursor):
+    return [clean_message(message) for message in (getattr(cursor, 'messages', None) or ())]
+
+
+def _set_statistics(cursor, io, time_, plan, value):
+    options = [name for name, enabled in (('IO', io), ('TIME', time_), ('XML', plan)) if enabled]
+    if options:
+        cursor.execute('SET STATISTICS {} {}'.format(', '.join(options), value))
+        while cursor.nextset():
+            pass
+    return None
+
+
+def profile_query(sqlbase,
+                  sql_query,
+                  params=None,
+                  database_name=None,
+                  io=True,
+                  time_statistics=True,
+                  plan=False):
+    """Run a query with statistics on and return its rows and a profile
+    inputs
+    -------
+    sqlbase : (SQLBase) with a SQL Server backend
+    sql_query : (str) sql string to execute
+    params : (sequence) parameter values for the ? markers in sql_query
+    database_name : (str) database to query. Defaults to the database set by
+        init_database_connection
+    io : (bool) SET STATISTICS IO ON (reads per table)
+    time_statistics : (bool) SET STATISTICS TIME ON (server CPU and elapsed)
+    plan : (bool) SET STATISTICS XML ON (actual plans)
+    outputs
+    -------
+    rows : (list) of rows of the first result set ([] if none)
+    columns : (list) of (str) column names of the first result set
+    report : (ProfileReport)"""
+
+    sqlbase._require_sql_server('profile_sql')
+    database_name = sqlbase._resolve_database_name(database_name)
+    pool = sqlbase.get_pool(database_name)
+
+    rows = None
+    columns = []
+    plans = []
+    messages = []
+
+    connection = pool.acquire()
+    discard = False
+    try:
+        cursor = connection.cursor()
+        try:
+            _set_statistics(cursor, io, time_statistics, plan, 'ON')
+            try:
+                start = time.perf_counter()
+                sqlbase._execute_cursor(cursor, sql_query, params)
+                execute_ms = (time.perf_counter() - start) * 1000
+                messages.extend(_messages(cursor))
+
+                start = time.perf_counter()
+                while True:
+                    description = cursor.description
+                    if description is not None:
+                        if len(description) == 1 and description[0][0] == _SHOWPLAN_COLUMN:
+                            plans.extend(row[0] for row in cursor.fetchall())
+                        elif rows is None:
+                            columns = [column[0] for column in description]
+                            rows = cursor.fetchall()
+                        else:
+                            # Later result sets are drained, not returned
+                            cursor.fetchall()
+                    if not cursor.nextset():
+                        break
+                    messages.extend(_messages(cursor))
+                fetch_ms = (time.perf_counter() - start) * 1000
+            finally:
+                # A connection with statistics still on must not return to
+                # the pool. Failing here must not hide the query's own error
+                try:
+                    _set_statistics(cursor, io, time_statistics, plan, 'OFF')
+                except Exception as e:
+                    logger.warning('Could not set statistics off, discarding the connection : {}'.format(e))
+                    discard = True
+        finally:
+            cursor.close()
+        connection.commit()
+    except Exception as e:
+        discard = discard or pool._is_connection_error(e)
+        raise
+    finally:
+        pool.release(connection, discard=discard)
+
+    rows = [] if rows is None else rows
+    stats = parse_messages(messages)
+    report = ProfileReport(sql_query,
+                           len(rows),
+                           stats['tables'],
+                           stats['compile_cpu_ms'],
+                           stats['compile_elapsed_ms'],
+                           stats['cpu_ms'],
+                           stats['elapsed_ms'],
+                           execute_ms,
+                           fetch_ms,
+                           plans,
+                           messages)
+    logger.debug('Profiled query : server cpu {} ms, elapsed {} ms, client fetch {:.1f} ms'.format(
+        report.cpu_ms, report.elapsed_ms, report.fetch_ms))
+
+    return rows, columns, report
+
+
+def format_report(report):
+    """Multi-line text summary of a ProfileReport"""
+    lines = ['rows : {}'.format(report.rows),
+             'server cpu : {} ms, elapsed : {} ms (compile cpu {} ms, elapsed {} ms)'.format(
+                 report.cpu_ms, report.elapsed_ms, report.compile_cpu_ms, report.compile_elapsed_ms),
+             'client execute : {:.1f} ms, fetch : {:.1f} ms'.format(report.execute_ms, report.fetch_ms)]
+    for table, counters in sorted(report.tables.items(),
+                                  key=lambda item: -item[1].get('logical_reads', 0)):
+        lines.append('table {} : {}'.format(table, ', '.join(
+            '{} {}'.format(name, value) for name, value in counters.items())))
+
+    return '\n'.join(lines)
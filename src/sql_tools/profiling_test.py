@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling tests. Messages and plans are parsed from captured SQL Server
+output, so no server is needed
+
+@author: vorst
+"""
+
+# Python imports
+import sqlite3
+import unittest
+from unittest import mock
+
+# local imports
+from sql_tools.profiling import clean_message, parse_messages, summarize_plan
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+
+#%%
+
+MESSAGES = [
+    ('[01000] (0)', '[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+     'SQL Server parse and compile time: \n   CPU time = 3 ms, elapsed time = 4 ms.'),
+    ('[01000] (0)', "[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]Table 'POINTBAS'. "
+     'Scan count 1, logical reads 120, physical reads 2, page server reads 0, '
+     'read-ahead reads 118, lob logical reads 0.'),
+    ('[01000] (0)', "[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]Table 'Worktable'. "
+     'Scan count 0, logical reads 0, physical reads 0.'),
+    ('[01000] (0)', '[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+     'SQL Server Execution Times:'),
+    ('[01000] (0)', '[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+     '   CPU time = 15 ms,  elapsed time = 41 ms.'),
+    ('[01000] (0)', "[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]Table 'POINTBAS'. "
+     'Scan count 1, logical reads 5, physical reads 0.'),
+]
+
+PLAN = """<ShowPlanXML xmlns="http://schemas.microsoft.com/sqlserver/2004/07/showplan">
+<BatchSequence><Batch><Statements>
+<StmtSimple StatementText="SELECT * FROM POINTBAS" StatementSubTreeCost="0.25">
+<QueryPlan><RelOp PhysicalOp="Clustered Index Scan" LogicalOp="Clustered Index Scan" EstimateRows="1000">
+<RunTimeInformation>
+<RunTimeCountersPerThread Thread="1" ActualRows="600" />
+<RunTimeCountersPerThread Thread="2" ActualRows="400" />
+</RunTimeInformation>
+</RelOp></QueryPlan>
+</StmtSimple>
+</Statements></Batch></BatchSequence>
+</ShowPlanXML>"""
+
+class _StatisticsCursor:
+    """SQLite cursor which accepts SET STATISTICS, optionally failing to turn
+    statistics off"""
+
+    def __init__(self, connection, cursor):
+        self._connection = connection
+        self._cursor = cursor
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, sql, *args):
+        if sql.startswith('SET STATISTICS'):
+            if sql.endswith('OFF') and self._connection.fail_off:
+                raise sqlite3.OperationalError('statistics off failed')
+            return self
+        self._cursor.execute(sql, *args)
+        return self
+
+    def nextset(self):
+        return False
+
+
+class _StatisticsConnection:
+
+    def __init__(self, connection, fail_off):
+        self._connection = connection
+        self.fail_off = fail_off
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return _StatisticsCursor(self, self._connection.cursor())
+
+
+class _StatisticsBackend(SQLiteBackend):
+
+    is_sql_server = True
+
+    def __init__(self):
+        super().__init__()
+        self.fail_off = False
+        return None
+
+    def connect(self, database_name):
+        return _StatisticsConnection(super().connect(database_name), self.fail_off)
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def test_parse_messages(self):
+
+        stats = parse_messages([clean_message(message) for message in MESSAGES])
+
+        self.assertEqual(stats['tables']['POINTBAS'],
+                         {'scan_count':2, 'logical_reads':125, 'physical_reads':2,
+                          'page_server_reads':0, 'read_ahead_reads':118,
+                          'lob_logical_reads':0})
+        self.assertEqual(stats['tables']['Worktable']['logical_reads'], 0)
+        self.assertEqual((stats['compile_cpu_ms'], stats['compile_elapsed_ms']), (3, 4))
+        self.assertEqual((stats['cpu_ms'], stats['elapsed_ms']), (15, 41))
+        self.assertIsNone(parse_messages([])['cpu_ms'])
+        return None
+
+
+    def test_summarize_plan(self):
+
+        statement, = summarize_plan(PLAN)
+        self.assertEqual(statement['estimated_cost'], 0.25)
+        self.assertEqual(statement['operators'][0]['actual_rows'], 1000)
+        self.assertEqual(statement['operators'][0]['physical_op'], 'Clustered Index Scan')
+        return None
+
+
+    def test_requires_sql_server(self):
+
+        backend = SQLiteBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        try:
+            with self.assertRaises(NotImplementedError):
+                sqlbase.profile_sql('SELECT 1', database_name='JobDB')
+        finally:
+            sqlbase.close()
+            backend.close()
+        return None
+
+
+    def test_statistics_off_failure(self):
+
+        backend = _StatisticsBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        try:
+            sqlbase.init_database_connection('JobDB')
+            sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)')
+            sqlbase.execute_sql("INSERT INTO POINTBAS VALUES (1, 'JHW')")
+            backend.fail_off = True
+            # New connections fail to set statistics off
+            sqlbase.get_pool('JobDB').discard_idle()
+            discards = sqlbase.pool_stats()['JobDB']['discards']
+
+            # The query's own error is raised, not the failed OFF statement
+            with self.assertLogs('sql_tools.profiling', 'WARNING'):
+                with self.assertRaises(sqlite3.OperationalError) as context:
+                    sqlbase.profile_sql('SELECT * FROM MISSING_TABLE')
+            self.assertIn('MISSING_TABLE', str(context.exception))
+
+            # A successful query still discards the connection
+            with self.assertLogs('sql_tools.profiling', 'WARNING'):
+                rows, report = sqlbase.profile_sql('SELECT * FROM POINTBAS')
+            self.assertEqual([tuple(row) for row in rows], [(1, 'JHW')])
+            stats = sqlbase.pool_stats()['JobDB']
+            self.assertEqual(stats['discards'], discards + 2)
+            self.assertEqual((stats['idle'], stats['checked_out']), (0, 0))
+        finally:
+            sqlbase.close()
+            backend.close()
+        return None
+
+
+    def test_invalidates_after_write(self):
+
+        backend = _StatisticsBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        try:
+            sqlbase.init_database_connection('JobDB')
+            sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)')
+            sqlbase.execute_sql("INSERT INTO POINTBAS VALUES (1, 'JHW')")
+            cache = sqlbase.enable_query_cache()
+
+            self.assertEqual(sqlbase.execute_sql('SELECT NAME FROM POINTBAS')[0][0], 'JHW')
+            sqlbase.profile_sql("UPDATE POINTBAS SET NAME = 'AHU'")
+            self.assertEqual(cache.stats()['entries'], 0)
+            self.assertEqual(sqlbase.execute_sql('SELECT NAME FROM POINTBAS')[0][0], 'AHU')
+
+            # DDL discards the table metadata
+            with mock.patch.object(sqlbase.metadata, 'invalidate') as invalidate:
+                sqlbase.profile_sql('ALTER TABLE POINTBAS ADD COLUMN VALUE REAL')
+            invalidate.assert_called_once_with('JobDB')
+        finally:
+            sqlbase.close()
+            backend.close()
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
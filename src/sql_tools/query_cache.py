@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+An opt-in cache of read-only query results. Entries are keyed by
+(database, normalized SQL, parameters), evicted least recently used when the
+entry count or estimated memory bound is reached, and expire after a TTL.
+Entries are invalidated per table when a write goes through SQLBase, and per
+database when the database is attached or detached
+
+@author: vorst
+"""
+
+# Python imports
+from collections import OrderedDict
+from collections.abc import Mapping
+import itertools
+import re
+import sys
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+MISSING = object()
+
+_read_only_re = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_write_keyword_re = re.compile(
+    r'\b(INSERT|UPDATE|DELETE|MERGE|INTO|EXEC|EXECUTE|CREATE|ALTER|DROP|TRUNCATE)\b',
+    re.IGNORECASE)
+_whitespace_re = re.compile(r'\s+')
+# A string literal, bracketed or quoted identifier, each kept verbatim
+_quoted_re = re.compile(r"(N?'[^']*(?:''[^']*)*'|\[[^\]]*(?:\]\][^\]]*)*\]|\"[^\"]*(?:\"\"[^\"]*)*\")")
+# An object name, optionally qualified, each part bare or in brackets
+_name = r'(?:\[[^\]]*(?:\]\][^\]]*)*\]|[\w#@$]+)'
+_table_re = re.compile(
+    r'\b(?:FROM|JOIN|INTO|UPDATE|MERGE|TABLE)\s+((?:' + _name + r'\s*\.\s*){0,3}' + _name + r')',
+    re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """Collapse whitespace and strip a trailing semicolon so formatting
+    differences do not produce different cache keys. String literals and
+    quoted identifiers are left as written"""
+    # Odd parts are the quoted sections matched by _quoted_re
+    parts = _quoted_re.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = _whitespace_re.sub(' ', parts[i])
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def is_read_only(sql):
+    """True if sql is a plain SELECT (or WITH ... SELECT) statement which can
+    be cached. Statements mentioning write keywords (including SELECT INTO
+    and EXEC) are treated as writes"""
+    return bool(_read_only_re.match(sql)) and not _write_keyword_re.search(sql)
+
+
+def referenced_tables(sql):
+    """Return the set of (lower case, unqualified) table names following
+    FROM, JOIN, INTO, UPDATE, MERGE or TABLE in sql. This is a heuristic; an
+    empty set means the tables could not be determined"""
+    tables = set()
+    for match in _table_re.finditer(sql):
+        last = re.split(r'\s*\.\s*(?=(?:\[|[\w#@$]))', match.group(1))[-1]
+        if last.startswith('['):
+            last = last[1:-1].replace(']]', ']')
+        tables.add(last.lower())
+
+    return tables
+
+
+def estimate_size(value):
+    """Estimate the memory used by a cached result in bytes. DataFrames report
+    their own usage; columnar results (a dict of arrays) are summed per
+    column; row lists are estimated from a sample of rows"""
+    if hasattr(value, 'memory_usage') and hasattr(value, 'columns'):
+        return int(value.memory_usage(index=True, deep=True).sum())
+
+    if isinstance(value, Mapping):
+        return sys.getsizeof(value) + sum(
+            sys.getsizeof(name) + _estimate_array_size(column)
+            for name, column in value.items())
+
+    try:
+        n_rows = len(value)
+    except TypeError:
+        return sys.getsizeof(value)
+
+    sample = list(itertools.islice(value, 100))
+    if not sample:
+        return sys.getsizeof(value)
+    sample_size = 0
+    for row in sample:
+        sample_size += sys.getsizeof(row)
+        try:
+            sample_size += sum(sys.getsizeof(item) for item in row)
+        except TypeError:
+            pass
+
+    return sys.getsizeof(value) + sample_size * n_rows // len(sample)
+
+
+def _estimate_array_size(column):
+    """Bytes used by one column of a columnar result. Object arrays hold
+    pointers, so the objects they point to are estimated from a sample"""
+    nbytes = getattr(column, 'nbytes', None)
+    if nbytes is None:
+        return estimate_size(column)
+    if getattr(column, 'dtype', None) is None or column.dtype.kind != 'O' or not len(column):
+        return int(nbytes)
+
+    sample = column[:100]
+    sample_size = sum(sys.getsizeof(item) for item in sample)
+    return int(nbytes) + sample_size * len(column) // len(sample)
+
+
+class QueryCache:
+
+    def __init__(self, max_entries=256, max_bytes=256 * 2**20, ttl=300):
+        """Least recently used cache of query results
+        inputs
+        -------
+        max_entries : (int) maximum number of cached results
+        max_bytes : (int) maximum estimated memory of all cached results.
+            Results larger than this are not cached
+        ttl : (float) seconds a result stays valid. None never expires"""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # {key : (value, size, expires, tables)}
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits':0,
+                       'misses':0,
+                       'evictions':0,
+                       'expirations':0,
+                       'invalidations':0}
+
+        return None
+
+
+    @staticmethod
+    def make_key(database_name, sql, params=None, kind='rows'):
+        """Cache key for a query. kind separates results of the same query in
+        different shapes (rows, DataFrame). Named parameters (a mapping) are
+        keyed by their sorted items. Returns None if the parameters are not
+        hashable (like a list or bytearray value); such queries are not
+        cached"""
+        try:
+            if isinstance(params, Mapping):
+                params = tuple(sorted(params.items()))
+            elif params is not None:
+                params = tuple(params)
+            key = (database_name, normalize_sql(sql), params, kind)
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+
+    def get(self, key):
+        """Return the cached value for key, or MISSING"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return MISSING
+
+            value, _size, expires, _tables = entry
+            if expires is not None and time.monotonic() >= expires:
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return MISSING
+
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+
+        return value
+
+
+    def put(self, key, value, tables=None):
+        """Cache value under key. tables is the set of table names the query
+        reads, used by invalidate_tables. If tables is empty or None the
+        entry is only invalidated with its whole database"""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return None
+
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires, frozenset(tables or ()))
+            self._bytes += size
+
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+        return None
+
+
+    def invalidate_database(self, database_name):
+        """Remove every entry for database_name"""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == database_name]
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+
+        return None
+
+
+    def invalidate_tables(self, database_name, tables):
+        """Remove entries for database_name which read any of tables, and
+        entries whose tables are unknown. If tables is empty every entry for
+        the database is removed"""
+        tables = {table.lower() for table in tables}
+        if not tables:
+            return self.invalidate_database(database_name)
+
+        with self._lock:
+            keys = [key for key, entry in self._entries.items()
+                    if key[0] == database_name and
+                    (not entry[3] or entry[3] & tables)]
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+
+        return None
+
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+        return None
+
+
+    def stats(self):
+        """Return a dictionary of hit, miss, eviction, expiration and
+        invalidation counters and the current entry count and size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+
+        return stats
+
+
+    def _remove(self, key):
+        """Call with the lock held"""
+        _value, size, _expires, _tables = self._entries.pop(key)
+        self._bytes -= size
+        return None
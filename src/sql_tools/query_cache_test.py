@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Query result cache tests
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+
+# Third party imports
+import numpy as np
+
+# local imports
+from sql_tools.query_cache import (QueryCache, MISSING, is_read_only,
+                                   referenced_tables, normalize_sql, estimate_size)
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+
+#%%
+
+class QueryCacheTest(unittest.TestCase):
+
+    def test_sql_helpers(self):
+
+        self.assertEqual(normalize_sql('SELECT *\n   FROM [POINTBAS];'),
+                         'SELECT * FROM [POINTBAS]')
+        self.assertTrue(is_read_only('select top(10) * from [POINTBAS]'))
+        self.assertFalse(is_read_only('SELECT * INTO #tmp FROM [POINTBAS]'))
+        self.assertFalse(is_read_only('UPDATE [POINTBAS] SET NAME = ?'))
+        self.assertEqual(referenced_tables('SELECT * FROM [JobDB].[dbo].[POINTBAS] AS p '
+                                           'JOIN dbo.NETDEV n ON p.ID = n.ID'),
+                         {'pointbas', 'netdev'})
+        # Whitespace inside literals and quoted names is kept
+        self.assertEqual(normalize_sql("SELECT  [A  B] FROM t WHERE NAME = 'JHW  AHU'"),
+                         "SELECT [A  B] FROM t WHERE NAME = 'JHW  AHU'")
+        self.assertEqual(normalize_sql("SELECT 'it''s  ok',\n  \"C  D\"  FROM t"),
+                         "SELECT 'it''s  ok', \"C  D\" FROM t")
+        return None
+
+
+    def test_literal_whitespace_keys(self):
+
+        backend = SQLiteBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        try:
+            sqlbase.init_database_connection('JobDB')
+            sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)')
+            sqlbase.bulk_insert([(1, 'a b'), (2, 'a  b')], 'POINTBAS', columns=['ID', 'NAME'])
+            cache = sqlbase.enable_query_cache()
+
+            self.assertEqual(sqlbase.execute_sql("SELECT ID FROM POINTBAS WHERE NAME = 'a b'"),
+                             [(1,)])
+            self.assertEqual(sqlbase.execute_sql("SELECT ID FROM POINTBAS WHERE NAME = 'a  b'"),
+                             [(2,)])
+            self.assertEqual(cache.stats()['entries'], 2)
+        finally:
+            sqlbase.close()
+            backend.close()
+        return None
+
+
+    def test_columnar_size(self):
+
+        n = 1_000_000
+        columns = {'ID':np.arange(n, dtype=np.int64),
+                   'VALUE':np.zeros(n, dtype=np.float64),
+                   'NAME':np.array(['JHW.AHU{}'.format(i % 10) for i in range(n)],
+                                   dtype=object)}
+        cache = QueryCache(max_bytes=16 * 2**20)
+        # The arrays, not just the column names, are measured
+        self.assertGreater(estimate_size(columns), 16 * 2**20)
+
+        # Too large to cache at all
+        cache.put(('db', 'a', None, 'columns'), columns)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+        # Smaller results evict each other once the bound is reached
+        small = {name:column[:n // 8] for name, column in columns.items()}
+        for i in range(4):
+            cache.put(('db', str(i), None, 'columns'), small)
+        stats = cache.stats()
+        self.assertLess(stats['entries'], 4)
+        self.assertGreater(stats['evictions'], 0)
+        self.assertLessEqual(stats['bytes'], 16 * 2**20)
+        return None
+
+
+    def test_lru_eviction(self):
+
+        cache = QueryCache(max_entries=2)
+        cache.put(('db', 'a', None, 'rows'), [(1,)])
+        cache.put(('db', 'b', None, 'rows'), [(2,)])
+        cache.get(('db', 'a', None, 'rows'))
+        cache.put(('db', 'c', None, 'rows'), [(3,)])
+
+        self.assertIs(cache.get(('db', 'b', None, 'rows')), MISSING)
+        self.assertEqual(cache.get(('db', 'a', None, 'rows')), [(1,)])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        return None
+
+
+    def test_ttl(self):
+
+        cache = QueryCache(ttl=0)
+        key = cache.make_key('db', 'SELECT 1')
+        cache.put(key, [(1,)])
+
+        self.assertIs(cache.get(key), MISSING)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        return None
+
+
+    def test_invalidate_tables(self):
+
+        cache = QueryCache()
+        points = cache.make_key('db', 'SELECT * FROM POINTBAS')
+        devices = cache.make_key('db', 'SELECT * FROM NETDEV')
+        other = cache.make_key('db2', 'SELECT * FROM POINTBAS')
+        cache.put(points, [], {'pointbas'})
+        cache.put(devices, [], {'netdev'})
+        cache.put(other, [], {'pointbas'})
+        cache.invalidate_tables('db', ['POINTBAS'])
+
+        self.assertIs(cache.get(points), MISSING)
+        self.assertEqual(cache.get(devices), [])
+        self.assertEqual(cache.get(other), [])
+
+        cache.invalidate_database('db')
+        self.assertIs(cache.get(devices), MISSING)
+        return None
+
+
+
+    def test_make_key(self):
+
+        sql = 'SELECT * FROM POINTBAS WHERE ID = :id AND NAME = :name'
+        self.assertEqual(QueryCache.make_key('db', sql, {'id':1, 'name':'JHW'}),
+                         QueryCache.make_key('db', sql, {'name':'JHW', 'id':1}))
+        self.assertNotEqual(QueryCache.make_key('db', sql, {'id':1, 'name':'JHW'}),
+                            QueryCache.make_key('db', sql, {'id':2, 'name':'JHW'}))
+        self.assertEqual(QueryCache.make_key('db', 'SELECT ?', [1])[2], (1,))
+        # Unhashable values are not cached
+        self.assertIsNone(QueryCache.make_key('db', 'SELECT ?', [[1, 2]]))
+        self.assertIsNone(QueryCache.make_key('db', 'SELECT ?', [bytearray(b'JHW')]))
+        self.assertIsNone(QueryCache.make_key('db', sql, {'id':[1], 'name':'JHW'}))
+        return None
+
+
+    def test_sqlbase_invalidation(self):
+
+        backend = SQLiteBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        try:
+            sqlbase.init_database_connection('JobDB')
+            sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)')
+            sqlbase.bulk_insert([(1, 'JHW')], 'POINTBAS', columns=['ID', 'NAME'])
+            cache = sqlbase.enable_query_cache()
+            sql = 'SELECT NAME FROM POINTBAS'
+
+            # An unhashable parameter runs the query without caching it
+            rows = sqlbase.execute_sql('SELECT COUNT(*) FROM POINTBAS WHERE NAME <> ?',
+                                       params=[bytearray(b'AHU')])
+            self.assertEqual(rows[0][0], 1)
+            self.assertEqual(cache.stats()['entries'], 0)
+
+            updates = [
+                lambda: list(sqlbase.execute_sql_batches("UPDATE POINTBAS SET NAME = 'AHU1'")),
+                lambda: list(sqlbase.pandas_execute_sql_chunks("UPDATE POINTBAS SET NAME = 'AHU2'")),
+                lambda: sqlbase.execute_sql("UPDATE POINTBAS SET NAME = 'AHU3'")]
+            for name, update in zip(['AHU1', 'AHU2', 'AHU3'], updates):
+                sqlbase.execute_sql(sql)
+                self.assertEqual(cache.stats()['entries'], 1)
+                update()
+                self.assertEqual(cache.stats()['entries'], 0)
+                self.assertEqual(sqlbase.execute_sql(sql)[0][0], name)
+
+            # DDL through the generators discards the table metadata
+            self.assertEqual(len(sqlbase.get_table('POINTBAS').columns), 2)
+            list(sqlbase.execute_sql_batches('ALTER TABLE POINTBAS ADD COLUMN VALUE REAL'))
+            self.assertEqual(len(sqlbase.get_table('POINTBAS').columns), 3)
+        finally:
+            sqlbase.close()
+            backend.close()
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
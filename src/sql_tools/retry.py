@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Retry transient SQL Server errors with jittered exponential backoff. Errors
+are classified from the ODBC SQLSTATE and the SQL Server native error number
+(deadlock victim, lost connection, timeout). Reads are replayed on any
+transient error; statements which are not idempotent are only replayed
+after a deadlock, because the server has already rolled them back
+
+@author: vorst
+"""
+
+# Python imports
+import random
+import re
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+DEADLOCK = 'deadlock'
+CONNECTION = 'connection'
+TIMEOUT = 'timeout'
+
+# SQLSTATE (pyodbc reports it as exception.args[0]) to reason. Class 08 is
+# handled as a prefix
+SQLSTATES = {'40001':DEADLOCK,
+             'HYT00':TIMEOUT,
+             'HYT01':TIMEOUT}
+
+# SQL Server native error numbers to reason
+NATIVE_ERRORS = {1205:DEADLOCK,
+                 1222:TIMEOUT,
+                 # Network and transport errors
+                 64:CONNECTION,
+                 233:CONNECTION,
+                 10053:CONNECTION,
+                 10054:CONNECTION,
+                 10060:CONNECTION,
+                 # Database in transition (failover, restarting)
+                 40197:CONNECTION,
+                 40501:CONNECTION,
+                 40613:CONNECTION}
+
+# The native error closes each diagnostic record of a pyodbc message, before
+# the ODBC function name, the '; [' of the next record or the end, like
+# '... Rerun the transaction. (1205) (SQLExecDirectW); [01000] ... (3621)'.
+# Parenthesized numbers inside the text (data values) are not matched
+_native_error_re = re.compile(r'\((\d+)\)(?=\s*(?:\(SQL\w+\)|;\s*\[|$))')
+
+
+def sqlstate(exception):
+    """Return the SQLSTATE of a pyodbc error, or None"""
+    args = getattr(exception, 'args', ())
+    if args and isinstance(args[0], str) and len(args[0]) == 5:
+        return args[0]
+    return None
+
+
+def native_errors(exception):
+    """Return the set of SQL Server native error numbers in the message of a
+    pyodbc error, like 1205 in '... Rerun the transaction. (1205) (SQLExecDirectW)'"""
+    args = getattr(exception, 'args', ())
+    if len(args) > 1 and isinstance(args[1], str):
+        message = args[1]
+    else:
+        message = str(exception)
+    return {int(number) for number in _native_error_re.findall(message.strip())}
+
+
+def classify(exception):
+    """Return why exception is transient : 'deadlock', 'connection' or
+    'timeout', or None if it is not transient"""
+    state = sqlstate(exception)
+    if state is not None:
+        if state.startswith('08'):
+            return CONNECTION
+        if state in SQLSTATES:
+            return SQLSTATES[state]
+
+    for number in native_errors(exception):
+        if number in NATIVE_ERRORS:
+            return NATIVE_ERRORS[number]
+
+    return None
+
+
+class RetryPolicy:
+
+    def __init__(self,
+                 max_attempts=3,
+                 base_delay=0.2,
+                 max_delay=5,
+                 max_elapsed=60,
+                 retry_writes_on=(DEADLOCK,),
+                 on_retry=None):
+        """When and how often to replay a statement after a transient error
+        inputs
+        -------
+        max_attempts : (int) total attempts including the first. 1 disables
+            retries
+        base_delay : (float) backoff before the first retry in seconds. The
+            backoff doubles each retry up to max_delay, and the actual sleep
+            is drawn uniformly between 0 and the backoff (full jitter) so
+            many workers hit by the same incident do not retry in lockstep
+        max_delay : (float) maximum backoff in seconds
+        max_elapsed : (float) no retry is started after this many seconds
+            since the first attempt. None for no limit
+        retry_writes_on : (iterable) reasons for which statements which are
+            not idempotent are replayed
+        on_retry : (callable) called as on_retry(attempt, reason, exception,
+            delay) before each retry sleep"""
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1, got {}'.format(max_attempts))
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.retry_writes_on = frozenset(retry_writes_on)
+        self.on_retry = on_retry
+
+        self._lock = threading.Lock()
+        self._stats = {'calls':0,
+                       'retries':0,
+                       'recovered':0,
+                       'exhausted':0,
+                       'not_retried':0,
+                       'sleep_seconds':0.0,
+                       DEADLOCK:0,
+                       CONNECTION:0,
+                       TIMEOUT:0}
+
+        return None
+
+
+    def backoff(self, attempt):
+        """Seconds to sleep before retry number attempt (1 for the first)"""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+    def call(self, operation, idempotent=True, on_retry=None):
+        """Call operation() and return its result, replaying it after
+        transient errors. operation must acquire its own connection so a
+        replay runs on a fresh one
+        inputs
+        -------
+        operation : (callable) called with no arguments
+        idempotent : (bool) True if replaying operation cannot apply a change
+            twice (reads)
+        on_retry : (callable) called as on_retry(attempt, reason, exception,
+            delay) before each retry, after the policy on_retry
+        outputs
+        -------
+        result : return value of operation"""
+        with self._lock:
+            self._stats['calls'] += 1
+
+        start = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                result = operation()
+            except Exception as e:
+                reason = classify(e)
+                if reason is None:
+                    raise
+                if not (idempotent or reason in self.retry_writes_on):
+                    self._count('not_retried')
+                    raise
+                elapsed = time.monotonic() - start
+                if (attempt >= self.max_attempts or
+                    (self.max_elapsed is not None and elapsed >= self.max_elapsed)):
+                    self._count('exhausted')
+                    logger.warning('Giving up after {} attempts ({}) : {}'.format(attempt, reason, e))
+                    raise
+
+                delay = self.backoff(attempt)
+                with self._lock:
+                    self._stats['retries'] += 1
+                    self._stats[reason] += 1
+                    self._stats['sleep_seconds'] += delay
+                logger.info('Attempt {} failed ({}), retrying in {:.2f}s : {}'.format(
+                    attempt, reason, delay, e))
+                for callback in (self.on_retry, on_retry):
+                    if callback is not None:
+                        callback(attempt, reason, e, delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if attempt > 1:
+                self._count('recovered')
+            return result
+
+
+    def stats(self):
+        """Return a dictionary of retry counters. 'retries' counts replays,
+        'recovered' calls which succeeded after a retry, 'exhausted' calls
+        which failed after the last allowed attempt, 'not_retried' transient
+        failures of statements which are not idempotent. The 'deadlock',
+        'connection' and 'timeout' keys count retries by reason"""
+        with self._lock:
+            return dict(self._stats)
+
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+        return None
+
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Retry policy tests. Transient errors are raised with pyodbc style arguments
+(SQLSTATE, message) so no SQL Server instance is needed
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+import sqlite3
+
+# local imports
+from sql_tools.retry import RetryPolicy, classify, native_errors
+from sql_tools.pool import ConnectionPool
+
+#%%
+
+class Error(Exception):
+    pass
+
+DEADLOCK = Error('40001', '[40001] [Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+                 'Transaction (Process ID 57) was deadlocked on lock resources with another '
+                 'process and has been chosen as the deadlock victim. Rerun the transaction. '
+                 '(1205) (SQLExecDirectW)')
+LINK_FAILURE = Error('08S01', '[08S01] [Microsoft][ODBC Driver 17 for SQL Server]'
+                     'Communication link failure (0) (SQLExecDirectW)')
+SYNTAX = Error('42000', "[42000] [Microsoft][ODBC Driver 17 for SQL Server][SQL Server]"
+               "Incorrect syntax near 'FORM'. (102) (SQLExecDirectW)")
+# Data values quoted in the message look like transient native errors
+DUPLICATE_KEY = Error('23000', "[23000] [Microsoft][ODBC Driver 17 for SQL Server][SQL Server]"
+                      "Violation of PRIMARY KEY constraint 'PK_POINTBAS'. Cannot insert duplicate "
+                      "key in object 'dbo.POINTBAS'. The duplicate key value is (10054). (2627) "
+                      "(SQLExecDirectW); [23000] [Microsoft][ODBC Driver 17 for SQL Server]"
+                      "[SQL Server]The statement has been terminated. (3621)")
+
+
+def _failing(errors, result='ok'):
+    """Return an operation which raises each error in errors in turn, then
+    returns result"""
+    errors = list(errors)
+    def operation():
+        if errors:
+            raise errors.pop(0)
+        return result
+    return operation
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_classify(self):
+
+        self.assertEqual(classify(DEADLOCK), 'deadlock')
+        self.assertEqual(classify(LINK_FAILURE), 'connection')
+        self.assertEqual(classify(Error('HYT00', '[HYT00] Query timeout expired (0)')), 'timeout')
+        self.assertIsNone(classify(SYNTAX))
+        self.assertIsNone(classify(DUPLICATE_KEY))
+        self.assertEqual(native_errors(DUPLICATE_KEY), {2627, 3621})
+        self.assertIsNone(classify(ValueError('bad value')))
+        return None
+
+
+    def test_replay_reads(self):
+
+        retried = []
+        policy = RetryPolicy(max_attempts=3, base_delay=0)
+        result = policy.call(_failing([LINK_FAILURE, DEADLOCK]),
+                             on_retry=lambda *args: retried.append(args[1]))
+
+        self.assertEqual(result, 'ok')
+        self.assertEqual(retried, ['connection', 'deadlock'])
+        stats = policy.stats()
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['recovered'], 1)
+        return None
+
+
+    def test_give_up(self):
+
+        policy = RetryPolicy(max_attempts=2, base_delay=0)
+        with self.assertRaises(Error):
+            policy.call(_failing([LINK_FAILURE] * 3))
+        with self.assertRaises(Error):
+            policy.call(_failing([SYNTAX]))
+
+        self.assertEqual(policy.stats()['exhausted'], 1)
+        self.assertEqual(policy.stats()['retries'], 1)
+        return None
+
+
+    def test_writes_only_replayed_after_deadlock(self):
+
+        policy = RetryPolicy(max_attempts=3, base_delay=0)
+        self.assertEqual(policy.call(_failing([DEADLOCK]), idempotent=False), 'ok')
+        with self.assertRaises(Error):
+            policy.call(_failing([LINK_FAILURE]), idempotent=False)
+
+        self.assertEqual(policy.stats()['not_retried'], 1)
+        return None
+
+
+    def test_pool_discards_lost_connection(self):
+
+        pool = ConnectionPool(lambda: sqlite3.connect(':memory:'), max_size=2)
+        with self.assertRaises(Error):
+            with pool.connection():
+                raise LINK_FAILURE
+        with pool.connection():
+            pass
+        pool.discard_idle()
+
+        stats = pool.stats()
+        self.assertEqual(stats['discards'], 2)
+        self.assertEqual(stats['size'], 0)
+        return None
+
+
+    def test_data_value_does_not_discard_connection(self):
+
+        pool = ConnectionPool(lambda: sqlite3.connect(':memory:'), max_size=1)
+        with self.assertRaises(Error):
+            with pool.connection():
+                raise DUPLICATE_KEY
+        self.assertEqual(pool.stats()['discards'], 0)
+
+        retried = []
+        with self.assertRaises(Error):
+            RetryPolicy(base_delay=0).call(_failing([DUPLICATE_KEY]),
+                                           on_retry=lambda *args: retried.append(args[1]))
+        self.assertEqual(retried, [])
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
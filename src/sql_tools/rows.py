@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Compact row formats for query results. pyodbc.Row objects each carry a
+reference to the cursor description and a per-row header; these formats
+store only the values :
+'tuple' : plain tuples in a Rows list holding one shared column index
+'record' : tuple subclasses with __slots__ = () (namedtuple), so attribute
+    access like rows[0].NAME keeps working at the memory cost of a tuple
+'columns' : a dict of {column : numpy.ndarray}, see sql_tools.columnar
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+import functools
+
+# Third party imports
+
+# Local imports
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+ROW_FORMATS = ('row', 'tuple', 'record', 'columns')
+
+
+@functools.lru_cache(maxsize=256)
+def record_class(columns):
+    """Return a namedtuple class for a tuple of column names. Names which
+    are not valid identifiers (or are repeated) are renamed to _<position>
+    for attribute access; indexing works for every column"""
+    return namedtuple('Record', columns, rename=True)
+
+
+class Rows(list):
+
+    def __init__(self, columns, rows=()):
+        """List of tuple rows sharing one column index
+        inputs
+        -------
+        columns : (iterable) of (str) column names
+        rows : (iterable) of tuples"""
+        super().__init__(rows)
+        self.columns = tuple(columns)
+        self.index = {name:position for position, name in enumerate(self.columns)}
+
+        return None
+
+
+    def column(self, name):
+        """Return the values of column name as a list"""
+        position = self.index[name]
+        return [row[position] for row in self]
+
+
+    def copy(self):
+        return Rows(self.columns, self)
+
+
+    def __repr__(self):
+        return 'Rows(columns={}, rows={})'.format(self.columns, len(self))
+
+
+def empty_result(row_format='row'):
+    """Result of a statement without a result set, in row_format"""
+    if row_format == 'columns':
+        return {}
+    if row_format in ('tuple', 'record'):
+        return Rows(())
+    return []
+
+
+def result_length(result):
+    """Number of rows in a result of any row format"""
+    if isinstance(result, dict):
+        return len(next(iter(result.values()))) if result else 0
+    return len(result)
+
+
+def copy_result(result):
+    """Copy a result so a cached result cannot be modified by the caller"""
+    if isinstance(result, dict):
+        return {name:values.copy() for name, values in result.items()}
+    return result.copy() if isinstance(result, Rows) else list(result)
+
+
+def fetch_rows(cursor, row_format='row', arraysize=10000):
+    """Fetch the remaining rows of an executed cursor in row_format. For
+    'tuple' and 'record' rows are converted batch by batch, so the driver
+    rows of only one batch are alive at a time
+    inputs
+    -------
+    cursor : executed DB-API cursor
+    row_format : (str) 'row' (driver rows, like pyodbc.Row), 'tuple',
+        'record' or 'columns'
+    arraysize : (int) rows fetched per round trip when converting
+    outputs
+    -------
+    rows : (list, Rows or dict)"""
+
+    if row_format == 'row':
+        return cursor.fetchall()
+    if row_format == 'columns':
+        from .columnar import fetch_columnar
+        return fetch_columnar(cursor, arraysize=arraysize, output='numpy')
+    if row_format not in ROW_FORMATS:
+        raise ValueError('row_format must be one of {}, got {}'.format(ROW_FORMATS, row_format))
+
+    columns = tuple(column[0] for column in cursor.description)
+    if row_format == 'tuple':
+        convert = tuple
+    else:
+        convert = record_class(columns)._make
+
+    rows = Rows(columns)
+    while True:
+        batch = cursor.fetchmany(arraysize)
+        if not batch:
+            break
+        rows.extend(map(convert, batch))
+        del batch
+
+    return rows
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Row format tests, run over SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+import sqlite3
+import tracemalloc
+import unittest
+
+# local imports
+from sql_tools.sql_tools import SQLBase
+from sql_tools.backends import SQLiteBackend
+from sql_tools.rows import Rows
+
+#%%
+
+class RowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        self.sqlbase.init_database_connection('JobDB')
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT, "NET DEV" REAL)')
+        self.sqlbase.bulk_insert([(i, 'JHW.AHU{}'.format(i), i * 0.5) for i in range(20000)],
+                                 'POINTBAS',
+                                 columns=['ID', 'NAME', 'NET DEV'])
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_tuple_and_record(self):
+
+        rows = self.sqlbase.execute_sql('SELECT * FROM POINTBAS ORDER BY ID', row_format='tuple')
+        self.assertIsInstance(rows, Rows)
+        self.assertEqual(rows.columns, ('ID', 'NAME', 'NET DEV'))
+        self.assertEqual(type(rows[1]), tuple)
+        self.assertEqual(rows[1][rows.index['NAME']], 'JHW.AHU1')
+        self.assertEqual(rows.column('ID')[:3], [0, 1, 2])
+
+        records = self.sqlbase.execute_sql('SELECT * FROM POINTBAS ORDER BY ID', row_format='record')
+        self.assertEqual(records[2].NAME, 'JHW.AHU2')
+        self.assertEqual(records[2][2], 1.0)
+        self.assertEqual(len(records), 20000)
+        return None
+
+
+    def test_columns(self):
+
+        columns = self.sqlbase.execute_sql('SELECT ID, NAME FROM POINTBAS WHERE ID < ?',
+                                           (5,), row_format='columns')
+        self.assertEqual(list(columns), ['ID', 'NAME'])
+        self.assertEqual(columns['ID'].tolist(), [0, 1, 2, 3, 4])
+        with self.assertRaises(ValueError):
+            self.sqlbase.execute_sql('SELECT 1', row_format='rowz')
+        return None
+
+
+    def test_no_result_set(self):
+
+        sql = "UPDATE POINTBAS SET NAME = 'JHW' WHERE ID = -1"
+        for row_format, empty in [('row', []), ('tuple', Rows(())), ('record', Rows(())),
+                                  ('columns', {})]:
+            result = self.sqlbase.execute_sql(sql, row_format=row_format)
+            self.assertEqual(type(result), type(empty))
+            self.assertEqual(result, empty)
+        self.assertEqual(self.sqlbase.execute_sql(sql, row_format='tuple').columns, ())
+        return None
+
+
+    def test_cache_returns_copies(self):
+
+        self.sqlbase.enable_query_cache()
+        first = self.sqlbase.execute_sql('SELECT ID FROM POINTBAS WHERE ID < 3', row_format='record')
+        first.pop()
+        second = self.sqlbase.execute_sql('SELECT ID FROM POINTBAS WHERE ID < 3', row_format='record')
+        self.assertEqual(len(second), 3)
+        self.assertEqual(second[0].ID, 0)
+        return None
+
+
+    def test_memory_below_row_objects(self):
+
+        def traced(fetch):
+            tracemalloc.start()
+            try:
+                result = fetch()
+                current, _peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            del result
+            return current
+
+        connection = self.backend.connect('JobDB')
+        connection.row_factory = sqlite3.Row
+        try:
+            row_objects = traced(lambda: connection.execute('SELECT * FROM POINTBAS').fetchall())
+        finally:
+            connection.close()
+        records = traced(lambda: self.sqlbase.execute_sql('SELECT * FROM POINTBAS',
+                                                          row_format='record'))
+
+        self.assertLess(records, row_objects)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,42 +11,69 @@ This module has a few important assumptions :
 
 # Python imports
 from datetime import datetime
-from typing import overload
-import sys, os
+import ntpath
+import os
 import subprocess
-from pathlib import Path
+from contextlib import contextmanager, nullcontext
+import threading
+import itertools
+import time
 
 # Third party imports
-import pyodbc
-import pandas as pd
+# pyodbc and pandas are imported on first use (see _import_pyodbc and
+# _import_pandas) so importing this module stays fast and side effect free
 
 # Local imports
+from .pool import ConnectionPool
+from .catalog import ServerCatalog, normalize_path
+from .metadata import MetadataCache, is_ddl
+from . import query_cache
+from . import rows as rows_module
+from .retry import RetryPolicy, CONNECTION
+from .instrumentation import Instrumentation
+from . import instrumentation as events
 
 # Setup logging
 import logging
-_log_dir = os.path.join(os.getcwd(), 'logs')
-if os.path.isdir(_log_dir):
-    pass
-else:
-    try:
-        os.mkdir(_log_dir)
-    except FileNotFoundError:
-        os.mkdir(os.path.split(_log_dir)[0])
-        os.mkdir(_log_dir)
-
-logging.basicConfig(filename=os.path.join(_log_dir, 'sql_logs.log'),
-                    level=logging.DEBUG,
-                    format='%(asctime)s %(message)s')
+logger = logging.getLogger(__name__)
 
 
 #%%
 
+def _import_pyodbc():
+    """Import pyodbc on first connect"""
+    import pyodbc
+    return pyodbc
+
+
+def _import_pandas():
+    """Import pandas when a DataFrame API is first used"""
+    import pandas
+    return pandas
+
+
+# GetDriveTypeW result of a mapped network drive
+DRIVE_REMOTE = 4
+
+
+def _drive_type(root):
+    """Windows drive type of root (like 'Z:\\'), or None on other
+    platforms"""
+    if os.name != 'nt':
+        return None
+    import ctypes
+    return ctypes.windll.kernel32.GetDriveTypeW(root)
+
+
 class DepreciationError(Exception):
     pass
 
 class NameUsedError(Exception):
     pass
 
+class DetachError(Exception):
+    pass
+
 def pyodbc_connection_str(server_name,
                           driver_name, 
                           database_name,
@@ -108,57 +135,439 @@ def sqlalchemy_connection_str(server_name,
     return engine_str
 
 
+def quote_identifier(name):
+    """Quote a (optionally schema or database qualified) object name for
+    T-SQL. Each dot separated part is wrapped in square brackets with any
+    closing bracket escaped. Parts which are already bracketed are kept
+    inputs
+    -------
+    name : (str) object name like 'POINTBAS', 'dbo.POINTBAS' or
+        '[JobDB].[dbo].[POINTBAS]'
+    outputs
+    -------
+    quoted : (str) like '[dbo].[POINTBAS]'"""
+
+    parts = []
+    part = ''
+    in_brackets = False
+    i = 0
+    while i < len(name):
+        char = name[i]
+        if in_brackets:
+            if char == ']' and name[i+1:i+2] == ']':
+                part += ']'
+                i += 1
+            elif char == ']':
+                in_brackets = False
+            else:
+                part += char
+        elif char == '[':
+            in_brackets = True
+        elif char == '.':
+            parts.append(part)
+            part = ''
+        else:
+            part += char
+        i += 1
+    parts.append(part)
+
+    if in_brackets or not all(part.strip() for part in parts):
+        raise ValueError('Invalid object name : {}'.format(name))
+
+    return '.'.join('[' + part.strip().replace(']', ']]') + ']' for part in parts)
+
+
 class SQLBase:
     pyodbc_base_conn_str = 'DRIVER={}; SERVER={}; DATABASE=master; Trusted_Connection=yes;'
 
 
-    def __init__(self, server_name, driver_name):
+    def __init__(self,
+                 server_name,
+                 driver_name,
+                 pool_size=5,
+                 pool_timeout=30,
+                 pool_max_idle=300,
+                 lazy=False,
+                 catalog_ttl=60,
+                 retry_policy=None,
+                 backend=None,
+                 metadata_ttl=None):
         """A helper class for sql databases. This incldues attaching, detaching,
         and connecting to databases with an sql server. This method only
         supports microsoft authentication (not user and password)
         inputs
         -------
         server_name : (str) name of sql server
-        driver_name : (str) type of driver"""
+        driver_name : (str) type of driver
+        pool_size : (int) maximum number of connections kept open per database.
+            Queries borrow a connection from the database pool, so up to
+            pool_size threads can query one database concurrently
+        pool_timeout : (float) seconds to wait for a free pooled connection
+            before raising PoolTimeoutError
+        pool_max_idle : (float) seconds an unused pooled connection is kept
+            before it is closed
+        lazy : (bool) if False (default) a master connection is opened
+            immediately to test SQL Server connectivity. If True no connection
+            is opened until one is needed, or until connect() / warmup() is
+            called. Use lazy=True when constructing many instances or when only
+            connection strings are needed
+        catalog_ttl : (float) seconds the server file catalog snapshot used by
+            check_existing_database is reused before it is reloaded. Attaches
+            and detaches through this instance update the snapshot directly.
+            None keeps the snapshot until catalog.invalidate() is called
+        retry_policy : (RetryPolicy) how reads are replayed after transient
+            errors (deadlock, lost connection, timeout) on a fresh pooled
+            connection. Defaults to RetryPolicy(). Use
+            RetryPolicy(max_attempts=1) to disable retries
+        backend : (Backend) opens connections (see sql_tools.backends).
+            Defaults to PyodbcBackend(server_name, driver_name). Pass
+            SQLAlchemyBackend, DBAPIBackend or SQLiteBackend to run the same
+            queries over another driver; server_name and driver_name may
+            then be None
+        metadata_ttl : (float) seconds the table metadata of a database (see
+            get_table) is reused before it is reloaded. Attaches, detaches
+            and DDL run through execute_sql discard it directly. None (the
+            default) keeps it until metadata.invalidate() is called
+
+        SQLBase is a context manager; connections are closed when the with
+        block exits
+        usage
+        -------
+        with SQLBase(server_name, driver_name, lazy=True) as sqlbase:
+            sqlbase.init_database_connection(database_name)
+            rows = sqlbase.execute_sql(sql)"""
         # TODO add support for username and password
 
-        if driver_name is None:
+        if driver_name is None and backend is None:
             driver_1 = "{SQL Server Native Client 10.0}"
             driver_2 = "{SQL Server Native Client 11.0}"
             msg='driver_name cannot be {}, try {} or {}'
             raise(ValueError(msg.format(driver_name, driver_1, driver_2)))
         else:
-            self.driver_name = '{{{driver_name}}}'.format(driver_name=driver_name)
+            if driver_name is None:
+                self.driver_name = None
+            else:
+                self.driver_name = '{{{driver_name}}}'.format(driver_name=driver_name)
             self.server_name = server_name
 
-        self._init_master_connection()
+        # A backend passed in belongs to the caller, who closes it
+        self._owns_backend = backend is None
+        if backend is None:
+            from .backends import PyodbcBackend
+            backend = PyodbcBackend(server_name, driver_name)
+        self.backend = backend
+
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.pool_max_idle = pool_max_idle
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._master_connection = None
+        self._master_lock = threading.RLock()
+        self.catalog = ServerCatalog(self._load_catalog, ttl=catalog_ttl)
+        self.metadata = MetadataCache(self._load_metadata, ttl=metadata_ttl)
+        self.query_cache = None
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.instrumentation = Instrumentation()
+
+        if not lazy:
+            self._init_master_connection()
+
+        return None
+
+
+    def __enter__(self):
+        return self
+
 
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
         return None
 
 
+    @property
+    def master_connection(self):
+        """Connection to the master database used for attaching and detaching.
+        Opened on first use if the instance was created with lazy=True"""
+        if self._master_connection is None:
+            with self._master_lock:
+                if self._master_connection is None:
+                    self._init_master_connection()
+        return self._master_connection
+
+
+    @master_connection.setter
+    def master_connection(self, connection):
+        self._master_connection = connection
+
+
     def _init_master_connection(self):
         """Initialize a master connection on startup to test SQL Server
         connectivity"""
-        if 'master_connection_str' not in self.__dict__:
-            self._set_pyodbc_master_connection_str()
-
         try:
-            self.master_connection = pyodbc.connect(self.master_connection_str)
+            self.master_connection = self.backend.connect('master')
         except Exception as e:
-            logging.debug(e)
+            logger.debug(e)
             raise(e)
             
         return None
 
 
+    def connect(self):
+        """Open the master connection if it is not already open. This tests
+        SQL Server connectivity for instances created with lazy=True
+        outputs
+        -------
+        self : (SQLBase)"""
+        self.master_connection
+        return self
+
+
+    def warmup(self, database_name=None, connections=1):
+        """Open connections ahead of time so the first queries do not pay for
+        a login. The master connection is opened, and if database_name is
+        given its pool is filled with 'connections' idle connections
+        inputs
+        -------
+        database_name : (str) database whose pool is filled
+        connections : (int) number of pooled connections to open
+        outputs
+        -------
+        self : (SQLBase)"""
+        self.connect()
+        if database_name is not None:
+            self.get_pool(database_name).warmup(connections)
+        return self
+
+
+    def close(self):
+        """Close the master connection, every pooled connection and, if this
+        instance created it, the backend (see Backend.close). A backend
+        passed to __init__ is left open for its owner to close. The instance
+        can still be used afterwards if the backend can reconnect;
+        connections are reopened on demand"""
+        with self._master_lock:
+            if self._master_connection is not None:
+                try:
+                    self._master_connection.close()
+                except Exception as e:
+                    logger.debug(e)
+                self._master_connection = None
+
+        self.close_pools()
+        if self._owns_backend:
+            self.backend.close()
+
+        return None
+
+
     def init_database_connection(self, database_name):
-        """Initialize a database connection"""
-        connection_str = self.get_pyodbc_database_connection_str(database_name)
+        """Initialize a database connection. This creates the connection pool
+        for database_name (opening and testing one connection) and makes
+        database_name the default database for execute_sql and
+        pandas_execute_sql
+        inputs
+        -------
+        database_name : (str) name of database to connect to"""
+        pool = self.get_pool(database_name)
+        try:
+            with pool.connection():
+                pass
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        self.database_name = database_name
+
+        return None
+
+
+    def _connect_database(self, database_name):
+        """Open a new connection to database_name. Used by the connection
+        pools to create connections"""
         try:
-            self.database_connection = pyodbc.connect(connection_str)
+            connection = self.backend.connect(database_name)
         except Exception as e:
-            logging.debug(e)
+            logger.debug(e)
             raise(e)
+        return connection
+
+
+    def _timed_connect(self, database_name):
+        with self.instrumentation.timer(events.CONNECT, database_name):
+            return self._connect_database(database_name)
+
+
+    def add_listener(self, listener):
+        """Register listener to receive an instrumentation Event for every
+        connect, execute, fetch batch, DataFrame construction, attach and
+        detach (see sql_tools.instrumentation)
+        inputs
+        -------
+        listener : (callable) called with one Event, on the thread which did
+            the work. HistogramCollector and SlowQueryLogger are provided
+        outputs
+        -------
+        listener : the listener, so it can be kept for remove_listener
+        usage
+        -------
+        histograms = sqlbase.add_listener(HistogramCollector())
+        sqlbase.add_listener(SlowQueryLogger(threshold=2.0))
+        ...
+        histograms.summary()"""
+        return self.instrumentation.add_listener(listener)
+
+
+    def remove_listener(self, listener):
+        self.instrumentation.remove_listener(listener)
+        return None
+
+
+    def get_pool(self, database_name):
+        """Return the connection pool for database_name, creating it if
+        needed. Connections are opened lazily by the pool
+        inputs
+        -------
+        database_name : (str) name of database
+        outputs
+        -------
+        pool : (ConnectionPool)"""
+        with self._pools_lock:
+            if database_name not in self._pools:
+                self._pools[database_name] = ConnectionPool(
+                    lambda: self._timed_connect(database_name),
+                    max_size=self.pool_size,
+                    timeout=self.pool_timeout,
+                    max_idle=self.pool_max_idle,
+                    name=database_name,
+                    keep_idle=not self.backend.pools_connections)
+            pool = self._pools[database_name]
+
+        return pool
+
+
+    def _resolve_database_name(self, database_name=None):
+        """Return database_name, or the database set by
+        init_database_connection if database_name is None"""
+        if database_name is None:
+            if not 'database_name' in self.__dict__:
+                msg='No database connection initialized. Try self.init_database_connection'
+                raise NameError(msg)
+            database_name = self.database_name
+
+        return database_name
+
+
+    def _get_database_pool(self, database_name=None):
+        """Return the pool for database_name, or for the database set by
+        init_database_connection if database_name is None"""
+        return self.get_pool(self._resolve_database_name(database_name))
+
+
+    def enable_query_cache(self, max_entries=256, max_bytes=256 * 2**20, ttl=300):
+        """Cache the results of read-only statements run through execute_sql
+        and pandas_execute_sql. Writes through this instance (bulk_insert, or
+        a write statement run through any of the execute methods) invalidate
+        cached results of the tables they touch, and attaching or detaching
+        a database invalidates all of its results
+        inputs
+        -------
+        max_entries : (int) maximum number of cached results
+        max_bytes : (int) maximum estimated memory of cached results
+        ttl : (float) seconds a cached result stays valid
+        outputs
+        -------
+        query_cache : (QueryCache) see QueryCache.stats for hit/miss counters"""
+        self.query_cache = query_cache.QueryCache(max_entries=max_entries,
+                                                  max_bytes=max_bytes,
+                                                  ttl=ttl)
+        return self.query_cache
+
+
+    def disable_query_cache(self):
+        """Stop caching query results and drop the cache"""
+        self.query_cache = None
+        return None
+
+
+    def _cache_get(self, database_name, sql_query, params, kind):
+        """Return (key, value) for a cacheable read-only query. key is None if
+        the query is not cacheable, value is query_cache.MISSING on a miss"""
+        cache = self.query_cache
+        if cache is None or not query_cache.is_read_only(sql_query):
+            return None, query_cache.MISSING
+
+        key = cache.make_key(database_name, sql_query, params, kind)
+        if key is None:
+            return None, query_cache.MISSING
+        return key, cache.get(key)
+
+
+    def _cache_put(self, key, sql_query, value):
+        cache = self.query_cache
+        if cache is not None and key is not None:
+            cache.put(key, value, query_cache.referenced_tables(sql_query))
+        return None
+
+
+    def _invalidate_query_cache(self, database_name, sql_query=None, tables=None):
+        """Invalidate cached results after a write. Results reading the
+        written tables are removed; if the tables cannot be determined all
+        results of database_name are removed"""
+        cache = self.query_cache
+        if cache is None:
+            return None
+
+        if tables is None and sql_query is not None:
+            tables = query_cache.referenced_tables(sql_query)
+        cache.invalidate_tables(database_name, tables or ())
+
+        return None
+
+
+    def _invalidate_after_write(self, database_name, sql_query):
+        """Invalidate cached results and table metadata which sql_query may
+        have changed. Read-only statements invalidate nothing"""
+        if query_cache.is_read_only(sql_query):
+            return None
+
+        self._invalidate_query_cache(database_name, sql_query)
+        if is_ddl(sql_query):
+            self.metadata.invalidate(database_name)
+
+        return None
+
+
+    def pool_stats(self):
+        """Return connection pool statistics for each database
+        outputs
+        -------
+        stats : (dict) of {database_name : (dict) of pool counters}. See
+            ConnectionPool.stats"""
+        with self._pools_lock:
+            pools = dict(self._pools)
+
+        return {name:pool.stats() for name, pool in pools.items()}
+
+
+    def _close_pool(self, database_name):
+        """Close and forget the pool for database_name, if any"""
+        with self._pools_lock:
+            pool = self._pools.pop(database_name, None)
+        if pool is not None:
+            pool.close()
+        return None
+
+
+    def close_pools(self):
+        """Close every pooled connection"""
+        with self._pools_lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+
+        for pool in pools:
+            pool.close()
+
         return None
 
 
@@ -173,27 +582,28 @@ class SQLBase:
 
     def _set_pyodbc_master_connection_str(self):
         """Set the master database connection string"""
-        self.master_connection_str = self.pyodbc_base_conn_str.format(self.driver_name, self.server_name)
+        self.master_connection_str = self.get_pyodbc_database_connection_str('master')
         return self.master_connection_str
 
 
     def get_pyodbc_database_connection_str(self, database_name):
-        """Return a database specific connection string
+        """Return a database specific connection string. With a
+        PyodbcBackend this is the string its connections are opened with
+        (including a SQL Server login, if the backend has one)
         inputs
         -------
         database_name : (str) name of database to connect to"""
+        from .backends import PyodbcBackend
 
-        driver_name = self.driver_name
-        server_name = self.server_name
+        if isinstance(self.backend, PyodbcBackend):
+            return self.backend.connection_str(database_name)
 
         # For pyodbc connection only
-        connection_string= 'DRIVER={}; SERVER={}; DATABASE={}; Trusted_Connection=yes;'\
-                                .format(driver_name,
-                                        server_name,
-                                        database_name)
+        return pyodbc_connection_str(self.server_name,
+                                     self.driver_name,
+                                     database_name)
+
 
-        return connection_string
-        
 
     def get_sqlalchemy_connection_str(self, 
                                       database_name, 
@@ -219,7 +629,9 @@ class SQLBase:
     def attach_database(self,
                         path_mdf,
                         path_ldf,
-                        database_name):
+                        database_name,
+                        manage_traceflag=True,
+                        connection=None):
         """Used to attach 'database_name' to the sql server. If path_ldf is
         not defined, then this method assumes the log file is in the same
         directory as path_mdf, with the file name 'JobDB_Log.ldf'. Define
@@ -233,14 +645,16 @@ class SQLBase:
         database_name : (str) name of database to attach. This can be any user
             specified name, but it must be used to attach, detach, and connect to
             a specific database
+        manage_traceflag : (bool) turn trace flag 1807 on before and off after
+            attaching a database on a network path. Pass False when the
+            caller already turned it on for the session (see process_databases)
+        connection : master database connection to attach on. Defaults to
+            the shared master_connection
         output
         -------
         database_name : (str) of actual database name attached as
         """
-
-        # Check if database connection is already instantiated
-        if 'master_connection' not in self.__dict__:
-            self._init_master_connection()
+        self._require_sql_server('attach_database')
 
         try:
             """Check if the selected file is already in use or if the requested
@@ -253,7 +667,7 @@ class SQLBase:
                 msg = ('File name: {} is already in use\n' +
                        'Connect to existing database instead\n' +
                        'Existing Database : {}'.format(existing_database_name))
-                logging.info(msg.format(path_mdf))
+                logger.info(msg.format(path_mdf))
 
                 raise FileExistsError(msg)
 
@@ -264,86 +678,237 @@ class SQLBase:
                 database_name = database_name + now.strftime('%Y%m%d%H%M%S')
                 str2 = ' Try a new name instead'.format(database_name)
                 msg = str1 + ' ' + str2
-                logging.info(msg)
+                logger.info(msg)
 
                 raise NameUsedError(msg)
 
             # Flag 1807 must be ON to connect remote databases
-            path_is_net_drive = not os.path.splitdrive(path_mdf)[0] in ['C:', 'D:']
-            path_is_network_name = os.path.splitdrive(path_mdf)[0].startswith('\\')
-            if any((path_is_net_drive, path_is_network_name)):
-                self.traceon1807(True)
+            traceflag = manage_traceflag and self.is_network_path(path_mdf)
+            if traceflag:
+                self.traceon1807(True, connection=connection)
 
             _dat_name = database_name + '_dat'
             _log_name = database_name + '_log'
-            sql = """CREATE DATABASE [{database_name}]
-                    ON PRIMARY (NAME={_dat_name}, FILENAME='{path_mdf}')
-                    LOG ON (NAME={_log_name}, FILENAME='{path_ldf}')
-                    FOR ATTACH WITH FILESTREAM (DIRECTORY_NAME='Test');
-                    """.format(database_name=database_name,
-                    path_mdf=path_mdf,
-                    path_ldf=path_ldf,
-                    _dat_name=_dat_name,
-                    _log_name=_log_name)
-
-            self.master_connection.autocommit = True
-            with self.master_connection.cursor() as master_cursor:
-                master_cursor.execute(sql)
-            self.master_connection.autocommit = False
-
-            logging.info('Database : {} connected'.format(database_name))
-
-            if any((path_is_net_drive, path_is_network_name)):
-                self.traceon1807(False)
+            # CREATE DATABASE does not accept parameters, so the statement is
+            # built server side from parameters with QUOTENAME / REPLACE
+            sql = """DECLARE @sql nvarchar(max) = N'CREATE DATABASE ' + QUOTENAME(?)
+                    + N' ON PRIMARY (NAME=' + QUOTENAME(?)
+                    + N', FILENAME=N''' + REPLACE(?, N'''', N'''''') + N''')'
+                    + N' LOG ON (NAME=' + QUOTENAME(?)
+                    + N', FILENAME=N''' + REPLACE(?, N'''', N'''''') + N''')'
+                    + N' FOR ATTACH WITH FILESTREAM (DIRECTORY_NAME=''Test'');';
+                    EXEC sp_executesql @sql;"""
+            params = (database_name,
+                      _dat_name,
+                      str(path_mdf),
+                      _log_name,
+                      str(path_ldf))
+
+            try:
+                with self.instrumentation.timer(events.ATTACH, database_name), \
+                     self._master_cursor(autocommit=True, connection=connection) as master_cursor:
+                    master_cursor.execute(sql, params)
+            except Exception:
+                # The server state is unknown after a failed attach
+                self.catalog.invalidate()
+                raise
+            finally:
+                if traceflag:
+                    self.traceon1807(False, connection=connection)
+            self.catalog.add_database(database_name, [path_mdf, path_ldf])
+            self.metadata.invalidate(database_name)
+            if self.query_cache is not None:
+                self.query_cache.invalidate_database(database_name)
+
+            logger.info('Database : {} connected'.format(database_name))
 
         except Exception as e:
-            logging.debug(e)
+            logger.debug(e)
             raise(e)
 
         return None
 
 
-    def detach_database(self, database_name):
+    def detach_database(self, database_name, skipchecks=False, connection=None):
         """Used to detach database_name.  Use
         this once I get the information needed from the database.  In addition,
         close the cursor associated with the connection
 
+        The database is set to SINGLE_USER (rolling back open transactions)
+        and detached with sp_detach_db over the master connection
+
         inputs
         -------
         database_name : (str) name of database to detach
+        skipchecks : (bool) passed to sp_detach_db. If False statistics are
+            updated before detaching
+        connection : master database connection to detach on. Defaults to
+            the shared master_connection
+        raises
+        -------
+        DetachError : if the server could not detach the database
         """
 
-        detach_str = """USE [master]
-        GO
-        ALTER DATABASE [{db_name}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE
-        GO
-        EXEC master.dbo.sp_detach_db @dbname = N'{db_name}', @skipchecks = 'false'
-        GO""".format(db_name=database_name)
+        results = self.detach_databases([database_name],
+                                        skipchecks=skipchecks,
+                                        connection=connection)
+        error = results[database_name]
+        if error is not None:
+            raise DetachError('Could not detach {} : {}'.format(database_name, error))
 
-        # Check if detach script is made yet
-        file_tail = Path('DetachDatabase.sql')
-        detach_file = os.path.join(os.getcwd(), file_tail)
-        with open(detach_file, mode='w') as f:
-            f.write(detach_str)
+        return None
 
-        subprocess.call(['sqlcmd', '-S', self.server_name, '-i', detach_file])
-        logging.info('Database {} removed'.format(database_name))
 
+    def detach_databases(self, database_names, skipchecks=False, connection=None):
+        """Detach many databases in one round trip. Each database is detached
+        independently; a failure does not stop the others
+        inputs
+        -------
+        database_names : (iterable) of (str) database names to detach
+        skipchecks : (bool) passed to sp_detach_db
+        connection : master database connection to detach on. Defaults to
+            the shared master_connection
+        outputs
+        -------
+        results : (dict) of {database_name : None if detached, otherwise
+            (str) the server error message}"""
+
+        self._require_sql_server('detach_databases')
+        database_names = list(database_names)
+        results = {}
+
+        # Pooled connections to a detached database are unusable
+        for database_name in database_names:
+            self._close_pool(database_name)
+
+        # Stay well below the 2100 parameter limit of a batch
+        batch_size = 1000
+        for start in range(0, len(database_names), batch_size):
+            names = database_names[start:start + batch_size]
+            sql = self._detach_sql.format(
+                values=', '.join('(?)' for _name in names))
+            params = ['true' if skipchecks else 'false'] + names
+
+            try:
+                with self.instrumentation.timer(events.DETACH, names[0] if len(names) == 1 else None) as timer, \
+                     self._master_cursor(autocommit=True, connection=connection) as master_cursor:
+                    timer.rows = len(names)
+                    master_cursor.execute(sql, params)
+                    # Skip row counts and messages ahead of the result set
+                    while master_cursor.description is None:
+                        if not master_cursor.nextset():
+                            raise DetachError('Detach batch returned no results')
+                    rows = master_cursor.fetchall()
+            except Exception as e:
+                logger.debug(e)
+                raise(e)
+
+            for name, _error_number, error_message in rows:
+                results[name] = error_message
+                if error_message is None:
+                    self.catalog.remove_database(name)
+                    self.metadata.invalidate(name)
+                    if self.query_cache is not None:
+                        self.query_cache.invalidate_database(name)
+                    logger.info('Database {} removed'.format(name))
+                else:
+                    logger.info('Database {} not removed : {}'.format(name, error_message))
+
+        return results
+
+
+    _detach_sql = """SET NOCOUNT ON;
+        DECLARE @skipchecks nvarchar(10) = ?;
+        DECLARE @names TABLE (ordinal int IDENTITY(1,1) PRIMARY KEY, name sysname);
+        INSERT INTO @names (name) VALUES {values};
+        DECLARE @results TABLE (ordinal int, name sysname,
+                                error_number int NULL, error_message nvarchar(4000) NULL);
+        DECLARE @ordinal int, @name sysname, @sql nvarchar(max);
+        DECLARE detach_cursor CURSOR LOCAL FAST_FORWARD FOR
+            SELECT ordinal, name FROM @names ORDER BY ordinal;
+        OPEN detach_cursor;
+        FETCH NEXT FROM detach_cursor INTO @ordinal, @name;
+        WHILE @@FETCH_STATUS = 0
+        BEGIN
+            BEGIN TRY
+                SET @sql = N'ALTER DATABASE ' + QUOTENAME(@name)
+                    + N' SET SINGLE_USER WITH ROLLBACK IMMEDIATE';
+                EXEC sp_executesql @sql;
+                EXEC master.dbo.sp_detach_db @dbname = @name, @skipchecks = @skipchecks;
+                INSERT INTO @results VALUES (@ordinal, @name, NULL, NULL);
+            END TRY
+            BEGIN CATCH
+                INSERT INTO @results VALUES (@ordinal, @name, ERROR_NUMBER(), ERROR_MESSAGE());
+                -- Do not leave a database which failed to detach in SINGLE_USER
+                IF DB_ID(@name) IS NOT NULL
+                BEGIN TRY
+                    SET @sql = N'ALTER DATABASE ' + QUOTENAME(@name) + N' SET MULTI_USER';
+                    EXEC sp_executesql @sql;
+                END TRY
+                BEGIN CATCH
+                END CATCH
+            END CATCH
+            FETCH NEXT FROM detach_cursor INTO @ordinal, @name;
+        END
+        CLOSE detach_cursor;
+        DEALLOCATE detach_cursor;
+        SELECT name, error_number, error_message FROM @results ORDER BY ordinal;"""
+
+
+    def _require_sql_server(self, operation):
+        if not self.backend.is_sql_server:
+            msg = '{} needs a SQL Server backend, not {!r}'
+            raise NotImplementedError(msg.format(operation, self.backend))
         return None
 
 
-    def check_existing_database(self, path_mdf, database_name):
+    @contextmanager
+    def _master_cursor(self, autocommit=False, connection=None):
+        """Cursor on the master connection for the duration of a with block.
+        The master connection is shared, so access is serialized with a lock.
+        DDL like CREATE DATABASE and sp_detach_db must run with
+        autocommit=True. If connection is given, it is used instead of the
+        shared master connection and is not locked"""
+        if connection is not None:
+            lock = nullcontext()
+        else:
+            lock = self._master_lock
+
+        with lock:
+            if connection is None:
+                connection = self.master_connection
+            previous = connection.autocommit
+            connection.autocommit = autocommit
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            finally:
+                try:
+                    cursor.close()
+                finally:
+                    # Only a state read back as a bool can be restored
+                    if isinstance(previous, bool):
+                        connection.autocommit = previous
+
+
+    def check_existing_database(self, path_mdf, database_name, refresh=False):
         """Check two conditions :
         1) A database with 'database_name' is already connected
         to the instance of sql server
         2) A database physical_name (operating system file name) is already
         connected to the server instance
 
+        The answer comes from a cached snapshot of the server catalog (see
+        self.catalog), which is reloaded after catalog_ttl seconds
+
         inputs
         -------
         path_mdf : (str) path to master data file .mdf
         database_name : (str) name of database you will try to connect as.
         It is the logical name of the database
+        refresh : (bool) reload the catalog snapshot before checking. Use this
+            if databases may have been attached or detached outside this
+            instance
         ouputs
         -------
         (file_used_bool, name_used_bool, existing_database_name)
@@ -355,31 +920,127 @@ class SQLBase:
             file_used_bool is true
         """
 
+        path_database_name = self.catalog.database_for_path(path_mdf, refresh=refresh)
+        file_used_bool = path_database_name is not None
+        name_used_bool = self.catalog.has_database(database_name)
+
+        if file_used_bool:
+            existing_database_name = path_database_name
+        elif name_used_bool:
+            existing_database_name = database_name
+        else:
+            existing_database_name = None
+
+        return (file_used_bool, name_used_bool, existing_database_name)
+
+
+    def _load_catalog(self):
+        """Return (logical_name, physical_name, database_name) rows for every
+        file attached to the server"""
         sql = """select [name] as logical_name, physical_name,
         	(select name
         	from [master].[sys].[databases] as t2
         	where t2.database_id = t1.database_id) as database_name
         from sys.master_files as t1"""
-        with self.master_connection.cursor() as master_cursor:
-            master_cursor.execute(sql)
-            rows = master_cursor.fetchall()
-
-        # Assume the file and database name is not initially used
-        file_used_bool = False
-        name_used_bool = False
-        existing_database_name = None
-
-        """If the query indicates the .mdf file name OR database name is already
-        Used then change the boolean state"""
-        for row in rows:
-            if self.path_equal(row.physical_name, path_mdf):
-                file_used_bool = True
-                existing_database_name = row.database_name
-            if row.database_name == database_name:
-                name_used_bool = True
-                existing_database_name = row.database_name
+        return self.execute_sql_master(sql)
+
+
+    def get_tables(self, database_name=None, refresh=False):
+        """Return the metadata of every table of a database. The metadata is
+        loaded in one batched catalog query and cached (see self.metadata)
+        inputs
+        -------
+        database_name : (str) database to describe. Defaults to the database
+            set by init_database_connection
+        refresh : (bool) reload the metadata first. Use this if tables may
+            have been changed outside this instance
+        outputs
+        -------
+        tables : (list) of (sql_tools.metadata.TableInfo)"""
+        database_name = self._resolve_database_name(database_name)
+        return self.metadata.tables(database_name, refresh=refresh)
+
+
+    def get_table(self, table, database_name=None, refresh=False):
+        """Return the metadata of one table: columns and their types,
+        indexes, key columns and the row count estimate
+        inputs
+        -------
+        table : (str) table name, like 'POINTBAS' or 'dbo.POINTBAS'
+        database_name : (str) database of the table. Defaults to the
+            database set by init_database_connection
+        refresh : (bool) reload the metadata first
+        outputs
+        -------
+        table : (sql_tools.metadata.TableInfo)
+        raises
+        -------
+        KeyError : if the table does not exist"""
+        database_name = self._resolve_database_name(database_name)
+        return self.metadata.table(database_name, table, refresh=refresh)
+
+
+    def _load_metadata(self, database_name):
+        """Return TableInfo for every table of database_name"""
+        from .metadata import load_tables
+        return load_tables(self, database_name)
+
+    @staticmethod
+    def is_network_path(path_mdf):
+        """True if path_mdf is a UNC path (\\\\server\\share) or on a mapped
+        network drive. Trace flag 1807 must be on to attach database files on
+        the network. Drive letters are checked with GetDriveTypeW, so local
+        disks other than C: and D: are not mistaken for network drives. On
+        other platforms only UNC paths are detected"""
+        drive = ntpath.splitdrive(str(path_mdf))[0]
+        if drive.startswith(('\\\\', '//')):
+            return True
+        if len(drive) != 2:
+            return False
+        return _drive_type(drive + '\\') == DRIVE_REMOTE
+
+
+    def process_databases(self,
+                          specs,
+                          extract=None,
+                          max_workers=4,
+                          detach=True,
+                          staging=None,
+                          copy_workers=2):
+        """Attach, extract from and detach many databases with bounded
+        concurrency. See sql_tools.batch.process_databases
+        inputs
+        -------
+        specs : (iterable) of (path_mdf, path_ldf, database_name) tuples
+        extract : (callable) called as extract(sqlbase, database_name) after
+            each database is attached. Its return value is reported in the
+            results
+        max_workers : (int) number of databases processed at once
+        detach : (bool) detach each database after extract
+        staging : (sql_tools.staging.StagingCache) if given, the files are
+            copied to (or reused from) this local cache and the local copies
+            are attached. Copies run while staged databases are processed
+            (see sql_tools.staging.process_databases)
+        copy_workers : (int) number of databases copied at once when staging
+        outputs
+        -------
+        results : (list) of (DatabaseResult) in the order of specs"""
+        if staging is not None:
+            from .staging import process_databases
+            return process_databases(self,
+                                     specs,
+                                     staging,
+                                     extract=extract,
+                                     max_workers=max_workers,
+                                     copy_workers=copy_workers,
+                                     detach=detach)
+        from .batch import process_databases
+        return process_databases(self,
+                                 specs,
+                                 extract=extract,
+                                 max_workers=max_workers,
+                                 detach=detach)
 
-        return (file_used_bool, name_used_bool, existing_database_name)
 
     @staticmethod
     def path_equal(path1, path2):
@@ -394,82 +1055,918 @@ class SQLBase:
         -------
         (bool) True if paths are the same"""
 
-        path1 = os.path.normpath(os.path.normcase(path1))
-        path2 = os.path.normpath(os.path.normcase(path2))
+        path1 = normalize_path(path1)
+        path2 = normalize_path(path2)
 
         return path1 == path2
 
 
-    def pandas_execute_sql(self, sql_query):
+    def pandas_execute_sql(self,
+                           sql_query,
+                           params=None,
+                           database_name=None,
+                           use_cache=True):
         """Read a table to dataframe using pyodbc and pandas. The server and driver
         used to instantiate the class is used (self.server_name, self.driver_name)
         inputs
         -------
-        sql_query : (str) sql string to execute
+        sql_query : (str) sql string to execute. Use ? parameter markers for
+            values
+        params : (sequence) parameter values for the ? markers in sql_query
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        use_cache : (bool) use the query cache if it is enabled (see
+            enable_query_cache)
         outputs
         -------
         df : (pandas.DataFrame) SQL table"""
 
-        if not 'database_connection' in self.__dict__:
-            msg='No database connection initialized. Try self.init_database_connection'
-            raise NameError(msg)
+        pd = _import_pandas()
+        database_name = self._resolve_database_name(database_name)
+        if use_cache:
+            key, df = self._cache_get(database_name, sql_query, params, 'DataFrame')
+            if df is not query_cache.MISSING:
+                # Copy so callers cannot modify the cached result
+                return df.copy()
+        pool = self.get_pool(database_name)
+
+        def run():
+            with pool.connection() as connection:
+                with self._execute(pool, connection, sql_query, params) as cursor:
+                    columns = [column[0] for column in cursor.description]
+                    rows = self._fetchall(cursor, database_name, sql_query)
+                with self.instrumentation.timer(events.DATAFRAME, database_name, sql_query) as timer:
+                    df = pd.DataFrame.from_records([tuple(row) for row in rows],
+                                                   columns=columns,
+                                                   coerce_float=True)
+                    timer.rows = len(df)
+                connection.commit()
+            return df
 
         # For pyodbc connection only
         try:
-            with self.database_connection as connection:
-                df = pd.read_sql(sql_query, connection)
+            df = self._with_retry(pool, run, query_cache.is_read_only(sql_query))
         except Exception as e:
-            logging.debug(e)
+            logger.debug(e)
             raise(e)
 
+        self._invalidate_after_write(database_name, sql_query)
+        if use_cache:
+            self._cache_put(key, sql_query, df.copy())
+
         return df
 
 
-    def execute_sql(self, sql_query):
+    def execute_sql(self,
+                    sql_query,
+                    params=None,
+                    database_name=None,
+                    use_cache=True,
+                    row_format='row'):
         """Execute a SQL statement and return rows
         inputs
         -------
-        sql_query : (str) sql string to execute
+        sql_query : (str) sql string to execute. Use ? parameter markers for
+            values so repeated statements reuse the prepared statement and
+            the server query plan
+        params : (sequence) parameter values for the ? markers in sql_query
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        use_cache : (bool) use the query cache if it is enabled (see
+            enable_query_cache). Statements which are not read-only
+            invalidate cached results of the tables they write
+        row_format : (str) how rows are returned (see sql_tools.rows) :
+            'row' : a list of driver rows (pyodbc.Row)
+            'tuple' : a Rows list of plain tuples with a shared column index
+                (rows.columns, rows.index, rows.column(name))
+            'record' : a Rows list of namedtuples, so rows[0].NAME works
+            'columns' : a dict of {column : numpy.ndarray}
+            'tuple' and 'record' use less memory than driver rows on large
+            results
         outputs
         -------
-        rows : ()
+        rows : (list, Rows or dict)
         """
-        if not 'database_connection' in self.__dict__:
-            msg='No database connection initialized. Try self.init_database_connection'
-            raise NameError(msg)
+        if row_format not in rows_module.ROW_FORMATS:
+            msg = 'row_format must be one of {}, got {}'
+            raise ValueError(msg.format(rows_module.ROW_FORMATS, row_format))
+        database_name = self._resolve_database_name(database_name)
+        kind = 'rows' if row_format == 'row' else 'rows:' + row_format
+        key = None
+        if use_cache:
+            key, rows = self._cache_get(database_name, sql_query, params, kind)
+            if rows is not query_cache.MISSING:
+                return rows_module.copy_result(rows)
+        pool = self.get_pool(database_name)
+
+        def run():
+            with pool.connection() as connection:
+                with self._execute(pool, connection, sql_query, params) as cursor:
+                    rows = self._fetchall(cursor, database_name, sql_query, row_format)
+                connection.commit()
+            return rows
 
         try:
-            with self.database_connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                rows = cursor.fetchall()
+            rows = self._with_retry(pool, run, query_cache.is_read_only(sql_query))
         except Exception as e:
-            logging.debug(e)
+            logger.debug(e)
             raise(e)
 
+        self._invalidate_after_write(database_name, sql_query)
+        if use_cache:
+            self._cache_put(key, sql_query, rows_module.copy_result(rows))
+
         return rows
 
 
-    def execute_sql_master(self, sql_query):
+    def execute_sql_batches(self,
+                            sql_query,
+                            params=None,
+                            arraysize=5000,
+                            database_name=None):
+        """Execute a SQL statement and yield rows in batches of at most
+        arraysize rows. Only one batch is held in memory at a time, so this
+        is suitable for results too large for execute_sql. A pooled
+        connection is held until the generator is exhausted or closed
+        inputs
+        -------
+        sql_query : (str) sql string to execute
+        params : (sequence) parameter values for the ? markers in sql_query
+        arraysize : (int) number of rows fetched per round trip (cursor.arraysize)
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        outputs
+        -------
+        rows : (generator) of (list) of rows"""
+
+        pool = self._get_database_pool(database_name)
+
+        try:
+            with pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.arraysize = arraysize
+                    with self.instrumentation.timer(events.EXECUTE, pool.name, sql_query):
+                        self._execute_cursor(cursor, sql_query, params)
+                    # A statement without a result set (like UPDATE) yields nothing
+                    if cursor.description is not None:
+                        for rows in self._iter_fetchmany(cursor, arraysize, pool.name, sql_query):
+                            yield rows
+                finally:
+                    cursor.close()
+                connection.commit()
+            self._invalidate_after_write(pool.name, sql_query)
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        return None
+
+
+    def pandas_execute_sql_chunks(self,
+                                  sql_query,
+                                  params=None,
+                                  chunksize=50000,
+                                  database_name=None):
+        """Read a query into a sequence of dataframes of at most chunksize
+        rows. Memory use is bounded by chunksize regardless of the size of
+        the result
+        inputs
+        -------
+        sql_query : (str) sql string to execute
+        params : (sequence) parameter values for the ? markers in sql_query
+        chunksize : (int) maximum number of rows per dataframe
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        outputs
+        -------
+        dfs : (generator) of (pandas.DataFrame)"""
+
+        pd = _import_pandas()
+        pool = self._get_database_pool(database_name)
+
+        try:
+            with pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.arraysize = chunksize
+                    with self.instrumentation.timer(events.EXECUTE, pool.name, sql_query):
+                        self._execute_cursor(cursor, sql_query, params)
+                    if cursor.description is not None:
+                        columns = [column[0] for column in cursor.description]
+                        for rows in self._iter_fetchmany(cursor, chunksize, pool.name, sql_query):
+                            yield pd.DataFrame.from_records(
+                                [tuple(row) for row in rows], columns=columns)
+                finally:
+                    cursor.close()
+                connection.commit()
+            self._invalidate_after_write(pool.name, sql_query)
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        return None
+
+
+    def pipeline_execute_sql(self,
+                             sql_query,
+                             transform=None,
+                             params=None,
+                             database_name=None,
+                             arraysize=50000,
+                             processes=None,
+                             max_pending=None,
+                             executor=None):
+        """Read a query into a dataframe with fetching, DataFrame construction
+        and transform overlapped across processes (see sql_tools.pipeline).
+        A fetch thread pulls batches of arraysize rows into a bounded queue
+        and a process pool converts and transforms them in parallel
+        inputs
+        -------
+        sql_query : (str) sql string to execute
+        transform : (callable) called as transform(df) on each batch in a
+            worker process. Must be a module level function
+        params : (sequence) parameter values for the ? markers in sql_query
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        arraysize : (int) rows per batch
+        processes : (int) worker processes. Defaults to os.cpu_count() - 1
+        max_pending : (int) batches held ahead of the consumer
+        executor : (concurrent.futures.Executor) reuse a process pool across
+            calls
+        outputs
+        -------
+        df : (pandas.DataFrame) the transformed batches concatenated in query
+            order"""
+        from .pipeline import pipeline_execute_sql
+        return pipeline_execute_sql(self,
+                                    sql_query,
+                                    transform=transform,
+                                    params=params,
+                                    database_name=database_name,
+                                    arraysize=arraysize,
+                                    processes=processes,
+                                    max_pending=max_pending,
+                                    executor=executor)
+
+
+    def iter_pipeline_execute_sql(self,
+                                  sql_query,
+                                  transform=None,
+                                  params=None,
+                                  database_name=None,
+                                  arraysize=50000,
+                                  processes=None,
+                                  max_pending=None,
+                                  executor=None):
+        """Like pipeline_execute_sql, but yield the transformed batch
+        dataframes in query order as they are ready. A slow consumer pauses
+        the fetch once max_pending batches are waiting
+        outputs
+        -------
+        dfs : (generator) of (pandas.DataFrame)"""
+        from .pipeline import iter_pipeline
+        return iter_pipeline(self,
+                             sql_query,
+                             transform=transform,
+                             params=params,
+                             database_name=database_name,
+                             arraysize=arraysize,
+                             processes=processes,
+                             max_pending=max_pending,
+                             executor=executor)
+
+
+    def columnar_execute_sql(self,
+                             sql_query,
+                             params=None,
+                             arraysize=10000,
+                             output='pandas',
+                             database_name=None):
+        """Execute a query and fetch the result column by column into typed
+        NumPy buffers (see sql_tools.columnar). Only one fetchmany batch of
+        rows is held at a time instead of every row of the result, so the
+        peak memory is lower than pandas_execute_sql; the speed is about
+        the same (see sql_tools.benchmarks.columnar_fetch). Integer and
+        boolean columns containing NULL use the pandas nullable dtypes
+        inputs
+        -------
+        sql_query : (str) sql string to execute
+        params : (sequence) parameter values for the ? markers in sql_query
+        arraysize : (int) rows fetched per round trip
+        output : (str) 'pandas' for a DataFrame, 'numpy' for a dict of
+            {column : numpy.ndarray} or 'arrow' for a pyarrow.Table
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        outputs
+        -------
+        result : (pandas.DataFrame, dict or pyarrow.Table)"""
+        from .columnar import fetch_columnar
+
+        pool = self._get_database_pool(database_name)
+
+        def run():
+            with pool.connection() as connection:
+                with self._execute(pool, connection, sql_query, params) as cursor:
+                    cursor.arraysize = arraysize
+                    with self.instrumentation.timer(events.FETCH, pool.name, sql_query) as timer:
+                        result = fetch_columnar(cursor, arraysize=arraysize, output=output)
+                        if timer.enabled:
+                            timer.rows = len(next(iter(result.values()))) if output == 'numpy' else len(result)
+                connection.commit()
+            return result
+
+        try:
+            result = self._with_retry(pool, run, query_cache.is_read_only(sql_query))
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        self._invalidate_after_write(pool.name, sql_query)
+
+        return result
+
+
+    def export_query(self,
+                     sql_query,
+                     path,
+                     format='parquet',
+                     chunk_rows=50000,
+                     compression=None,
+                     params=None,
+                     database_name=None):
+        """Stream the result of a query to a Parquet or CSV file without
+        holding the whole result in memory (see sql_tools.export). Each batch
+        of chunk_rows rows is written as one Parquet row group, or appended
+        to a buffered CSV writer
+        inputs
+        -------
+        sql_query : (str) sql string to execute
+        path : (str or Path) output file
+        format : (str) 'parquet' (requires pyarrow) or 'csv'
+        chunk_rows : (int) rows fetched and written per batch
+        compression : (str) Parquet codec ('snappy' default, 'gzip', 'zstd',
+            'none') or CSV compression (None, 'gzip', 'bz2', 'xz')
+        params : (sequence) parameter values for the ? markers in sql_query
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        outputs
+        -------
+        report : (dict) with keys 'path', 'rows', 'bytes', 'seconds',
+            'rows_per_sec' and 'peak_rss_mb'"""
+        from .export import export_cursor
+
+        pool = self._get_database_pool(database_name)
+
+        try:
+            with pool.connection() as connection:
+                with self._execute(pool, connection, sql_query, params) as cursor:
+                    cursor.arraysize = chunk_rows
+                    with self.instrumentation.timer(events.FETCH, pool.name, sql_query) as timer:
+                        report = export_cursor(cursor,
+                                               path,
+                                               format=format,
+                                               chunk_rows=chunk_rows,
+                                               compression=compression)
+                        timer.rows = report['rows']
+                        timer.bytes = report['bytes']
+                connection.commit()
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        return report
+
+
+    def export_database(self,
+                        directory,
+                        database_name=None,
+                        tables=None,
+                        format='parquet',
+                        chunk_rows=50000,
+                        compression=None,
+                        max_workers=4):
+        """Export every table of a database to one file per table, several
+        tables at once. See sql_tools.export.export_database
+        inputs
+        -------
+        directory : (str or Path) output directory
+        database_name : (str) database to export. Defaults to the database
+            set by init_database_connection
+        tables : (iterable) of (schema, table) tuples. Defaults to every base
+            table
+        format, chunk_rows, compression : see export_query
+        max_workers : (int) number of tables exported at once
+        outputs
+        -------
+        reports : (dict) of {'schema.table' : report}"""
+        from .export import export_database
+        return export_database(self,
+                               directory,
+                               database_name=database_name,
+                               tables=tables,
+                               format=format,
+                               chunk_rows=chunk_rows,
+                               compression=compression,
+                               max_workers=max_workers)
+
+
+    def fan_out_sql(self,
+                    sql_query,
+                    database_names,
+                    params=None,
+                    output='pandas',
+                    max_workers=8,
+                    source_column='database_name',
+                    use_cache=True):
+        """Run one query on many databases concurrently and merge the
+        results (see sql_tools.fanout). Each query borrows a connection from
+        its database pool, so init_database_connection is not needed. A
+        failed database is reported and does not stop the others
+        inputs
+        -------
+        sql_query : (str) sql string to execute on every database
+        database_names : (iterable) of (str) databases to query
+        params : (sequence) parameter values for the ? markers in sql_query
+        output : (str) 'pandas' for a DataFrame or 'rows' for a list of
+            tuples (database_name, *row)
+        max_workers : (int) number of databases queried at once
+        source_column : (str) name of the DataFrame column holding the
+            source database (a categorical)
+        use_cache : (bool) use the query cache if it is enabled
+        outputs
+        -------
+        merged : (pandas.DataFrame or list) results of all databases
+        report : (list) of (FanoutResult) with database_name, error, seconds
+            and rows of each database, in the order of database_names
+        usage
+        -------
+        df, report = sqlbase.fan_out_sql(sql, ['JobDB1', 'JobDB2'])
+        failed = [item for item in report if item.error is not None]"""
+        from .fanout import fan_out
+        return fan_out(self,
+                       sql_query,
+                       database_names,
+                       params=params,
+                       output=output,
+                       max_workers=max_workers,
+                       source_column=source_column,
+                       use_cache=use_cache)
+
+
+    def iter_fan_out_sql(self,
+                         sql_query,
+                         database_names,
+                         params=None,
+                         output='pandas',
+                         max_workers=8,
+                         source_column='database_name',
+                         use_cache=True):
+        """Like fan_out_sql, but yield a FanoutResult for each database as
+        soon as its query completes, without merging. Only max_workers
+        results are held at once
+        outputs
+        -------
+        results : (generator) of (FanoutResult) in completion order"""
+        from .fanout import iter_fan_out
+        return iter_fan_out(self,
+                            sql_query,
+                            database_names,
+                            params=params,
+                            output=output,
+                            max_workers=max_workers,
+                            source_column=source_column,
+                            use_cache=use_cache)
+
+
+    def extract_changed_tables(self,
+                               state,
+                               on_table,
+                               database_name=None,
+                               source=None,
+                               tables=None,
+                               high_water_columns=None,
+                               output='pandas'):
+        """Extract only the tables (or rows) which changed since the previous
+        run recorded in state (see sql_tools.incremental). Unchanged tables
+        are not read; tables with a rowversion column, or a column listed in
+        high_water_columns, return only rows above the previous high-water
+        mark
+        inputs
+        -------
+        state : (sql_tools.incremental.StateStore) local state of previous
+            runs
+        on_table : (callable) called as on_table(extract) with a
+            TableExtract for each table. The state of a table is saved after
+            on_table returns
+        database_name : (str) database to extract. Defaults to the database
+            set by init_database_connection
+        source : (str) stable name under which state is recorded, like the
+            .mdf path. Defaults to database_name
+        tables : (iterable) of (str) table names. Defaults to every table
+        high_water_columns : (dict) of {table name : ever increasing column}
+        output : (str) 'pandas' for DataFrames or 'rows' for Rows of tuples
+        outputs
+        -------
+        extracts : (list) of (TableExtract) with data set to None"""
+        from .incremental import extract_tables
+        return extract_tables(self,
+                              state,
+                              on_table,
+                              database_name=database_name,
+                              source=source,
+                              tables=tables,
+                              high_water_columns=high_water_columns,
+                              output=output)
+
+
+    def iter_table_pages(self,
+                         table,
+                         key_columns=None,
+                         page_size=10000,
+                         start_after=None,
+                         columns=None,
+                         workers=1,
+                         database_name=None):
+        """Walk a table in keyset paginated pages (see sql_tools.pagination).
+        Each page is a separate short statement ordered by the table key, so
+        no locks are held between pages and a walk can be resumed from the
+        last key of any page
+        inputs
+        -------
+        table : (str) table name, like 'POINTBAS' or 'dbo.POINTBAS'
+        key_columns : (list) of (str) unique key columns. Defaults to the
+            clustered index key (or primary key) of table
+        page_size : (int) rows per page
+        start_after : key to resume after. With workers=1 the last_key of a
+            Page; with workers > 1 a dict of {range_index : last_key}
+        columns : (list) of (str) columns to select. Defaults to all columns
+        workers : (int) if more than 1, pages are fetched in parallel over
+            disjoint ranges of the leading key column and arrive in no
+            particular order across ranges. Use KeysetPaginator directly to
+            keep the ranges for a resumable parallel walk
+        database_name : (str) database to query. Defaults to the database
+            set by init_database_connection
+        outputs
+        -------
+        pages : (generator) of (Page) with attributes rows, columns,
+            last_key and range_index
+        usage
+        -------
+        for page in sqlbase.iter_table_pages('POINTBAS', page_size=50000):
+            process(page.rows)
+            save_checkpoint(page.last_key)"""
+        from .pagination import KeysetPaginator
+
+        paginator = KeysetPaginator(self,
+                                    table,
+                                    key_columns=key_columns,
+                                    page_size=page_size,
+                                    columns=columns,
+                                    database_name=database_name)
+        if workers > 1:
+            return paginator.parallel_pages(workers=workers, start_after=start_after)
+        return paginator.pages(start_after=start_after)
+
+
+    def profile_sql(self,
+                    sql_query,
+                    params=None,
+                    database_name=None,
+                    io=True,
+                    time_statistics=True,
+                    plan=False,
+                    output='rows'):
+        """Run a query with SET STATISTICS IO / TIME / XML ON and return its
+        result next to a profile (see sql_tools.profiling). The report shows
+        whether the time is server CPU, reads or client fetch
+        inputs
+        -------
+        sql_query : (str) sql string to execute
+        params : (sequence) parameter values for the ? markers in sql_query
+        database_name : (str) database to query. Defaults to the database set
+            by init_database_connection
+        io : (bool) capture logical and physical reads per table
+        time_statistics : (bool) capture server CPU and elapsed time
+        plan : (bool) capture the actual plan XML of each statement
+        output : (str) 'rows' for a list of rows or 'pandas' for a DataFrame
+        outputs
+        -------
+        result : (list or pandas.DataFrame) first result set of the query
+        report : (sql_tools.profiling.ProfileReport)
+        usage
+        -------
+        rows, report = sqlbase.profile_sql(sql, plan=True)
+        print(sql_tools.profiling.format_report(report))"""
+        if output not in ('rows', 'pandas'):
+            raise ValueError("output must be 'rows' or 'pandas', got {}".format(output))
+        from .profiling import profile_query
+
+        try:
+            rows, columns, report = profile_query(self,
+                                                  sql_query,
+                                                  params=params,
+                                                  database_name=database_name,
+                                                  io=io,
+                                                  time_statistics=time_statistics,
+                                                  plan=plan)
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        self._invalidate_after_write(self._resolve_database_name(database_name), sql_query)
+        if output == 'pandas':
+            pd = _import_pandas()
+            return pd.DataFrame.from_records([tuple(row) for row in rows],
+                                             columns=columns,
+                                             coerce_float=True), report
+        return rows, report
+
+
+    def _iter_fetchmany(self, cursor, arraysize, database_name=None, sql_query=None):
+        """Yield non-empty lists of rows from cursor.fetchmany until the
+        result set is exhausted. Each batch is timed as one fetch event"""
+        while True:
+            with self.instrumentation.timer(events.FETCH, database_name, sql_query) as timer:
+                rows = cursor.fetchmany(arraysize)
+                if timer.enabled:
+                    timer.rows = len(rows)
+                    timer.bytes = query_cache.estimate_size(rows)
+            if not rows:
+                break
+            yield rows
+
+        return None
+
+
+    def execute_sql_master(self, sql_query, params=None):
         """Execute a SQL statement against system databases only
         (uses the master database)
         inputs
         -------
         sql_query : (str) sql string to execute
+        params : (sequence) parameter values for the ? markers in sql_query
         outputs
         -------
         rows : (list) of
         """
 
+        pool = self.get_pool('master')
+
+        def run():
+            with pool.connection() as connection:
+                with self._execute(pool, connection, sql_query, params) as cursor:
+                    rows = self._fetchall(cursor, 'master', sql_query)
+                connection.commit()
+            return rows
+
         try:
-            with self.master_connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                rows = cursor.fetchall()
+            rows = self._with_retry(pool, run, query_cache.is_read_only(sql_query))
         except Exception as e:
-            logging.debug(e)
+            logger.debug(e)
             raise(e)
 
         return rows
 
+
+    def _with_retry(self, pool, operation, idempotent=True):
+        """Call operation() under the retry policy. operation borrows its
+        own connection from pool, so a connection broken by the failed
+        attempt is discarded by the pool and the replay runs on another one.
+        After a lost connection the idle connections of pool are discarded
+        too, since they most likely point at the same failed session host
+        inputs
+        -------
+        pool : (ConnectionPool) pool used by operation
+        operation : (callable) called with no arguments
+        idempotent : (bool) False for statements which may write. These are
+            only replayed after a deadlock (see RetryPolicy)"""
+        def on_retry(attempt, reason, exception, delay):
+            if reason == CONNECTION:
+                pool.discard_idle()
+            return None
+
+        return self.retry_policy.call(operation, idempotent=idempotent, on_retry=on_retry)
+
+
+    @contextmanager
+    def _execute(self, pool, connection, sql_query, params=None):
+        """Execute sql_query on the cached cursor for its statement text and
+        yield the cursor for the duration of a with block. The cursor belongs
+        to the connection statement cache and must not be closed by the
+        caller. Unread results are drained when the block exits, and the
+        cursor is discarded if the block raises (see StatementCache.statement)"""
+        statements = pool.statement_cache(connection)
+        with statements.statement(sql_query) as cursor:
+            with self.instrumentation.timer(events.EXECUTE, pool.name, sql_query):
+                self._execute_cursor(cursor, sql_query, params)
+            yield cursor
+
+
+    def _fetchall(self, cursor, database_name, sql_query, row_format='row'):
+        """Fetch all rows of the first result set in row_format (see
+        sql_tools.rows), or an empty result in row_format if the statement
+        returned no result set, timed as one fetch event. Row counts and
+        messages ahead of the result set (like those of an EXEC) are
+        skipped"""
+        while not cursor.description:
+            nextset = getattr(cursor, 'nextset', None)
+            if nextset is None or not nextset():
+                return rows_module.empty_result(row_format)
+        with self.instrumentation.timer(events.FETCH, database_name, sql_query) as timer:
+            rows = rows_module.fetch_rows(cursor, row_format)
+            if timer.enabled:
+                timer.rows = rows_module.result_length(rows)
+                if not isinstance(rows, dict):
+                    timer.bytes = query_cache.estimate_size(rows)
+
+        return rows
+
+
+    @staticmethod
+    def _execute_cursor(cursor, sql_query, params=None):
+        """Execute sql_query on cursor, with params if given"""
+        if params is None:
+            cursor.execute(sql_query)
+        else:
+            cursor.execute(sql_query, params)
+        return cursor
+
+    def bulk_insert(self,
+                    data,
+                    table,
+                    columns=None,
+                    batch_size=10000,
+                    upsert_keys=None,
+                    fast_executemany=True,
+                    database_name=None):
+        """Insert many rows into table using parameter arrays. Rows are sent
+        in batches of batch_size with pyodbc fast_executemany, so each batch
+        is a single round trip instead of one round trip per row. All
+        batches are committed in one transaction
+        inputs
+        -------
+        data : (pandas.DataFrame or iterable) rows to write. An iterable may
+            contain sequences (columns is required) or dictionaries (columns
+            defaults to the keys of the first dictionary)
+        table : (str) destination table like 'POINTBAS' or 'dbo.POINTBAS'
+        columns : (list) of column names. Defaults to the DataFrame columns
+        batch_size : (int) number of rows sent per executemany call
+        upsert_keys : (list) of key column names. If given, rows are staged
+            in a temporary table and merged into table with MERGE : rows with
+            matching keys are updated and all other rows are inserted
+        fast_executemany : (bool) use pyodbc parameter arrays
+        database_name : (str) database to write to. Defaults to the database
+            set by init_database_connection
+        outputs
+        -------
+        report : (dict) with keys 'rows', 'batches', 'seconds' and
+            'rows_per_sec'"""
+
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1, got {}'.format(batch_size))
+
+        columns, records = self._iter_records(data, columns)
+        if upsert_keys:
+            missing = [key for key in upsert_keys if key not in columns]
+            if missing:
+                raise ValueError('upsert_keys {} are not in columns'.format(missing))
+
+        table_name = quote_identifier(table)
+        column_names = ', '.join(quote_identifier(column) for column in columns)
+        placeholders = ', '.join('?' for _column in columns)
+        stage_name = '#sql_tools_stage'
+        target_name = stage_name if upsert_keys else table_name
+        insert_sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            target_name, column_names, placeholders)
+
+        database_name = self._resolve_database_name(database_name)
+        pool = self.get_pool(database_name)
+        n_rows = 0
+        n_batches = 0
+        start = time.perf_counter()
+
+        try:
+            with pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    if fast_executemany:
+                        try:
+                            cursor.fast_executemany = True
+                        except AttributeError:
+                            # Not a pyodbc cursor
+                            pass
+
+                    if upsert_keys:
+                        # SELECT INTO copies an IDENTITY property, which would
+                        # reject explicit values in the stage. A UNION does not
+                        cursor.execute(
+                            "IF OBJECT_ID('tempdb..{stage}') IS NOT NULL DROP TABLE {stage}; "
+                            "SELECT TOP 0 {columns} INTO {stage} FROM {table} "
+                            "UNION ALL SELECT TOP 0 {columns} FROM {table}"\
+                                .format(stage=stage_name,
+                                        columns=column_names,
+                                        table=table_name))
+
+                    while True:
+                        batch = list(itertools.islice(records, batch_size))
+                        if not batch:
+                            break
+                        with self.instrumentation.timer(events.EXECUTE, database_name, insert_sql) as timer:
+                            cursor.executemany(insert_sql, batch)
+                            timer.rows = len(batch)
+                        n_rows += len(batch)
+                        n_batches += 1
+
+                    if upsert_keys:
+                        cursor.execute(self._merge_sql(table_name, stage_name, columns, upsert_keys))
+                        cursor.execute('DROP TABLE {}'.format(stage_name))
+
+                    connection.commit()
+
+                except Exception:
+                    connection.rollback()
+                    raise
+                finally:
+                    cursor.close()
+
+        except Exception as e:
+            logger.debug(e)
+            raise(e)
+
+        self._invalidate_query_cache(database_name,
+                                     sql_query='INSERT INTO ' + table_name)
+
+        seconds = time.perf_counter() - start
+        report = {'rows':n_rows,
+                  'batches':n_batches,
+                  'seconds':seconds,
+                  'rows_per_sec':n_rows / seconds if seconds > 0 else float('inf')}
+        logger.info('Bulk {} of {} rows into {} : {:.0f} rows/sec'.format(
+            'upsert' if upsert_keys else 'insert', n_rows, table, report['rows_per_sec']))
+
+        return report
+
+
+    @staticmethod
+    def _iter_records(data, columns=None):
+        """Return (columns, iterator of row tuples) for a DataFrame or an
+        iterable of sequences or dictionaries. Missing values in a DataFrame
+        (NaN, NaT) are converted to None so they are written as NULL"""
+
+        if hasattr(data, 'itertuples') and hasattr(data, 'columns'):
+            # pandas.DataFrame
+            if columns is None:
+                columns = [str(column) for column in data.columns]
+            else:
+                data = data[list(columns)]
+            data = data.astype(object).where(data.notna(), None)
+            return list(columns), data.itertuples(index=False, name=None)
+
+        records = iter(data)
+        try:
+            first = next(records)
+        except StopIteration:
+            if columns is None:
+                raise ValueError('columns is required when data is empty')
+            return list(columns), iter(())
+
+        if isinstance(first, dict):
+            if columns is None:
+                columns = list(first.keys())
+            records = (tuple(record[column] for column in columns)
+                       for record in itertools.chain([first], records))
+        else:
+            if columns is None:
+                raise ValueError('columns is required when data rows are sequences')
+            records = (tuple(record) for record in itertools.chain([first], records))
+
+        return list(columns), records
+
+
+    @staticmethod
+    def _merge_sql(table_name, stage_name, columns, upsert_keys):
+        """MERGE statement which upserts stage_name into table_name on
+        upsert_keys"""
+
+        on = ' AND '.join('target.{0} = source.{0}'.format(quote_identifier(key))
+                          for key in upsert_keys)
+        update_columns = [column for column in columns if column not in upsert_keys]
+        column_names = ', '.join(quote_identifier(column) for column in columns)
+        source_names = ', '.join('source.' + quote_identifier(column) for column in columns)
+
+        sql = 'MERGE INTO {} WITH (HOLDLOCK) AS target USING {} AS source ON {} '\
+            .format(table_name, stage_name, on)
+        if update_columns:
+            sql += 'WHEN MATCHED THEN UPDATE SET {} '.format(
+                ', '.join('target.{0} = source.{0}'.format(quote_identifier(column))
+                          for column in update_columns))
+        sql += 'WHEN NOT MATCHED BY TARGET THEN INSERT ({}) VALUES ({});'\
+            .format(column_names, source_names)
+
+        return sql
+
+
     @staticmethod
     def get_UNC():
         """Return a users mapped network drives. UNC path will be used for
@@ -495,18 +1992,19 @@ class SQLBase:
         return server_mapping
 
 
-    def traceon1807(self, Flag):
+    def traceon1807(self, Flag, connection=None):
         """Turn on/off Trace Flag 1807 based on user input True or False
         Parameters
         ----------
-        Flag : (bool) True for turn Trace 1807 ON; False for 1807 OFF"""
+        Flag : (bool) True for turn Trace 1807 ON; False for 1807 OFF
+        connection : master database connection (session) to set the flag
+            on. Defaults to the shared master_connection"""
         if Flag:
             sql = """DBCC TRACEON(1807)"""
         else:
             sql = """DBCC TRACEOFF(1807)"""
 
-        with self.master_connection.cursor() as master_cursor:
+        with self._master_cursor(autocommit=True, connection=connection) as master_cursor:
             master_cursor.execute(sql)
-            master_cursor.commit()
 
         return None
\ No newline at end of file
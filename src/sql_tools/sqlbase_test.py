@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+SQLBase tests which do not need a SQL Server instance. Server level
+statements run against fake master connections, everything else over
+SQLiteBackend
+
+@author: vorst
+"""
+
+# Python imports
+import unittest
+from unittest import mock
+import datetime
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from sql_tools.sql_tools import SQLBase, DetachError, quote_identifier
+from sql_tools.backends import Backend, SQLiteBackend, PyodbcBackend
+from sql_tools import instrumentation as events
+
+#%%
+
+class _ServerCursor:
+    """Fake SQL Server cursor. Statements and parameter arrays are recorded
+    on the connection. A detach batch returns a row count, then a result
+    row for each database"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        return None
+
+    def execute(self, sql, params=()):
+        self.connection.statements.append((sql, list(params)))
+        self.description = None
+        return self
+
+    def executemany(self, sql, rows):
+        self.connection.statements.append((sql, list(rows)))
+        return self
+
+    def nextset(self):
+        self.description = [('name',), ('error_number',), ('error_message',)]
+        return True
+
+    def fetchall(self):
+        names = self.connection.statements[-1][1][1:]
+        return [(name, *self.connection.errors.get(name, (None, None))) for name in names]
+
+    def close(self):
+        return None
+
+
+class _ServerConnection:
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.statements = []
+        self.autocommit = False
+        self.commits = 0
+        return None
+
+    def cursor(self):
+        return _ServerCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        return None
+
+    def rollback(self):
+        return None
+
+    def close(self):
+        return None
+
+
+class _ServerBackend(Backend):
+
+    is_sql_server = True
+
+    def __init__(self, errors=None):
+        # One connection records the statements sent to every database
+        self.master = _ServerConnection(errors or {})
+        self.closed = False
+        return None
+
+    def connect(self, database_name):
+        return self.master
+
+    def close(self):
+        self.closed = True
+        return None
+
+
+class DetachTest(unittest.TestCase):
+
+    def setUp(self):
+        self.errors = {'JobDB2':(3703, 'Cannot detach the database JobDB2 because it is '
+                                 'currently in use.')}
+        self.backend = _ServerBackend(self.errors)
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        return None
+
+
+    def test_detach_databases(self):
+
+        results = self.sqlbase.detach_databases(['JobDB1', 'JobDB2', 'JobDB3'], skipchecks=True)
+
+        self.assertEqual(results, {'JobDB1':None,
+                                   'JobDB2':self.errors['JobDB2'][1],
+                                   'JobDB3':None})
+        (sql, params), = self.backend.master.statements
+        self.assertEqual(params, ['true', 'JobDB1', 'JobDB2', 'JobDB3'])
+        self.assertIn('VALUES (?), (?), (?);', sql)
+        # The master connection is restored after the autocommit batch
+        self.assertFalse(self.backend.master.autocommit)
+        return None
+
+
+    def test_detach_database_raises(self):
+
+        self.sqlbase.detach_database('JobDB1')
+        self.assertEqual(self.backend.master.statements[-1][1], ['false', 'JobDB1'])
+
+        with self.assertRaises(DetachError) as context:
+            self.sqlbase.detach_database('JobDB2')
+        self.assertIn('currently in use', str(context.exception))
+        return None
+
+
+    def test_multi_user_fallback(self):
+
+        self.sqlbase.detach_databases(['JobDB2'])
+        sql = self.backend.master.statements[-1][0]
+
+        # A database which failed to detach is set back to MULTI_USER, after
+        # its error is recorded and only if it still exists
+        catch = sql.index('BEGIN CATCH')
+        self.assertLess(sql.index('SET SINGLE_USER WITH ROLLBACK IMMEDIATE'), catch)
+        self.assertLess(catch, sql.index('ERROR_MESSAGE()'))
+        self.assertLess(sql.index('ERROR_MESSAGE()'), sql.index('IF DB_ID(@name) IS NOT NULL'))
+        self.assertLess(sql.index('IF DB_ID(@name) IS NOT NULL'), sql.index("N' SET MULTI_USER'"))
+        return None
+
+
+class BatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLiteBackend()
+        self.sqlbase = SQLBase(None, None, lazy=True, backend=self.backend)
+        self.sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)',
+                                 database_name='JobDB')
+        self.sqlbase.bulk_insert([(i, 'JHW.AHU{}'.format(i)) for i in range(10)],
+                                 'POINTBAS', columns=['ID', 'NAME'], database_name='JobDB')
+        self.sqlbase.init_database_connection('JobDB')
+        self.events = []
+        self.sqlbase.add_listener(self.events.append)
+        return None
+
+
+    def tearDown(self):
+        self.sqlbase.close()
+        self.backend.close()
+        return None
+
+
+    def test_batch_size(self):
+
+        batches = list(self.sqlbase.execute_sql_batches('SELECT * FROM POINTBAS ORDER BY ID',
+                                                        arraysize=4))
+        self.assertEqual([len(rows) for rows in batches], [4, 4, 2])
+        self.assertEqual([row[0] for rows in batches for row in rows], list(range(10)))
+
+        dfs = list(self.sqlbase.pandas_execute_sql_chunks('SELECT * FROM POINTBAS ORDER BY ID',
+                                                          chunksize=6))
+        self.assertEqual([len(df) for df in dfs], [6, 4])
+        self.assertEqual(list(dfs[0].columns), ['ID', 'NAME'])
+        return None
+
+
+    def test_closed_early_returns_connection(self):
+
+        for batches in [self.sqlbase.execute_sql_batches('SELECT * FROM POINTBAS', arraysize=3),
+                        self.sqlbase.pandas_execute_sql_chunks('SELECT * FROM POINTBAS',
+                                                               chunksize=3)]:
+            next(batches)
+            self.assertEqual(self.sqlbase.pool_stats()['JobDB']['checked_out'], 1)
+            batches.close()
+            self.assertEqual(self.sqlbase.pool_stats()['JobDB']['checked_out'], 0)
+        return None
+
+
+    def test_no_rows_and_no_result_set(self):
+
+        sql = 'SELECT * FROM POINTBAS WHERE ID < 0'
+        self.assertEqual(list(self.sqlbase.execute_sql_batches(sql)), [])
+        self.assertEqual(list(self.sqlbase.pandas_execute_sql_chunks(sql)), [])
+
+        del self.events[:]
+        self.assertEqual(list(self.sqlbase.execute_sql_batches(
+            "UPDATE POINTBAS SET NAME = 'JHW' WHERE ID = 1")), [])
+        self.assertEqual(list(self.sqlbase.pandas_execute_sql_chunks(
+            "UPDATE POINTBAS SET NAME = 'JHW.AHU' WHERE ID = 2")), [])
+        # Nothing is fetched, and the statements are committed
+        self.assertEqual([event.kind for event in self.events], [events.EXECUTE] * 2)
+        rows = self.sqlbase.execute_sql('SELECT NAME FROM POINTBAS WHERE ID IN (1, 2) ORDER BY ID')
+        self.assertEqual([row[0] for row in rows], ['JHW', 'JHW.AHU'])
+        self.assertEqual(self.sqlbase.pool_stats()['JobDB']['checked_out'], 0)
+        return None
+
+
+
+class BulkInsertTest(unittest.TestCase):
+
+    def test_quote_identifier(self):
+
+        self.assertEqual(quote_identifier('POINTBAS'), '[POINTBAS]')
+        self.assertEqual(quote_identifier('dbo.POINTBAS'), '[dbo].[POINTBAS]')
+        self.assertEqual(quote_identifier('[JobDB].[dbo].[POINTBAS]'), '[JobDB].[dbo].[POINTBAS]')
+        # A closing bracket inside a name is doubled
+        self.assertEqual(quote_identifier('POINT]BAS'), '[POINT]]BAS]')
+        self.assertEqual(quote_identifier('[POINT]]BAS]'), '[POINT]]BAS]')
+        self.assertEqual(quote_identifier('[dbo.POINTBAS]'), '[dbo.POINTBAS]')
+        self.assertEqual(quote_identifier('x]; DROP TABLE POINTBAS; --'),
+                         '[x]]; DROP TABLE POINTBAS; --]')
+        for name in ['', 'dbo.', '[POINTBAS', 'JobDB..POINTBAS']:
+            with self.assertRaises(ValueError):
+                quote_identifier(name)
+        return None
+
+
+    def test_batches(self):
+
+        backend = SQLiteBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        try:
+            sqlbase.execute_sql('CREATE TABLE POINTBAS (ID INTEGER, NAME TEXT)',
+                                database_name='JobDB')
+            report = sqlbase.bulk_insert([(i, 'JHW.AHU{}'.format(i)) for i in range(25)],
+                                         'POINTBAS',
+                                         columns=['ID', 'NAME'],
+                                         batch_size=10,
+                                         database_name='JobDB')
+            self.assertEqual((report['rows'], report['batches']), (25, 3))
+
+            report = sqlbase.bulk_insert([{'NAME':'JHW.VAV', 'ID':100}],
+                                         'POINTBAS', database_name='JobDB')
+            self.assertEqual((report['rows'], report['batches']), (1, 1))
+            rows = sqlbase.execute_sql('SELECT COUNT(*), MAX(ID) FROM POINTBAS',
+                                       database_name='JobDB')
+            self.assertEqual(tuple(rows[0]), (26, 100))
+
+            with self.assertRaises(ValueError):
+                sqlbase.bulk_insert([], 'POINTBAS', batch_size=0, database_name='JobDB')
+        finally:
+            sqlbase.close()
+            backend.close()
+        return None
+
+
+    def test_missing_values_are_null(self):
+
+        df = pd.DataFrame({'ID':pd.array([1, None], dtype='Int64'),
+                           'VALUE':[1.5, np.nan],
+                           'NAME':['JHW', None],
+                           'MODIFIED':[datetime.datetime(2020, 1, 13), pd.NaT]})
+        columns, records = SQLBase._iter_records(df)
+        records = list(records)
+
+        self.assertEqual(columns, ['ID', 'VALUE', 'NAME', 'MODIFIED'])
+        self.assertEqual(records[1], (None, None, None, None))
+        self.assertEqual(records[0][:3], (1, 1.5, 'JHW'))
+
+        columns, records = SQLBase._iter_records(df, columns=['NAME', 'ID'])
+        self.assertEqual(list(records), [('JHW', 1), (None, None)])
+        return None
+
+
+    def test_upsert_sql(self):
+
+        backend = _ServerBackend()
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        report = sqlbase.bulk_insert([(1, 2, 'JHW.AHU1'), (1, 3, 'JHW.AHU2')],
+                                     'dbo.POINTBAS',
+                                     columns=['NETDEVID', 'ID', 'NAME'],
+                                     upsert_keys=['NETDEVID', 'ID'],
+                                     database_name='JobDB')
+        self.assertEqual(report['rows'], 2)
+
+        (stage, _), (insert, rows), (merge, _), (drop, _) = backend.master.statements
+        # The UNION keeps an IDENTITY column from being copied to the stage
+        self.assertEqual(stage, "IF OBJECT_ID('tempdb..#sql_tools_stage') IS NOT NULL "
+                         "DROP TABLE #sql_tools_stage; SELECT TOP 0 [NETDEVID], [ID], [NAME] "
+                         "INTO #sql_tools_stage FROM [dbo].[POINTBAS] "
+                         "UNION ALL SELECT TOP 0 [NETDEVID], [ID], [NAME] FROM [dbo].[POINTBAS]")
+        self.assertEqual(insert, 'INSERT INTO #sql_tools_stage ([NETDEVID], [ID], [NAME]) '
+                         'VALUES (?, ?, ?)')
+        self.assertEqual(rows, [(1, 2, 'JHW.AHU1'), (1, 3, 'JHW.AHU2')])
+        self.assertEqual(merge, 'MERGE INTO [dbo].[POINTBAS] WITH (HOLDLOCK) AS target '
+                         'USING #sql_tools_stage AS source '
+                         'ON target.[NETDEVID] = source.[NETDEVID] AND target.[ID] = source.[ID] '
+                         'WHEN MATCHED THEN UPDATE SET target.[NAME] = source.[NAME] '
+                         'WHEN NOT MATCHED BY TARGET THEN INSERT ([NETDEVID], [ID], [NAME]) '
+                         'VALUES (source.[NETDEVID], source.[ID], source.[NAME]);')
+        self.assertEqual(drop, 'DROP TABLE #sql_tools_stage')
+        self.assertEqual(backend.master.commits, 1)
+
+        # Key only tables have nothing to update
+        self.assertNotIn('WHEN MATCHED', SQLBase._merge_sql('[T]', '#s', ['ID'], ['ID']))
+        with self.assertRaises(ValueError):
+            sqlbase.bulk_insert([(1,)], 'POINTBAS', columns=['ID'], upsert_keys=['NAME'],
+                                database_name='JobDB')
+        return None
+
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def test_close_leaves_caller_backend(self):
+
+        # A backend passed in belongs to the caller
+        backend = _ServerBackend()
+        with SQLBase(None, None, backend=backend) as sqlbase:
+            self.assertIs(sqlbase.master_connection, backend.master)
+        self.assertFalse(backend.closed)
+        self.assertIsNone(sqlbase._master_connection)
+
+        # A backend SQLBase created is closed with it
+        sqlbase = SQLBase('.\\SQLEXPRESS', 'SQL Server Native Client 11.0', lazy=True)
+        with mock.patch.object(sqlbase.backend, 'close') as close:
+            sqlbase.close()
+        close.assert_called_once_with()
+        return None
+
+
+    def test_is_network_path(self):
+
+        self.assertTrue(SQLBase.is_network_path('\\\\server\\share\\JobDB.mdf'))
+        self.assertTrue(SQLBase.is_network_path('//server/share/JobDB.mdf'))
+        self.assertFalse(SQLBase.is_network_path('/var/opt/mssql/data/JobDB.mdf'))
+
+        drive_types = {'C:\\':3, 'E:\\':3, 'Z:\\':4}
+        with mock.patch('sql_tools.sql_tools._drive_type', drive_types.get):
+            self.assertFalse(SQLBase.is_network_path('C:\\Jobs\\JobDB.mdf'))
+            # Local disks other than C: and D: are not network drives
+            self.assertFalse(SQLBase.is_network_path('E:\\Jobs\\JobDB.mdf'))
+            self.assertTrue(SQLBase.is_network_path('Z:\\Jobs\\JobDB.mdf'))
+        return None
+
+
+    def test_pyodbc_connection_str(self):
+
+        sqlbase = SQLBase('.\\SQLEXPRESS', 'SQL Server Native Client 11.0', lazy=True)
+        self.assertEqual(sqlbase.get_pyodbc_database_connection_str('JobDB'),
+                         'DRIVER={SQL Server Native Client 11.0}; SERVER=.\\SQLEXPRESS; '
+                         'DATABASE=JobDB; Trusted_Connection=yes;')
+        self.assertEqual(sqlbase.get_pyodbc_master_connection_str(),
+                         sqlbase.backend.connection_str('master'))
+
+        # The string is the one the backend connects with
+        backend = PyodbcBackend('.\\SQLEXPRESS', 'ODBC Driver 17 for SQL Server',
+                                uid='sql_tools', pwd='secret')
+        sqlbase = SQLBase(None, None, lazy=True, backend=backend)
+        self.assertEqual(sqlbase.get_pyodbc_database_connection_str('JobDB'),
+                         'DRIVER={ODBC Driver 17 for SQL Server}; SERVER=.\\SQLEXPRESS; '
+                         'DATABASE=JobDB; UID=sql_tools; PWD=secret;')
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
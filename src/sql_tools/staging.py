@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Local staging of database files. Attaching a .mdf on a network share makes
+every page read an SMB round trip; StagingCache copies the .mdf/.ldf pair to
+a local disk once and attaches the local copy. A copy is reused while the
+source file keeps its size and modification time (optionally its hash) and
+the copy itself is unchanged since it was last detached, and the least
+recently used copies are evicted to keep the cache under a disk
+quota. process_databases copies files in background threads while databases
+which are already staged are attached and extracted
+
+The SQL Server service account must be able to read and write the staging
+directory
+
+@author: vorst
+"""
+
+# Python imports
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Third party imports
+
+# Local imports
+from .catalog import normalize_path
+
+# Setup logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+#%%
+
+StagedFiles = namedtuple('StagedFiles',
+                         ['path_mdf',
+                          'path_ldf',
+                          'source_mdf',
+                          'source_ldf',
+                          'staged',
+                          'copied',
+                          'bytes',
+                          'seconds'])
+StagedFiles.__doc__ = """Result of staging one database. path_mdf and
+path_ldf are the files to attach: the local copies if staged is True,
+otherwise the source files (the copy would not fit the quota). copied is
+True if the files were copied now, False if an existing copy was reused.
+bytes and seconds are those of the copy"""
+
+MANIFEST = 'manifest.json'
+
+COPY_BUFFER = 8 * 2**20
+
+
+def _key(path_mdf):
+    return hashlib.sha1(normalize_path(path_mdf).encode('utf-8')).hexdigest()[:16]
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def copy_file(source, destination, digest=None):
+    """Copy source to destination through a temporary file, so a partial
+    copy is never mistaken for a complete one. If digest (hashlib object) is
+    given it is updated with the contents
+    outputs
+    -------
+    size : (int) bytes copied"""
+    partial = destination + '.partial'
+    size = 0
+    try:
+        if digest is None:
+            shutil.copyfile(source, partial)
+            size = os.path.getsize(partial)
+        else:
+            with open(source, 'rb') as reader, open(partial, 'wb') as writer:
+                while True:
+                    chunk = reader.read(COPY_BUFFER)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    writer.write(chunk)
+                    size += len(chunk)
+        os.replace(partial, destination)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    return size
+
+
+def file_hash(paths):
+    """sha1 of the contents of paths, in order"""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as reader:
+            while True:
+                chunk = reader.read(COPY_BUFFER)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StagingCache:
+
+    def __init__(self, directory, quota_bytes, verify='mtime'):
+        """Local copies of database files
+        inputs
+        -------
+        directory : (str) local directory holding the copies, created if
+            missing. Use a fast local disk
+        quota_bytes : (int) maximum total size of the copies. Least recently
+            used copies which are not attached are evicted to make room
+        verify : (str) how an existing copy is checked against its source :
+            'mtime' compares size and modification time, 'hash' also
+            compares a sha1 of the source contents (reads the source)"""
+        if verify not in ('mtime', 'hash'):
+            raise ValueError("verify must be 'mtime' or 'hash', got {}".format(verify))
+        self.directory = str(directory)
+        self.quota_bytes = quota_bytes
+        self.verify = verify
+        self._lock = threading.Lock()
+        # {key : Lock} so one source is copied by one thread at a time
+        self._key_locks = {}
+        # {key : number of users} of copies which must not be evicted
+        self._pins = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._entries = self._read_manifest()
+
+        return None
+
+
+    def _read_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        try:
+            with open(path) as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        # Drop entries whose copies are gone
+        return {key:entry for key, entry in entries.items()
+                if all(os.path.exists(os.path.join(self.directory, key, name))
+                       for name in entry['files'])}
+
+
+    def _write_manifest(self):
+        """Persist the entries. Call with the lock held"""
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.partial', 'w') as file:
+            json.dump(self._entries, file, indent=1)
+        os.replace(path + '.partial', path)
+        return None
+
+
+    def used_bytes(self):
+        """Total size of the copies, including copies in progress"""
+        with self._lock:
+            return sum(entry['bytes'] for entry in self._entries.values())
+
+
+    def _evict(self, needed):
+        """Remove least recently used unpinned copies until needed bytes fit
+        the quota. Call with the lock held. Returns False if they cannot"""
+        used = sum(entry['bytes'] for entry in self._entries.values())
+        candidates = sorted((entry['last_used'], key) for key, entry in self._entries.items()
+                            if not self._pins.get(key))
+        while used + needed > self.quota_bytes and candidates:
+            _last_used, key = candidates.pop(0)
+            entry = self._entries.pop(key)
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            used -= entry['bytes']
+            self.evictions += 1
+            logger.info('Evicted staged copy of {}'.format(entry['source_mdf']))
+
+        return used + needed <= self.quota_bytes
+
+
+    def _matches(self, entry, source_mdf, source_ldf, signatures, local):
+        if entry.get('complete') is not True:
+            return False
+        if entry['source_mdf'] != normalize_path(source_mdf) or \
+           entry['source_ldf'] != normalize_path(source_ldf):
+            return False
+        if [list(signature) for signature in signatures] != entry['signatures']:
+            return False
+        # Attaching and detaching rewrite the copy, so its signature is
+        # recorded after each use. A copy changed since (still attached, or
+        # left behind by a crash) is not reused
+        try:
+            if [list(_signature(path)) for path in local] != entry.get('local_signatures'):
+                return False
+        except OSError:
+            return False
+        if self.verify == 'hash' and file_hash([source_mdf, source_ldf]) != entry['hash']:
+            return False
+        return True
+
+
+    def stage(self, path_mdf, path_ldf):
+        """Return local copies of a .mdf/.ldf pair, copying them if no valid
+        copy exists. The copy is pinned (not evicted) until release() is
+        called with the same path_mdf
+        inputs
+        -------
+        path_mdf : (str) source .mdf file, usually on a network share
+        path_ldf : (str) source .ldf file
+        outputs
+        -------
+        staged : (StagedFiles)"""
+        path_mdf = str(path_mdf)
+        path_ldf = str(path_ldf)
+        key = _key(path_mdf)
+        names = [os.path.basename(path_mdf), os.path.basename(path_ldf)]
+        if names[0].lower() == names[1].lower():
+            names[1] = 'log_' + names[1]
+        local = [os.path.join(self.directory, key, name) for name in names]
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+        try:
+            with key_lock:
+                signatures = [_signature(path_mdf), _signature(path_ldf)]
+                with self._lock:
+                    entry = self._entries.get(key)
+                reuse = entry is not None and self._matches(entry, path_mdf, path_ldf,
+                                                            signatures, local)
+
+                if reuse:
+                    with self._lock:
+                        entry['last_used'] = time.time()
+                        self.hits += 1
+                        self._write_manifest()
+                    return StagedFiles(local[0], local[1], path_mdf, path_ldf, True, False, 0, 0.0)
+
+                size = signatures[0][0] + signatures[1][0]
+                with self._lock:
+                    self.misses += 1
+                    if self._entries.pop(key, None) is not None:
+                        # Stale copy of a changed source
+                        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                    if not self._evict(size):
+                        logger.info('{} does not fit the staging quota, attaching the source'.format(path_mdf))
+                        self._write_manifest()
+                        self._release(key)
+                        return StagedFiles(path_mdf, path_ldf, path_mdf, path_ldf, False, False, 0, 0.0)
+                    # Reserve the space while copying
+                    self._entries[key] = {'source_mdf':normalize_path(path_mdf),
+                                          'source_ldf':normalize_path(path_ldf),
+                                          'files':names,
+                                          'signatures':[list(signature) for signature in signatures],
+                                          'bytes':size,
+                                          'local_signatures':None,
+                                          'hash':None,
+                                          'complete':False,
+                                          'last_used':time.time()}
+
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                os.makedirs(os.path.join(self.directory, key))
+                start = time.perf_counter()
+                digest = hashlib.sha1() if self.verify == 'hash' else None
+                try:
+                    copied = copy_file(path_mdf, local[0], digest)
+                    copied += copy_file(path_ldf, local[1], digest)
+                except Exception:
+                    with self._lock:
+                        self._entries.pop(key, None)
+                    shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                    raise
+                seconds = time.perf_counter() - start
+
+                with self._lock:
+                    entry = self._entries[key]
+                    entry['hash'] = None if digest is None else digest.hexdigest()
+                    entry['local_signatures'] = [list(_signature(path)) for path in local]
+                    entry['complete'] = True
+                    entry['last_used'] = time.time()
+                    self._write_manifest()
+                logger.info('Staged {} ({:.0f} MB in {:.1f}s)'.format(path_mdf, copied / 2**20, seconds))
+
+                return StagedFiles(local[0], local[1], path_mdf, path_ldf, True, True, copied, seconds)
+
+        except Exception:
+            with self._lock:
+                self._release(key)
+            raise
+
+
+    def _release(self, key):
+        """Unpin a copy. Call with the lock held"""
+        count = self._pins.get(key, 0) - 1
+        if count > 0:
+            self._pins[key] = count
+        else:
+            self._pins.pop(key, None)
+        return None
+
+
+    def release(self, path_mdf):
+        """Allow the copy of path_mdf to be evicted again, usually after the
+        database was detached. The size and modification time of the copy
+        are recorded again, since attaching and detaching modify it"""
+        key = _key(str(path_mdf))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.get('complete'):
+                local = [os.path.join(self.directory, key, name) for name in entry['files']]
+                try:
+                    entry['local_signatures'] = [list(_signature(path)) for path in local]
+                    entry['bytes'] = sum(signature[0] for signature in entry['local_signatures'])
+                except OSError as e:
+                    logger.debug(e)
+                    entry['local_signatures'] = None
+                self._write_manifest()
+            self._release(key)
+        return None
+
+
+    def clear(self):
+        """Remove every copy which is not pinned"""
+        with self._lock:
+            for key in [key for key in self._entries if not self._pins.get(key)]:
+                del self._entries[key]
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            self._write_manifest()
+        return None
+
+
+    def stats(self):
+        """Return cache counters"""
+        with self._lock:
+            return {'entries':len(self._entries),
+                    'used_bytes':sum(entry['bytes'] for entry in self._entries.values()),
+                    'quota_bytes':self.quota_bytes,
+                    'hits':self.hits,
+                    'misses':self.misses,
+                    'evictions':self.evictions}
+
+
+def process_databases(sqlbase,
+                      specs,
+                      cache,
+                      extract=None,
+                      max_workers=4,
+                      copy_workers=2,
+                      detach=True):
+    """Stage, attach, extract from and detach many databases. Files are
+    copied by copy_workers threads; each database is attached as soon as its
+    copy is ready, while the copies of the next databases continue. See
+    sql_tools.batch.process_databases for the other inputs
+    inputs
+    -------
+    cache : (StagingCache)
+    copy_workers : (int) number of databases copied at once
+    detach : (bool) detach each database after extract. Copies are released
+        either way, so with detach=False detach the databases before the
+        cache evicts their copies
+    outputs
+    -------
+    results : (list) of (DatabaseResult) in the order of specs"""
+    from .batch import DatabaseSpec, DatabaseResult, _MasterSessions, _process_one
+
+    specs = [DatabaseSpec(*spec) for spec in specs]
+    # Copies which do not fit the quota are attached from the source,
+    # which needs trace flag 1807 on network paths
+    traceflag = any(sqlbase.is_network_path(spec.path_mdf) for spec in specs)
+    sessions = _MasterSessions(sqlbase, traceflag)
+
+    def process(spec, staged):
+        try:
+            local = spec._replace(path_mdf=staged.path_mdf, path_ldf=staged.path_ldf)
+            return _process_one(sqlbase, sessions, local, extract, detach)
+        finally:
+            # Unpinned even when left attached, so the quota still holds
+            if staged.staged:
+                cache.release(spec.path_mdf)
+
+    results = [None] * len(specs)
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=copy_workers,
+                                thread_name_prefix='sql_tools_staging') as copier, \
+             ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix='sql_tools_batch') as attacher:
+            copies = {copier.submit(cache.stage, spec.path_mdf, spec.path_ldf):index
+                      for index, spec in enumerate(specs)}
+            attaches = {}
+            while copies:
+                done, _pending = wait(copies, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = copies.pop(future)
+                    spec = specs[index]
+                    try:
+                        staged = future.result()
+                    except Exception as e:
+                        logger.info('Staging {} failed : {}'.format(spec.path_mdf, e))
+                        results[index] = DatabaseResult(spec.database_name, None, e, None, None, None)
+                        continue
+                    attaches[attacher.submit(process, spec, staged)] = index
+            for future, index in attaches.items():
+                results[index] = future.result()
+    finally:
+        sessions.close()
+
+    n_failed = sum(1 for result in results if result.error is not None)
+    logger.info('Processed {} staged databases in {:.1f}s, {} failed'.format(
+        len(results), time.perf_counter() - start, n_failed))
+
+    return results
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Staging cache tests
+
+@author: vorst
+"""
+
+# Python imports
+import os
+import tempfile
+import unittest
+
+# local imports
+from sql_tools.staging import StagingCache, process_databases
+
+#%%
+
+class _FakeSQLBase:
+    """Records attached databases; never needs the trace flag"""
+
+    def __init__(self):
+        self.attached = {}
+        return None
+
+    def _connect_database(self, database_name):
+        return _FakeConnection()
+
+    @staticmethod
+    def is_network_path(path_mdf):
+        return False
+
+    def attach_database(self, path_mdf, path_ldf, database_name,
+                        manage_traceflag=True, connection=None):
+        self.attached[database_name] = path_mdf
+        return None
+
+    def detach_database(self, database_name, connection=None):
+        del self.attached[database_name]
+        return None
+
+
+class _FakeConnection:
+
+    autocommit = False
+
+    def close(self):
+        return None
+
+
+class StagingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.share = os.path.join(self.directory.name, 'share')
+        self.local = os.path.join(self.directory.name, 'local')
+        os.makedirs(self.share)
+        return None
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+        return None
+
+
+    def job(self, name, size=1000):
+        directory = os.path.join(self.share, name)
+        os.makedirs(directory, exist_ok=True)
+        path_mdf = os.path.join(directory, 'JobDB.mdf')
+        path_ldf = os.path.join(directory, 'JobDB_Log.ldf')
+        with open(path_mdf, 'wb') as file:
+            file.write(os.urandom(size))
+        with open(path_ldf, 'wb') as file:
+            file.write(b'log')
+        return path_mdf, path_ldf
+
+
+    def test_copy_and_reuse(self):
+
+        cache = StagingCache(self.local, quota_bytes=10000, verify='hash')
+        path_mdf, path_ldf = self.job('job1')
+        staged = cache.stage(path_mdf, path_ldf)
+        self.assertTrue(staged.copied)
+        self.assertTrue(staged.path_mdf.startswith(self.local))
+        with open(staged.path_mdf, 'rb') as local, open(path_mdf, 'rb') as source:
+            self.assertEqual(local.read(), source.read())
+        cache.release(path_mdf)
+
+        # A new instance reads the manifest
+        cache = StagingCache(self.local, quota_bytes=10000)
+        self.assertFalse(cache.stage(path_mdf, path_ldf).copied)
+        cache.release(path_mdf)
+
+        # A changed source is copied again
+        with open(path_mdf, 'ab') as file:
+            file.write(b'new pages')
+        staged = cache.stage(path_mdf, path_ldf)
+        self.assertTrue(staged.copied)
+        self.assertEqual(os.path.getsize(staged.path_mdf), 1009)
+        return None
+
+
+    def test_lru_eviction_and_quota(self):
+
+        cache = StagingCache(self.local, quota_bytes=2500)
+        jobs = [self.job('job{}'.format(i)) for i in range(3)]
+        for path_mdf, path_ldf in jobs[:2]:
+            cache.stage(path_mdf, path_ldf)
+            cache.release(path_mdf)
+        # Use job0 so job1 is the least recently used
+        cache.stage(*jobs[0])
+        cache.release(jobs[0][0])
+
+        cache.stage(*jobs[2])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertFalse(cache.stage(*jobs[0]).copied)
+        self.assertLessEqual(cache.used_bytes(), 2500)
+
+        # job0 and job2 are pinned, so job1 cannot be staged
+        staged = cache.stage(*jobs[1])
+        self.assertFalse(staged.staged)
+        self.assertEqual(staged.path_mdf, jobs[1][0])
+        return None
+
+
+
+    def test_copy_changed_by_attach(self):
+
+        cache = StagingCache(self.local, quota_bytes=10000)
+        path_mdf, path_ldf = self.job('job1')
+        staged = cache.stage(path_mdf, path_ldf)
+
+        # Attaching and detaching write to the local copy
+        with open(staged.path_ldf, 'ab') as file:
+            file.write(b'recovered log records')
+        cache.release(path_mdf)
+        self.assertEqual(cache.used_bytes(), 1003 + len(b'recovered log records'))
+        self.assertFalse(cache.stage(path_mdf, path_ldf).copied)
+        cache.release(path_mdf)
+
+        # A copy changed outside stage / release is copied again
+        with open(staged.path_mdf, 'ab') as file:
+            file.write(b'pages')
+        staged = cache.stage(path_mdf, path_ldf)
+        self.assertTrue(staged.copied)
+        with open(staged.path_mdf, 'rb') as local, open(path_mdf, 'rb') as source:
+            self.assertEqual(local.read(), source.read())
+        return None
+
+
+    def test_process_databases_releases_pins(self):
+
+        cache = StagingCache(self.local, quota_bytes=2500)
+        specs = [self.job('job{}'.format(i)) + ('JobDB{}'.format(i),) for i in range(2)]
+
+        for detach in [True, False]:
+            sqlbase = _FakeSQLBase()
+            results = process_databases(sqlbase, specs, cache, detach=detach, max_workers=1)
+            self.assertEqual([result.error for result in results], [None, None])
+            self.assertEqual(len(sqlbase.attached), 0 if detach else 2)
+            # Nothing stays pinned, so the copies can be evicted
+            self.assertEqual(cache._pins, {})
+
+        path_mdf, path_ldf = self.job('job2')
+        staged = cache.stage(path_mdf, path_ldf)
+        self.assertTrue(staged.staged)
+        self.assertGreater(cache.stats()['evictions'], 0)
+        self.assertLessEqual(cache.stats()['used_bytes'], 2500)
+        cache.release(path_mdf)
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()